@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from .models import *
+from . import shards
 
 # Admin
 class UserAdmin(UserAdmin):
@@ -21,10 +22,68 @@ class UserAdmin(UserAdmin):
     search_fields = ('username', 'email')
     ordering = ('username',)
     readonly_fields = ('last_login', 'date_joined')
-class WalletAdmin(admin.ModelAdmin):
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        if not shards.is_sharded():
+            return []
+        return [(alias, alias) for alias in shards.shards()]
+
+    def queryset(self, request, queryset):
+        # applied by LedgerAdmin.get_queryset
+        return queryset
+
+
+class LedgerAdmin(admin.ModelAdmin):
+    """
+    Lists the ledger rows of the shard picked by the currency or shard filter
+    and finds a row to change on whichever shard holds it. Saving and
+    deleting go to the shard of the row's currency through the routers.
+    """
+
+    def shard(self, request):
+        # set by get_object for the row being changed
+        if getattr(request, 'ledger_shard', None):
+            return request.ledger_shard
+        currency = request.GET.get('currency__id__exact')
+        if currency:
+            return shards.for_currency(currency)
+        shard = request.GET.get('shard')
+        return shard if shard in shards.shards() else shards.PRIMARY
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).using(self.shard(request))
+
+    def get_list_select_related(self, request):
+        if self.shard(request) == shards.PRIMARY:
+            return super().get_list_select_related(request)
+        # joins can only reach the rows on the same shard
+        return tuple(field.name for field in self.model._meta.concrete_fields
+                     if field.is_relation and shards.is_ledger(field.related_model))
+
+    def get_object(self, request, object_id, from_field=None):
+        for alias in shards.shards():
+            request.ledger_shard = alias
+            obj = super().get_object(request, object_id, from_field)
+            if obj is not None:
+                return obj
+        request.ledger_shard = None
+        return None
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if shards.is_ledger(db_field.related_model):
+            kwargs['using'] = self.shard(request)
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+
+class WalletAdmin(LedgerAdmin):
     list_display = ('user', 'currency', 'balance', 'created_at', 'updated_at', 'publickey')
     search_fields = ('user', 'currency')
-    list_filter = ('user', 'currency')
+    list_filter = ('user', 'currency', ShardListFilter)
     readonly_fields = ('created_at', 'updated_at', 'publickey', 'privatekey')
 
     add_fieldsets = (
@@ -37,10 +96,10 @@ class WalletAdmin(admin.ModelAdmin):
         ('Important dates', {'fields': ('created_at', 'updated_at')}),
     )
 
-class TransactionAdmin(admin.ModelAdmin):
+class TransactionAdmin(LedgerAdmin):
     list_display = ('sender', 'receiver', 'amount', 'currency', 'created_at')
     search_fields = ('sender', 'receiver', 'amount', 'currency')
-    list_filter = ('sender', 'receiver', 'amount', 'currency')
+    list_filter = ('sender', 'receiver', 'amount', 'currency', ShardListFilter)
 
     add_fieldsets = (
         (None, {'fields': ('sender', 'receiver', 'amount', 'currency')}),
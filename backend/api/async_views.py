@@ -0,0 +1,175 @@
+"""
+Async versions of the CPU heavy REST views, used when served over ASGI with
+``ASYNC_VIEWS['ENABLED']``.
+
+They answer like their counterparts in api/views.py. Database work runs
+through sync_to_async, while password hashing, RSA signing and RSA key
+generation run in the bounded pools of api/offload.py, so a worker keeps
+serving cheap requests while expensive ones are in flight.
+"""
+import json
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.hashers import check_password, make_password
+from django.db import IntegrityError
+from django.http import JsonResponse
+from rest_framework import status
+
+from . import keypool, offload, shards, tokens, transfers
+from .models import Currency, User, Wallet
+from .serializers import CurrencySerializers, TransactionSerializers, WalletSerializers
+
+
+def async_api_view(view):
+    """Accept POST requests only and parse their body into ``request.data``."""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method != 'POST':
+            return JsonResponse({'message': f'Method "{request.method}" not allowed.'},
+                                status=status.HTTP_405_METHOD_NOT_ALLOWED)
+        if request.content_type == 'application/json':
+            try:
+                request.data = json.loads(request.body or b'{}')
+            except ValueError:
+                return JsonResponse({'message': 'Invalid JSON'}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            request.data = request.POST
+        try:
+            return await view(request, *args, **kwargs)
+        except shards.LedgerMoving:
+            return JsonResponse({'message': transfers.MOVING_MESSAGE},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    # authentication is by token, like the DRF views
+    wrapper.csrf_exempt = True
+    return wrapper
+
+
+def _authenticated_user(request):
+    # request.user may be a lazy session lookup, resolve it off the event loop
+    return request.user if request.user.is_authenticated else None
+
+
+def _missing(*fields):
+    return JsonResponse({'message': f'{", ".join(fields)} required'}, status=status.HTTP_400_BAD_REQUEST)
+
+
+@async_api_view
+async def register(request):
+    try:
+        username = request.data['username']
+        email = request.data['email']
+        password = request.data['password']
+    except KeyError:
+        return _missing('username', 'email', 'password')
+
+    hashed = await offload.run_in_thread(make_password, password)
+
+    def create():
+        user = User.objects.create(
+            username=username, email=User.objects.normalize_email(email), password=hashed)
+        return tokens.tokens_for(user)
+
+    try:
+        issued = await sync_to_async(create)()
+    except IntegrityError:
+        return JsonResponse({'message': 'Username already taken'}, status=status.HTTP_400_BAD_REQUEST)
+    return JsonResponse(issued, status=status.HTTP_201_CREATED)
+
+
+@async_api_view
+async def login(request):
+    try:
+        username = request.data['username']
+        password = request.data['password']
+    except KeyError:
+        return _missing('username', 'password')
+
+    user = await sync_to_async(User.objects.filter(username=username).first)()
+    if user is None:
+        return JsonResponse({'message': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+    if await offload.run_in_thread(check_password, password, user.password):
+        return JsonResponse(await sync_to_async(tokens.tokens_for)(user), status=status.HTTP_200_OK)
+    return JsonResponse({'message': 'Invalid credentials'}, status=status.HTTP_401_UNAUTHORIZED)
+
+
+async def _join(user, currency, status_code):
+    keyPair = await sync_to_async(keypool.take)()
+    if keyPair is None:
+        keyPair = await offload.run_in_process(keypool.generate_keypair)
+
+    def create():
+        wallet = Wallet(user=user, currency=currency, balance=currency.initial_balance,
+                        publickey=keyPair[0], privatekey=keyPair[1])
+        wallet.save()
+        return {
+            'wallet': WalletSerializers(wallet).data,
+            'currency': CurrencySerializers(currency).data,
+        }
+
+    return JsonResponse(await sync_to_async(create)(), status=status_code)
+
+
+@async_api_view
+async def currency_join(request):
+    user = await sync_to_async(_authenticated_user)(request)
+    if user is None:
+        return JsonResponse({'message': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
+    currency = await sync_to_async(Currency.objects.filter(invite_code=request.data.get('invite_code')).first)()
+    if currency is None:
+        return JsonResponse({'message': 'Invalid invite code'}, status=status.HTTP_404_NOT_FOUND)
+    return await _join(user, currency, status.HTTP_200_OK)
+
+
+@async_api_view
+async def wallet_create(request):
+    user = await sync_to_async(_authenticated_user)(request)
+    if user is None:
+        return JsonResponse({'message': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
+    try:
+        currency_id = int(request.data['currency'])
+    except (KeyError, TypeError, ValueError):
+        return JsonResponse({'message': 'Invalid currency id'}, status=status.HTTP_404_NOT_FOUND)
+    currency = await sync_to_async(Currency.objects.filter(id=currency_id).first)()
+    if currency is None:
+        return JsonResponse({'message': 'Invalid currency id'}, status=status.HTTP_404_NOT_FOUND)
+    return await _join(user, currency, status.HTTP_201_CREATED)
+
+
+@async_api_view
+async def transaction_create(request):
+    user = await sync_to_async(_authenticated_user)(request)
+    if user is None:
+        return JsonResponse({'message': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
+    try:
+        sender = request.data['sender']
+        receiver = request.data['receiver']
+        amount = request.data['amount']
+        currency = request.data['currency']
+    except KeyError:
+        return _missing('sender', 'receiver', 'amount', 'currency')
+
+    # sign before the wallets are locked, the transfer only checks the signatures
+    signatures = None
+    try:
+        sender_id, receiver_id, amount = int(sender), int(receiver), int(amount)
+    except (TypeError, ValueError):
+        pass
+    else:
+        wallets = await sync_to_async(shards.in_bulk)(
+            Wallet.objects.all(), [sender_id, receiver_id], users=True)
+        sender_wallet, receiver_wallet = wallets.get(sender_id), wallets.get(receiver_id)
+        if (sender_wallet is not None and receiver_wallet is not None and sender_id != receiver_id
+                and sender_wallet.user_id == user.id and 0 < amount <= sender_wallet.balance):
+            signatures = await offload.run_in_thread(transfers.sign, sender_wallet, receiver_wallet, amount)
+
+    def create():
+        transaction = transfers.transfer(sender, receiver, amount, currency, user=user, signatures=signatures)
+        return TransactionSerializers(transaction).data
+
+    try:
+        data = await sync_to_async(create)()
+    except transfers.TransferError as err:
+        return JsonResponse({'message': err.message}, status=err.status_code)
+    return JsonResponse(data, status=status.HTTP_201_CREATED)
@@ -0,0 +1,61 @@
+"""
+JWT authentication that decodes the token of a request once.
+
+The JWT middleware (through api.backends.JWTBackend) and DRF both
+authenticate every API request. The first pass stores its result on the
+Django request and every later pass, including DRF's, reuses it, so the
+token is decoded and the user loaded a single time per request. Users come
+from the cache of api/usercache.py, so most requests load none.
+"""
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from . import tokens, usercache
+
+_UNSET = object()
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    memo_attribute = '_jwt_authentication'
+
+    def authenticate(self, request):
+        # DRF wraps the Django request, the result is kept on the Django one
+        django_request = getattr(request, '_request', request)
+        result = getattr(django_request, self.memo_attribute, _UNSET)
+        if result is _UNSET:
+            try:
+                result = super().authenticate(request)
+            except Exception as err:
+                result = err
+            setattr(django_request, self.memo_attribute, result)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        user = usercache.get_user(user_id)
+        if user is None:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return user
+
+
+class ClaimsJWTAuthentication(CachedJWTAuthentication):
+    """
+    For identity-only views: a token with current claims authenticates as a
+    ClaimsUser without loading the user, older tokens fall back to the user.
+    """
+    memo_attribute = '_jwt_claims_authentication'
+
+    def get_user(self, validated_token):
+        if tokens.is_current(validated_token):
+            return tokens.ClaimsUser(validated_token)
+        return super().get_user(validated_token)
@@ -1,8 +1,8 @@
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from .authentication import CachedJWTAuthentication
 
 
 class JWTBackend:
-    authenticator = JWTAuthentication()
+    authenticator = CachedJWTAuthentication()
 
     def authenticate(self, request=None, **kwargs):
         if request is None:
@@ -0,0 +1,149 @@
+"""
+In-process set of blacklisted refresh token JTIs.
+
+Checking a refresh token against the token_blacklist tables costs a join
+query on every refresh. The JTIs of the blacklisted, unexpired tokens are
+kept in memory instead. The set is loaded on first use and then, at most
+every ``SYNC_INTERVAL`` seconds, reads the rows blacklisted since its last
+sync, so most checks never touch the tables. Tokens blacklisted by this
+process are added right away (see api/signals.py), tokens blacklisted by
+other workers are seen after their next sync. A ``SYNC_INTERVAL`` of 0
+syncs on every check.
+
+Rows do not commit in the order of their ids or of their blacklisted_at, so
+a sync reads again the rows blacklisted up to ``SYNC_LOOKBACK`` seconds
+before the previous one started. A row that takes longer to commit, or is
+stamped by a worker whose clock is further behind, is missed by these
+syncs, so every ``RELOAD_INTERVAL`` seconds a sync reads all the rows again.
+
+compact() prunes expired outstanding and blacklisted tokens in small
+chunks, each in its own short transaction, so the tables never stay locked
+for long. Schedule ``python manage.py compact_blacklist`` to run it.
+"""
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+DEFAULTS = {
+    'SYNC_INTERVAL': 5,
+    # seconds of rows read again by every sync, covers late commits and clock skew
+    'SYNC_LOOKBACK': 60,
+    # seconds between two syncs reading every row, bounds how long a revocation can be missed
+    'RELOAD_INTERVAL': 300,
+    'COMPACT_CHUNK_SIZE': 1000,
+    # seconds between two compaction chunks, lets other writers in
+    'COMPACT_PAUSE': 0.05,
+}
+
+
+def blacklist_settings():
+    return {**DEFAULTS, **getattr(settings, 'TOKEN_BLACKLIST', {})}
+
+
+class JtiSet:
+    def __init__(self):
+        self.loaded = False
+        # rows blacklisted after this are read by the next sync
+        self.since = None
+        self.synced_at = 0
+        self.reloaded_at = 0
+        self.checks = 0
+        self.syncs = 0
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def _load(self, rows):
+        for jti, expires_at in rows:
+            self._expires[jti] = expires_at
+
+    def sync(self, force=False):
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+        config = blacklist_settings()
+        now = time.monotonic()
+        with self._lock:
+            if not force and self.loaded and now - self.synced_at < config['SYNC_INTERVAL']:
+                return
+            self.synced_at = now
+            self.syncs += 1
+            started = timezone.now()
+            rows = BlacklistedToken.objects.filter(token__expires_at__gt=started)
+            if self.since is not None and now - self.reloaded_at < config['RELOAD_INTERVAL']:
+                rows = rows.filter(blacklisted_at__gt=self.since)
+            else:
+                self.reloaded_at = now
+            self._load(rows.values_list('token__jti', 'token__expires_at'))
+            self.since = started - timedelta(seconds=config['SYNC_LOOKBACK'])
+            self.loaded = True
+            self._prune()
+
+    def _prune(self):
+        now = timezone.now()
+        for jti in [jti for jti, expires_at in self._expires.items() if expires_at <= now]:
+            del self._expires[jti]
+
+    def add(self, jti, expires_at):
+        with self._lock:
+            self._expires[jti] = expires_at
+
+    def contains(self, jti):
+        self.sync()
+        with self._lock:
+            self.checks += 1
+            return jti in self._expires
+
+    def clear(self):
+        with self._lock:
+            self.loaded = False
+            self.since = None
+            self.synced_at = 0
+            self.reloaded_at = 0
+            self.checks = 0
+            self.syncs = 0
+            self._expires.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._expires),
+                'checks': self.checks,
+                'syncs': self.syncs,
+            }
+
+
+jtis = JtiSet()
+
+
+def is_blacklisted(jti):
+    return jtis.contains(jti)
+
+
+def stats():
+    return jtis.stats()
+
+
+def compact(chunk_size=None, pause=None):
+    """Delete expired outstanding tokens and their blacklist rows, return the number deleted."""
+    from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+    config = blacklist_settings()
+    chunk_size = chunk_size or config['COMPACT_CHUNK_SIZE']
+    pause = config['COMPACT_PAUSE'] if pause is None else pause
+    now = timezone.now()
+    deleted = 0
+    while True:
+        ids = list(OutstandingToken.objects.filter(expires_at__lte=now)
+                   .order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        with transaction.atomic():
+            BlacklistedToken.objects.filter(token_id__in=ids).delete()
+            OutstandingToken.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
+        if pause:
+            time.sleep(pause)
+    return deleted
@@ -0,0 +1,188 @@
+"""
+Point-in-time balances from periodic balance checkpoints.
+
+A checkpoint of a currency stores, for its moment ``as_of``, the balance of
+every wallet that moved since the previous checkpoint. A wallet without a
+row in a checkpoint did not move, so its newest row at or before a
+checkpoint holds its balance there, or its opening balance when it has no
+row yet. The balance at time T is that balance at the latest checkpoint
+before T plus the transfers between the checkpoint and T. Checkpoints are
+taken every ``EVERY`` transactions of a currency, or ``INTERVAL`` seconds
+after the last one when fewer came in, which bounds that scan.
+
+build() adds the due checkpoints of a currency after its last one,
+``python manage.py build_checkpoints --every`` keeps them up to date.
+Transactions younger than ``SETTLE_SECONDS`` wait for the next run: an
+older created_at may still be committing and a checkpoint must not miss
+it. Checkpoints live on the shard of their currency, see api/shards.py.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import BigIntegerField, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from . import shards
+from .models import BalanceCheckpoint, Currency, Transaction, Wallet
+
+DEFAULTS = {
+    # transactions of a currency between two checkpoints
+    'EVERY': 1000,
+    # seconds after which fewer transactions get a checkpoint too
+    'INTERVAL': 3600,
+    # transactions younger than this may still be committing
+    'SETTLE_SECONDS': 60,
+    # wallets read or written per query
+    'CHUNK_SIZE': 500,
+}
+
+
+class CheckpointError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def checkpoint_settings():
+    return {**DEFAULTS, **getattr(settings, 'BALANCE_CHECKPOINTS', {})}
+
+
+def parse_time(value):
+    """Parse ``at``, a bare date stands for the end of that day and no value for now."""
+    if value is None:
+        return timezone.now()
+    try:
+        parsed = parse_datetime(value)
+        day = parse_date(value) if parsed is None else None
+    except ValueError:
+        # well formed but impossible, like February 30th
+        raise CheckpointError(f'Invalid date {value}')
+    if parsed is None:
+        if day is None:
+            raise CheckpointError(f'Invalid date {value}')
+        parsed = datetime.combine(day, time.max)
+    if settings.USE_TZ and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def latest(queryset, currency_id, at=None):
+    """Return the as_of of the newest checkpoint of the currency at or before ``at``."""
+    checkpoints = queryset.filter(currency_id=currency_id)
+    if at is not None:
+        checkpoints = checkpoints.filter(as_of__lte=at)
+    return checkpoints.order_by('-as_of').values_list('as_of', flat=True).first()
+
+
+def with_checkpoint(wallets, as_of):
+    """Annotate ``wallets`` with ``checkpoint_balance``, their balance at the checkpoint ``as_of``."""
+    if as_of is None:
+        return wallets.annotate(checkpoint_balance=F('opening_balance'))
+    newest = (BalanceCheckpoint.objects.filter(wallet_id=OuterRef('pk'), as_of__lte=as_of)
+              .order_by('-as_of').values('balance')[:1])
+    return wallets.annotate(checkpoint_balance=Coalesce(
+        Subquery(newest), F('opening_balance'), output_field=BigIntegerField()))
+
+
+def deltas(transactions):
+    """Return {wallet id: net amount} of ``transactions``."""
+    moved = defaultdict(int)
+    for sender_id, receiver_id, amount in transactions.values_list('sender_id', 'receiver_id', 'amount').iterator():
+        moved[sender_id] -= amount
+        moved[receiver_id] += amount
+    return moved
+
+
+def _after(transactions, as_of, at):
+    transactions = transactions.filter(created_at__lte=at)
+    if as_of is not None:
+        transactions = transactions.filter(created_at__gt=as_of)
+    return transactions
+
+
+def balance_at(wallet, at):
+    """Return the balance of ``wallet`` at ``at``, None before it was created."""
+    if wallet.created_at > at:
+        return None
+    checkpoints = shards.on_shard(BalanceCheckpoint.objects.all(), wallet.currency_id)
+    as_of = latest(checkpoints, wallet.currency_id, at)
+    balance = with_checkpoint(
+        shards.on_shard(Wallet.objects.filter(pk=wallet.pk), wallet.currency_id), as_of
+    ).values_list('checkpoint_balance', flat=True).get()
+    transactions = _after(shards.on_shard(Transaction.objects.all(), wallet.currency_id), as_of, at)
+    sent = transactions.filter(sender_id=wallet.pk).aggregate(total=Sum('amount'))['total'] or 0
+    received = transactions.filter(receiver_id=wallet.pk).aggregate(total=Sum('amount'))['total'] or 0
+    return balance + received - sent
+
+
+def balances_at(currency_id, at):
+    """Return (wallet, balance) at ``at`` for the wallets of the currency created by then."""
+    checkpoints = shards.on_shard(BalanceCheckpoint.objects.all(), currency_id)
+    as_of = latest(checkpoints, currency_id, at)
+    wallets = shards.with_users(with_checkpoint(
+        shards.on_shard(Wallet.objects.filter(currency_id=currency_id, created_at__lte=at), currency_id),
+        as_of).order_by('id'))
+    moved = deltas(_after(shards.by_currency(Transaction.objects.all(), currency_id), as_of, at))
+    return [(wallet, wallet.checkpoint_balance + moved.get(wallet.pk, 0)) for wallet in wallets]
+
+
+def _next(pending, last, settled, config):
+    """Return the as_of of the next checkpoint of the ``pending`` transactions, None when none is due."""
+    times = pending.order_by('created_at').values_list('created_at', flat=True)
+    full = times[config['EVERY'] - 1:config['EVERY']].first()
+    if full is not None:
+        return full
+    newest = times.last()
+    since = last if last is not None else times.first()
+    if newest is None or settled - since < timedelta(seconds=config['INTERVAL']):
+        return None
+    return newest
+
+
+def build(currency_id, now=None):
+    """Add the due checkpoints of a currency, return how many were added."""
+    config = checkpoint_settings()
+    using = shards.for_currency(currency_id, write=True)
+    settled = (now or timezone.now()) - timedelta(seconds=config['SETTLE_SECONDS'])
+    checkpoints = BalanceCheckpoint.objects.using(using)
+    added = 0
+    while True:
+        last = latest(checkpoints, currency_id)
+        pending = _after(Transaction.objects.using(using).filter(currency_id=currency_id), last, settled)
+        as_of = _next(pending, last, settled, config)
+        if as_of is None:
+            return added
+        moved = deltas(pending.filter(created_at__lte=as_of))
+        wallet_ids = list(moved)
+        balances = {}
+        for start in range(0, len(wallet_ids), config['CHUNK_SIZE']):
+            balances.update(with_checkpoint(
+                Wallet.objects.using(using).filter(id__in=wallet_ids[start:start + config['CHUNK_SIZE']]), last
+            ).values_list('id', 'checkpoint_balance'))
+        rows = [
+            BalanceCheckpoint(currency_id=currency_id, wallet_id=wallet_id, as_of=as_of,
+                              balance=balance + moved[wallet_id])
+            for wallet_id, balance in balances.items()
+        ]
+        if not rows:
+            return added
+        with transaction.atomic(using=using):
+            shards.assign_ids(rows)
+            checkpoints.bulk_create(rows, batch_size=config['CHUNK_SIZE'])
+        added += 1
+
+
+def build_all(now=None):
+    """Add the due checkpoints of every currency, return how many were added."""
+    added = 0
+    for currency_id in Currency.objects.values_list('id', flat=True):
+        try:
+            added += build(currency_id, now=now)
+        except shards.LedgerMoving:
+            # its checkpoints move with it, the next run catches up
+            continue
+    return added
@@ -0,0 +1,169 @@
+"""
+Parsed document cache and persisted queries for the GraphQL endpoint.
+
+Documents are parsed and validated once and kept in an LRU keyed by the
+SHA-256 of their text, so repeated operations skip lexing, parsing and
+validation. Clients may send only that hash, either as ``id`` or as an
+Apollo style ``extensions.persistedQuery.sha256Hash``, and the text is
+looked up in the cache or in the registered PersistedQuery rows. With
+``PERSISTED_ONLY`` the endpoint runs registered documents only.
+
+The registered texts read from the database are kept per process for
+``REGISTRY_TTL`` seconds, so a hash is looked up in the database once and
+a query removed from the registry stops running within that time.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
+from graphql import parse, validate
+from graphql.backend.base import GraphQLDocument
+from graphql.execution import execute
+
+DEFAULTS = {
+    'CACHE_SIZE': 500,
+    'PERSISTED_ONLY': False,
+    # seconds a process trusts a registered query it read
+    'REGISTRY_TTL': 60,
+}
+
+
+def documents_settings():
+    return {**DEFAULTS, **getattr(settings, 'GRAPHQL_DOCUMENTS', {})}
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+
+class PersistedQueryNotFound(Exception):
+    pass
+
+
+class PersistedQueryNotAllowed(Exception):
+    pass
+
+
+class DocumentCache:
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            document = self._entries.get(key)
+            if document is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return document
+
+    def put(self, key, document):
+        with self._lock:
+            self._entries[key] = document
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+cache = DocumentCache(documents_settings()['CACHE_SIZE'])
+
+
+def load(schema, query):
+    """
+    Return (document, errors) for ``query``. A valid document is cached and
+    executes without being validated again.
+    """
+    key = query_hash(query)
+    document = cache.get(key)
+    if document is not None:
+        return document, None
+
+    document_ast = parse(query)
+    errors = validate(schema, document_ast)
+    if errors:
+        return None, errors
+    document = GraphQLDocument(
+        schema=schema,
+        document_string=query,
+        document_ast=document_ast,
+        execute=partial(execute, schema, document_ast),
+    )
+    cache.put(key, document)
+    return document, None
+
+
+class Registry:
+    """The registered query texts read by this process, by hash."""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        """Return the registered text of ``digest``, None when it is not registered."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and now - entry[1] < documents_settings()['REGISTRY_TTL']:
+                self._entries.move_to_end(digest)
+                return entry[0]
+
+        from .models import PersistedQuery
+
+        query = PersistedQuery.objects.filter(sha256=digest).values_list('query', flat=True).first()
+        with self._lock:
+            if query is None:
+                self._entries.pop(digest, None)
+                return None
+            self._entries[digest] = (query, now)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return query
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+registry = Registry(documents_settings()['CACHE_SIZE'])
+
+
+def registered_query(digest):
+    return registry.get(digest)
+
+
+def resolve(query, digest):
+    """Return the text to run for a request carrying ``query`` and/or a hash."""
+    persisted_only = documents_settings()['PERSISTED_ONLY']
+    if query:
+        if digest and digest != query_hash(query):
+            raise PersistedQueryNotFound('provided sha does not match query')
+        if persisted_only and registered_query(query_hash(query)) is None:
+            raise PersistedQueryNotAllowed('Only persisted queries are allowed')
+        return query
+
+    if not digest:
+        return query
+    document = None if persisted_only else cache.get(digest)
+    if document is not None:
+        return document.document_string
+    query = registered_query(digest)
+    if query is None:
+        raise PersistedQueryNotFound('PersistedQueryNotFound')
+    return query
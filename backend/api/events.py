@@ -0,0 +1,155 @@
+"""
+Wallet events pushed to subscribed clients.
+
+Transfers publish a ``transaction`` and a ``balance`` event on the channel of
+each wallet they touch once their database transaction commits, and the
+event stream of backend/asgi.py forwards them to the owners of the wallets.
+The broker that fans the events out is chosen by ``EVENTS['BACKEND']``. The
+default keeps subscribers in process, so a deployment running several
+processes replaces it with a broker that relays events between them.
+"""
+import asyncio
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.utils.module_loading import import_string
+
+DEFAULTS = {
+    'BACKEND': 'api.events.InProcessBroker',
+    'HEARTBEAT': 15,
+    'QUEUE_SIZE': 100,
+}
+
+
+def events_settings():
+    return {**DEFAULTS, **getattr(settings, 'EVENTS', {})}
+
+
+def wallet_channel(wallet_id):
+    return f'wallet:{wallet_id}'
+
+
+class Subscription:
+    """The events of some channels, read with ``await subscription.get()``."""
+
+    def __init__(self, broker, channels, size):
+        self.broker = broker
+        self.channels = list(channels)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(size)
+
+    def deliver(self, event):
+        # called from any thread, the queue belongs to the subscriber's loop
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        if self.queue.full():
+            # a slow client loses its oldest events rather than stalling publishers
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout=None):
+        """Return the next event, or None after ``timeout`` seconds."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class Broker:
+    """Interface of the event brokers."""
+
+    def publish(self, channel, event):
+        raise NotImplementedError
+
+    def subscribe(self, channels):
+        """Return a Subscription, must be called from the subscriber's event loop."""
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription):
+        raise NotImplementedError
+
+
+class InProcessBroker(Broker):
+    def __init__(self):
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def publish(self, channel, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.deliver(event)
+
+    def subscribe(self, channels):
+        subscription = Subscription(self, channels, events_settings()['QUEUE_SIZE'])
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscriptions.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscriptions[channel]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscriptions.values())
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = import_string(events_settings()['BACKEND'])()
+        return _broker
+
+
+def transfer_events(transaction):
+    """Return (channel, event) pairs describing a saved transfer."""
+    data = {
+        'id': transaction.id,
+        'sender': transaction.sender_id,
+        'receiver': transaction.receiver_id,
+        'amount': transaction.amount,
+        'currency': transaction.currency_id,
+        'created_at': transaction.created_at.isoformat() if transaction.created_at else None,
+    }
+    balances = (
+        (transaction.sender_id, transaction.after_sender_amount_snapshot),
+        (transaction.receiver_id, transaction.after_receiver_amount_snapshot),
+    )
+    events = []
+    for wallet_id, balance in balances:
+        channel = wallet_channel(wallet_id)
+        events.append((channel, {'type': 'transaction', 'data': data}))
+        events.append((channel, {'type': 'balance', 'data': {'wallet': wallet_id, 'balance': balance}}))
+    return events
+
+
+def publish_transfers(transactions, using=None):
+    """Publish the events of ``transactions`` once the current transaction of ``using`` commits."""
+    events = [event for transaction in transactions for event in transfer_events(transaction)]
+    if not events:
+        return
+
+    def publish():
+        broker = get_broker()
+        for channel, event in events:
+            broker.publish(channel, event)
+
+    db_transaction.on_commit(publish, using=using)
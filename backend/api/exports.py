@@ -0,0 +1,217 @@
+"""
+Streaming exports of transaction history.
+
+The history of a wallet or a currency is written as CSV or NDJSON while it
+is read. Rows are read in keyset batches ordered by (created_at, id), each
+batch through QuerySet.iterator(), so memory stays the same for ten rows or
+ten million. Time range and counterparty filters are part of the query. The
+output can be gzipped on the fly.
+
+Under ASGI, Django 3.2 iterates a streaming response on the event loop where
+the ORM refuses to run. backend/asgi.py serves Django with ExportASGIHandler,
+which pulls each chunk of a streaming response in the thread of the view.
+"""
+import csv
+import json
+import zlib
+from datetime import datetime, time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from . import shards
+from .models import Transaction
+
+DEFAULTS = {
+    'BATCH_SIZE': 5000,
+    # rows fetched from the cursor at a time within a batch
+    'FETCH_SIZE': 1000,
+}
+
+FIELDS = (
+    'id', 'created_at', 'sender', 'receiver', 'amount', 'currency',
+    'before_sender_amount_snapshot', 'after_sender_amount_snapshot',
+    'before_receiver_amount_snapshot', 'after_receiver_amount_snapshot',
+)
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class ExportError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def export_settings():
+    return {**DEFAULTS, **getattr(settings, 'EXPORTS', {})}
+
+
+def _parse_time(value, end=False):
+    if value is None:
+        return None
+    try:
+        parsed = parse_datetime(value)
+        day = parse_date(value) if parsed is None else None
+    except ValueError:
+        # well formed but impossible, like February 30th
+        raise ExportError(f'Invalid date {value}')
+    if parsed is None:
+        if day is None:
+            raise ExportError(f'Invalid date {value}')
+        # a bare end date includes the whole day
+        parsed = datetime.combine(day, time.max if end else time.min)
+    if settings.USE_TZ and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def filter_history(queryset, params, counterparty_of=None):
+    """
+    Apply the ``start``, ``end`` and ``counterparty`` parameters. With
+    ``counterparty_of`` (a wallet id) the counterparty is the other side of
+    that wallet's transfers, otherwise either side.
+    """
+    start = _parse_time(params.get('start'))
+    end = _parse_time(params.get('end'), end=True)
+    if start is not None:
+        queryset = queryset.filter(created_at__gte=start)
+    if end is not None:
+        queryset = queryset.filter(created_at__lte=end)
+    counterparty = params.get('counterparty')
+    if counterparty is not None:
+        try:
+            counterparty = int(counterparty)
+        except ValueError:
+            raise ExportError('Invalid counterparty wallet id')
+        if counterparty_of is None:
+            queryset = queryset.filter(Q(sender_id=counterparty) | Q(receiver_id=counterparty))
+        else:
+            queryset = queryset.filter(
+                Q(sender_id=counterparty_of, receiver_id=counterparty)
+                | Q(sender_id=counterparty, receiver_id=counterparty_of))
+    return queryset
+
+
+def wallet_history(wallet):
+    return shards.on_shard(
+        Transaction.objects.filter(Q(sender_id=wallet.id) | Q(receiver_id=wallet.id)), wallet.currency_id)
+
+
+def currency_history(currency):
+    return shards.by_currency(Transaction.objects.all(), currency.id)
+
+
+def rows(queryset, batch_size=None, fetch_size=None):
+    """Yield the FIELDS of every row of ``queryset`` in (created_at, id) order, one batch at a time."""
+    config = export_settings()
+    batch_size = batch_size or config['BATCH_SIZE']
+    fetch_size = fetch_size or config['FETCH_SIZE']
+    queryset = queryset.order_by('created_at', 'id').values_list(*FIELDS)
+    after = None
+    while True:
+        batch = queryset
+        if after is not None:
+            batch = batch.filter(Q(created_at__gt=after[0]) | Q(created_at=after[0], id__gt=after[1]))
+        count = 0
+        for row in batch[:batch_size].iterator(chunk_size=fetch_size):
+            count += 1
+            yield row
+        if count < batch_size:
+            return
+        after = (row[1], row[0])
+
+
+class _Echo:
+    """A file that returns what is written, lets csv.writer format one row at a time."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(FIELDS)
+    for row in rows:
+        yield writer.writerow((row[0], row[1].isoformat(), *row[2:]))
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        record = dict(zip(FIELDS, row))
+        record['created_at'] = record['created_at'].isoformat()
+        yield json.dumps(record) + '\n'
+
+
+def encoded(lines, size=64 * 1024):
+    """Group ``lines`` into byte chunks of about ``size``."""
+    buffer, length = [], 0
+    for line in lines:
+        data = line.encode('utf-8')
+        buffer.append(data)
+        length += len(data)
+        if length >= size:
+            yield b''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_response(queryset, export_format, filename, compress=False):
+    if export_format not in FORMATS:
+        raise ExportError(f'Format must be one of {", ".join(FORMATS)}')
+    lines = csv_lines if export_format == 'csv' else ndjson_lines
+    chunks = encoded(lines(rows(queryset)))
+    filename = f'{filename}.{export_format}'
+    content_type = FORMATS[export_format]
+    if compress:
+        chunks = gzipped(chunks)
+        filename += '.gz'
+        content_type = 'application/gzip'
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+class ExportASGIHandler(ASGIHandler):
+    """Django's ASGI handler, iterating streaming responses where the ORM may run."""
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        headers = [
+            (header.encode('ascii') if isinstance(header, str) else header,
+             value.encode('latin1') if isinstance(value, str) else value)
+            for header, value in response.items()
+        ]
+        headers.extend((b'Set-Cookie', cookie.output(header='').encode('ascii').strip())
+                       for cookie in response.cookies.values())
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        parts = iter(response)
+        # the thread the view ran in, which holds its database connection
+        pull = sync_to_async(next, thread_sensitive=True)
+        while True:
+            part = await pull(parts, None)
+            if part is None:
+                break
+            for chunk, _ in self.chunk_bytes(part):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body'})
+        await sync_to_async(response.close, thread_sensitive=True)()
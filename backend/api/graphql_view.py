@@ -0,0 +1,110 @@
+import json
+import logging
+import time
+from contextlib import nullcontext
+
+from django.http import HttpResponseBadRequest, HttpResponseNotAllowed
+from graphene_django.views import GraphQLView, HttpError
+from graphql.execution import ExecutionResult
+
+from . import documents, query_cost, routers
+
+logger = logging.getLogger(__name__)
+
+
+class ResolveCounterMiddleware:
+    """Counts the fields resolved for a request, the actual cost of the operation."""
+
+    def resolve(self, next, root, info, **args):
+        info.context.graphql_resolved = getattr(info.context, 'graphql_resolved', 0) + 1
+        return next(root, info, **args)
+
+
+class ValidationFailed(Exception):
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+class BlokkGraphQLView(GraphQLView):
+    """
+    GraphQLView that rejects operations over the depth or cost limits before
+    they run and logs their estimated cost, actual cost and execution time.
+    Documents come from the parsed document cache and may be sent as the hash
+    of a persisted query. Queries read from the database replicas, see
+    api/routers.py.
+    """
+
+    @staticmethod
+    def get_graphql_params(request, data):
+        query, variables, operation_name, id = GraphQLView.get_graphql_params(request, data)
+
+        extensions = request.GET.get("extensions") or data.get("extensions") or {}
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpError(HttpResponseBadRequest("Extensions are invalid JSON."))
+        persisted = extensions.get("persistedQuery") if isinstance(extensions, dict) else None
+        digest = (persisted or {}).get("sha256Hash") or id
+
+        try:
+            query = documents.resolve(query, digest)
+        except (documents.PersistedQueryNotFound, documents.PersistedQueryNotAllowed) as e:
+            raise HttpError(HttpResponseBadRequest(str(e)))
+        return query, variables, operation_name, id
+
+    def get_middleware(self, request):
+        return list(super().get_middleware(request) or []) + [ResolveCounterMiddleware()]
+
+    def get_document(self, request, query):
+        document, errors = documents.load(self.schema, query)
+        if errors:
+            raise ValidationFailed(errors)
+        return document
+
+    def execute_graphql_request(self, request, data, query, variables, operation_name, show_graphiql=False):
+        if not query:
+            if show_graphiql:
+                return None
+            raise HttpError(HttpResponseBadRequest("Must provide query string."))
+
+        try:
+            document = self.get_document(request, query)
+            operation_type = document.get_operation_type(operation_name)
+        except ValidationFailed as e:
+            return ExecutionResult(errors=e.errors, invalid=True)
+        except Exception as e:
+            return ExecutionResult(errors=[e], invalid=True)
+
+        if request.method.lower() == "get" and operation_type and operation_type != "query":
+            if show_graphiql:
+                return None
+            raise HttpError(HttpResponseNotAllowed(
+                ["POST"], f"Can only perform a {operation_type} operation from a POST request."))
+
+        try:
+            estimated = query_cost.check(self.schema, document.document_ast, operation_name, variables)
+        except Exception as e:
+            return ExecutionResult(errors=[e], invalid=True)
+
+        started = time.perf_counter()
+        # queries only read, they can be answered by a replica
+        reads = routers.replica_reads() if operation_type == "query" else nullcontext()
+        try:
+            with reads:
+                result = document.execute(
+                    root_value=self.get_root_value(request),
+                    variable_values=variables,
+                    operation_name=operation_name,
+                    context_value=self.get_context(request),
+                    middleware=self.get_middleware(request),
+                )
+        except Exception as e:
+            return ExecutionResult(errors=[e], invalid=True)
+
+        logger.info(
+            "graphql operation=%s estimated_cost=%d actual_cost=%d time=%.1fms",
+            operation_name or operation_type, estimated, getattr(request, 'graphql_resolved', 0),
+            (time.perf_counter() - started) * 1000)
+        return result
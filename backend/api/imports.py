@@ -0,0 +1,442 @@
+"""
+Bulk import of users, currencies, wallets and their history.
+
+Creating a migrated ledger through the models costs a key generation per
+wallet, two signatures per transaction and several saves per row. The
+importer reads one record per line of NDJSON or CSV input and writes the
+records with bulk_create, ``BATCH_SIZE`` at a time:
+
+    {"type": "user", "username": ..., "email": ..., "password": <a Django password hash>}
+    {"type": "currency", "symbol": ..., "name": ..., "admin": <username>,
+     "market_cap": ..., "initial_balance": ...}
+    {"type": "wallet", "user": <username>, "currency": <symbol>,
+     "balance": <balance before the history>, "publickey": ..., "privatekey": ...}
+    {"type": "transaction", "currency": <symbol>, "sender": <username>,
+     "receiver": <username>, "amount": ..., "created_at": ...}
+
+CSV input has a ``type`` column and a column per field, empty cells are
+missing fields. Records refer to the users, currencies and wallets of
+earlier lines, users may also exist already. Wallets without keys get a new
+pair and transactions without signatures are signed, both in a pool of
+``WORKERS`` processes. The balances are followed in memory while the history
+is read, which gives the snapshots of every transaction. Each batch of
+transactions is written in one database transaction with the balances and
+running totals it leaves its wallets with. Wallets and transactions are
+written to the shard of their currency.
+
+A bad record stops the import. The records before its batch stay imported
+with consistent balances, so the input can be fixed and the rest imported.
+The same holds when the import fails or is interrupted otherwise.
+"""
+import binascii
+import csv
+import json
+import math
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+from Crypto.Hash import SHA256
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import transaction as db_transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import keycache, keypool, shards
+from .models import Currency, Transaction, User, Wallet
+
+DEFAULTS = {
+    # rows written per bulk_create
+    'BATCH_SIZE': 2000,
+    # processes generating keys and signing, 0 works in-process
+    'WORKERS': 2,
+}
+
+TYPES = ('user', 'currency', 'wallet', 'transaction')
+
+LABELS = dict(zip(TYPES, ('users', 'currencies', 'wallets', 'transactions')))
+
+FORMATS = ('ndjson', 'csv')
+
+
+class LedgerImportError(Exception):
+    def __init__(self, message, line=None):
+        if line is not None:
+            message = f'Line {line}: {message}'
+        super().__init__(message)
+        self.message = message
+
+
+def import_settings():
+    return {**DEFAULTS, **getattr(settings, 'LEDGER_IMPORT', {})}
+
+
+def read_records(lines, input_format):
+    """Yield (line number, record) for the records of NDJSON or CSV ``lines``."""
+    if input_format == 'csv':
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, {
+                key: value for key, value in record.items() if key is not None and value not in ('', None)}
+    elif input_format == 'ndjson':
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise LedgerImportError('Invalid JSON', number)
+            if not isinstance(record, dict):
+                raise LedgerImportError('A record must be a JSON object', number)
+            yield number, record
+    else:
+        raise LedgerImportError(f'Format must be one of {", ".join(FORMATS)}')
+
+
+# parsed private keys of the process signing, see sign_chunk()
+_keys = keycache.KeyCache()
+
+
+def sign_chunk(chunk):
+    """
+    Sign the transfers of ``chunk``, a ({wallet id: private key}, [(sender id,
+    receiver id, message)]) pair, return their (sender, receiver) signatures.
+    """
+    keys, items = chunk
+    signatures = []
+    for sender_id, receiver_id, message in items:
+        digest = SHA256.new(message.encode('utf-8'))
+        signatures.append(tuple(
+            binascii.hexlify(_keys.get((wallet_id, 'private'), keys[wallet_id]).sign(digest)).decode('ascii')
+            for wallet_id in (sender_id, receiver_id)))
+    return signatures
+
+
+@contextmanager
+def historical_timestamps():
+    """Let bulk_create keep the created_at of the ledger rows instead of stamping the current time."""
+    fields = [model._meta.get_field('created_at') for model in (Wallet, Transaction)]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+class _WalletState:
+    """A wallet of the import and its balance after the history read so far."""
+    __slots__ = ('id', 'user_id', 'currency_id', 'shard', 'balance', 'received', 'sent')
+
+    def __init__(self, user_id, currency_id, balance):
+        self.id = None
+        self.user_id = user_id
+        self.currency_id = currency_id
+        self.shard = None
+        self.balance = balance
+        self.received = 0
+        self.sent = 0
+
+
+class Importer:
+    def __init__(self, batch_size=None, workers=None, log=None):
+        config = import_settings()
+        self.batch_size = batch_size or config['BATCH_SIZE']
+        self.workers = config['WORKERS'] if workers is None else workers
+        self.log = log
+        # username -> id, symbol -> (id, admin username), (username, symbol) -> _WalletState
+        self.users = {}
+        self.currencies = {}
+        self.wallets = {}
+        # wallet id -> _WalletState of the written wallets
+        self._states = {}
+        self.counts = dict.fromkeys(TYPES, 0)
+        self._kind = None
+        self._batch = []
+        self._executor = None
+        self._started = None
+
+    def run(self, records):
+        """Import ``records``, (line number, record) pairs, return the counts per type."""
+        self._started = time.perf_counter()
+        pool = ProcessPoolExecutor(max_workers=self.workers) if self.workers else nullcontext()
+        with pool as executor, historical_timestamps():
+            self._executor = executor
+            try:
+                for line, record in records:
+                    self.add(line, record)
+                self.flush()
+                self.add_admin_wallets()
+            except LedgerImportError:
+                # the records parsed before the bad one are valid
+                self.flush()
+                raise
+        return self.counts
+
+    def add(self, line, record):
+        kind = record.get('type')
+        if kind not in TYPES:
+            raise LedgerImportError(f'Type must be one of {", ".join(TYPES)}', line)
+        if kind != self._kind or len(self._batch) >= self.batch_size:
+            self.flush()
+        row = getattr(self, f'_parse_{kind}')(line, record)
+        self._kind = kind
+        self._batch.append(row)
+
+    def flush(self):
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        getattr(self, f'_write_{self._kind}')(batch)
+        self.counts[self._kind] += len(batch)
+        self.progress()
+
+    def elapsed(self):
+        return time.perf_counter() - self._started
+
+    def progress(self):
+        if self.log is None:
+            return
+        total, elapsed = sum(self.counts.values()), self.elapsed()
+        counts = ' '.join(f'{LABELS[kind]}={count}' for kind, count in self.counts.items())
+        self.log(f'{counts} {total / elapsed if elapsed else 0:.1f} rows/s')
+
+    def _map(self, fn, items):
+        if self._executor is None:
+            return list(map(fn, items))
+        return list(self._executor.map(fn, items, chunksize=max(1, len(items) // (self.workers * 4))))
+
+    # reading records
+
+    def _field(self, line, record, name, default=None):
+        value = record.get(name, default)
+        if value is None:
+            raise LedgerImportError(f'Missing {name}', line)
+        return value
+
+    def _int(self, line, record, name, default=None):
+        value = self._field(line, record, name, default)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise LedgerImportError(f'Invalid {name} {value}', line)
+
+    def _time(self, line, record):
+        value = record.get('created_at')
+        if value is None:
+            return timezone.now()
+        parsed = parse_datetime(value) if isinstance(value, str) else None
+        if parsed is None:
+            raise LedgerImportError(f'Invalid created_at {value}', line)
+        if settings.USE_TZ and timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
+
+    def _keys(self, line, record, names):
+        values = [record.get(name) for name in names]
+        if any(values) and not all(values):
+            raise LedgerImportError(f'Give both or none of {" and ".join(names)}', line)
+        return values
+
+    def _user_id(self, line, username):
+        if username not in self.users:
+            self.users[username] = User.objects.filter(username=username).values_list('id', flat=True).first()
+        if self.users[username] is None:
+            del self.users[username]
+            raise LedgerImportError(f'Unknown user {username}', line)
+        return self.users[username]
+
+    def _wallet(self, line, username, symbol):
+        wallet = self.wallets.get((username, symbol))
+        if wallet is None:
+            raise LedgerImportError(f'Unknown {symbol} wallet of {username}', line)
+        return wallet
+
+    def _parse_user(self, line, record):
+        username = str(self._field(line, record, 'username'))
+        if username in self.users:
+            raise LedgerImportError(f'Duplicate user {username}', line)
+        # imported users keep their password hash, users without one can not log in until they reset it
+        user = User(username=username, email=record.get('email', ''),
+                    password=record.get('password') or make_password(None))
+        self.users[username] = None
+        return line, user
+
+    def _parse_currency(self, line, record):
+        symbol = str(self._field(line, record, 'symbol'))
+        if symbol in self.currencies or Currency.objects.filter(symbol=symbol).exists():
+            raise LedgerImportError(f'Duplicate currency {symbol}', line)
+        admin = str(self._field(line, record, 'admin'))
+        currency = Currency(
+            name=record.get('name', symbol), symbol=symbol, admin_id=self._user_id(line, admin),
+            market_cap=self._int(line, record, 'market_cap', -1),
+            initial_balance=self._int(line, record, 'initial_balance', 0))
+        if currency.market_cap != -1:
+            currency.initial_balance = 0
+        self.currencies[symbol] = (None, admin)
+        return currency
+
+    def _parse_wallet(self, line, record):
+        username = str(self._field(line, record, 'user'))
+        symbol = str(self._field(line, record, 'currency'))
+        if symbol not in self.currencies:
+            raise LedgerImportError(f'Currency {symbol} is not part of this import', line)
+        if (username, symbol) in self.wallets:
+            raise LedgerImportError(f'Duplicate {symbol} wallet of {username}', line)
+        balance = self._int(line, record, 'balance', 0)
+        if balance < 0:
+            raise LedgerImportError(f'Invalid balance {balance}', line)
+        publickey, privatekey = self._keys(line, record, ('publickey', 'privatekey'))
+        state = _WalletState(self._user_id(line, username), self.currencies[symbol][0], balance)
+        wallet = Wallet(user_id=state.user_id, currency_id=state.currency_id, balance=balance,
+                        opening_balance=balance, publickey=publickey, privatekey=privatekey,
+                        created_at=self._time(line, record))
+        self.wallets[username, symbol] = state
+        return wallet, state
+
+    def _parse_transaction(self, line, record):
+        symbol = str(self._field(line, record, 'currency'))
+        sender_name = str(self._field(line, record, 'sender'))
+        receiver_name = str(self._field(line, record, 'receiver'))
+        sender = self._wallet(line, sender_name, symbol)
+        receiver = self._wallet(line, receiver_name, symbol)
+        if sender is receiver:
+            raise LedgerImportError('Sender and receiver cannot be the same', line)
+        amount = self._int(line, record, 'amount')
+        if amount <= 0 or amount > sender.balance:
+            raise LedgerImportError(f'Insufficient funds, {sender_name} has {sender.balance} {symbol}', line)
+        sender_signature, receiver_signature = self._keys(
+            line, record, ('sender_signature', 'receiver_signature'))
+        transaction = Transaction(
+            sender_id=sender.id, receiver_id=receiver.id, amount=amount, currency_id=sender.currency_id,
+            created_at=self._time(line, record),
+            sender_signature=sender_signature, receiver_signature=receiver_signature,
+            before_sender_amount_snapshot=sender.balance,
+            before_receiver_amount_snapshot=receiver.balance,
+            after_sender_amount_snapshot=sender.balance - amount,
+            after_receiver_amount_snapshot=receiver.balance + amount)
+        sender.balance -= amount
+        sender.sent += amount
+        receiver.balance += amount
+        receiver.received += amount
+        # the message of Transaction.message_for()
+        return transaction, f'{sender_name} sent {amount} to {receiver_name}'
+
+    # writing batches
+
+    def _write_user(self, batch):
+        usernames = [user.username for _, user in batch]
+        taken = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+        for line, user in batch:
+            if user.username in taken:
+                for _, pending in batch:
+                    del self.users[pending.username]
+                raise LedgerImportError(f'User {user.username} already exists', line)
+        User.objects.bulk_create([user for _, user in batch])
+        # SQLite does not return the ids of bulk inserted rows
+        self.users.update(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+
+    def _write_currency(self, batch):
+        Currency.objects.bulk_create(batch)
+        ids = dict(Currency.objects.filter(symbol__in=[currency.symbol for currency in batch])
+                   .values_list('symbol', 'id'))
+        for currency in batch:
+            currency.pk = ids[currency.symbol]
+            currency.generateInvite(commit=False)
+            shards.place(currency)
+            self.currencies[currency.symbol] = (currency.pk, self.currencies[currency.symbol][1])
+        Currency.objects.bulk_update(batch, ['invite_code'])
+
+    def _write_wallet(self, batch):
+        missing = [wallet for wallet, _ in batch if not wallet.publickey]
+        for wallet, keypair in zip(missing, self._map(keypool.generate_keypair, range(len(missing)))):
+            wallet.publickey, wallet.privatekey = keypair
+
+        by_shard = defaultdict(list)
+        for wallet, state in batch:
+            state.shard = shards.for_currency(state.currency_id, write=True)
+            by_shard[state.shard].append((wallet, state))
+        for shard, rows in by_shard.items():
+            wallets = [wallet for wallet, _ in rows]
+            shards.assign_ids(wallets)
+            Wallet.objects.using(shard).bulk_create(wallets)
+            if wallets[0].pk is None:
+                # SQLite does not return the ids of bulk inserted rows
+                ids = {
+                    (user_id, currency_id): pk for pk, user_id, currency_id in Wallet.objects.using(shard).filter(
+                        currency_id__in={wallet.currency_id for wallet in wallets},
+                        user_id__in={wallet.user_id for wallet in wallets}).values_list('id', 'user_id', 'currency_id')
+                }
+                for wallet in wallets:
+                    wallet.pk = ids[wallet.user_id, wallet.currency_id]
+            for wallet, state in rows:
+                state.id = wallet.pk
+                self._states[state.id] = state
+
+        supply, holders = defaultdict(int), defaultdict(int)
+        for wallet, state in batch:
+            supply[state.currency_id] += wallet.balance
+            holders[state.currency_id] += 1
+        for currency_id in supply:
+            Currency.objects.filter(pk=currency_id).update(
+                circulating_supply=F('circulating_supply') + supply[currency_id],
+                holder_count=F('holder_count') + holders[currency_id])
+
+    def _write_transaction(self, batch):
+        self._sign([(transaction, message) for transaction, message in batch
+                    if not transaction.sender_signature])
+        by_shard = defaultdict(list)
+        for transaction, _ in batch:
+            by_shard[shards.for_currency(transaction.currency_id, write=True)].append(transaction)
+        # the batch is the last history parsed, the states hold the balances it leaves
+        states = self._states
+        now = timezone.now()
+        for shard, transactions in by_shard.items():
+            wallet_ids = {wallet_id for transaction in transactions
+                          for wallet_id in (transaction.sender_id, transaction.receiver_id)}
+            wallets = [
+                Wallet(id=wallet_id, balance=states[wallet_id].balance, total_received=states[wallet_id].received,
+                       total_sent=states[wallet_id].sent, updated_at=now)
+                for wallet_id in wallet_ids
+            ]
+            shards.assign_ids(transactions)
+            with db_transaction.atomic(using=shard):
+                Transaction.objects.using(shard).bulk_create(transactions)
+                Wallet.objects.using(shard).bulk_update(
+                    wallets, ['balance', 'total_received', 'total_sent', 'updated_at'], batch_size=self.batch_size)
+
+    def _sign(self, items):
+        if not items:
+            return
+        wallet_ids = defaultdict(set)
+        for transaction, _ in items:
+            shard = shards.for_currency(transaction.currency_id)
+            wallet_ids[shard].update((transaction.sender_id, transaction.receiver_id))
+        keys = {}
+        for shard, ids in wallet_ids.items():
+            keys.update(Wallet.objects.using(shard).filter(id__in=ids).values_list('id', 'privatekey'))
+
+        # a chunk carries only the keys it signs with
+        size = math.ceil(len(items) / max(1, self.workers * 4))
+        chunks = []
+        for start in range(0, len(items), size):
+            chunk = [(transaction.sender_id, transaction.receiver_id, message)
+                     for transaction, message in items[start:start + size]]
+            chunks.append(({wallet_id: keys[wallet_id] for item in chunk for wallet_id in item[:2]}, chunk))
+        signatures = (pair for result in self._map(sign_chunk, chunks) for pair in result)
+        for (transaction, _), (sender_signature, receiver_signature) in zip(items, signatures):
+            transaction.sender_signature = sender_signature
+            transaction.receiver_signature = receiver_signature
+
+    # finishing
+
+    def add_admin_wallets(self):
+        """Give the imported currencies whose admin had no wallet record an empty admin wallet."""
+        for symbol, (_, admin) in self.currencies.items():
+            if (admin, symbol) not in self.wallets:
+                self.add(None, {'type': 'wallet', 'user': admin, 'currency': symbol})
+        self.flush()
@@ -0,0 +1,91 @@
+"""
+LRU cache of parsed wallet keys.
+
+Parsing PEM text with ``RSA.import_key`` costs more than the signature it
+is used for, so the parsed ``PKCS115_SigScheme`` objects are kept per
+wallet. Entries carry a fingerprint of the PEM they were built from: when a
+wallet's key changes the fingerprint no longer matches and the entry is
+rebuilt, so nothing has to invalidate the cache by hand.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from Crypto.PublicKey import RSA
+from Crypto.Signature.pkcs1_15 import PKCS115_SigScheme
+from django.conf import settings
+
+DEFAULT_SIZE = 1024
+
+
+def fingerprint(pem):
+    return hashlib.sha256(pem.encode('ascii')).hexdigest()
+
+
+class KeyCache:
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, pem):
+        """Return the scheme for ``pem`` cached under ``key``, parsing it on a miss."""
+        digest = fingerprint(pem)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == digest:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        scheme = PKCS115_SigScheme(RSA.import_key(pem))
+        with self._lock:
+            self._entries[key] = (digest, scheme)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return scheme
+
+    def invalidate(self, wallet_id):
+        with self._lock:
+            for kind in ('private', 'public'):
+                self._entries.pop((wallet_id, kind), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'capacity': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+cache = KeyCache(getattr(settings, 'KEY_CACHE', {}).get('SIZE', DEFAULT_SIZE))
+
+
+def signer(wallet):
+    """Signature scheme built from the wallet's private key."""
+    if wallet.pk is None:
+        return PKCS115_SigScheme(RSA.import_key(wallet.privatekey))
+    return cache.get((wallet.pk, 'private'), wallet.privatekey)
+
+
+def verifier(wallet):
+    """Signature scheme built from the wallet's public key."""
+    if wallet.pk is None:
+        return PKCS115_SigScheme(RSA.import_key(wallet.publickey))
+    return cache.get((wallet.pk, 'public'), wallet.publickey)
+
+
+def stats():
+    return cache.stats()
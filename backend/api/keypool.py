@@ -0,0 +1,164 @@
+"""
+Pool of pre-generated RSA key pairs.
+
+Generating a 2048 bit key pair takes hundreds of milliseconds, so wallets
+take a ready key pair from the pool and only fall back to generating one
+inline when the pool is empty. The pool lives in the database so the
+producer (``python manage.py keypool --watch``) can run as its own process
+and fill it for every web worker.
+"""
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from Crypto.PublicKey import RSA
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+KEY_SIZE = 2048
+
+DEFAULTS = {
+    # Number of key pairs the producer keeps ready.
+    'SIZE': 64,
+    # The producer tops the pool up once it drops below this depth.
+    'LOW_WATER': 16,
+    # Worker processes used to generate keys, 0 generates in-process.
+    'WORKERS': 2,
+    # Seconds between two depth checks of the producer.
+    'INTERVAL': 5,
+    # Window in seconds used to compute the refill rate.
+    'RATE_WINDOW': 60,
+}
+
+_counters = {'hits': 0, 'misses': 0}
+_counters_lock = threading.Lock()
+
+
+def pool_settings():
+    return {**DEFAULTS, **getattr(settings, 'KEY_POOL', {})}
+
+
+def generate_keypair(_=None):
+    """Return a new (publickey, privatekey) pair as PEM text."""
+    keyPair = RSA.generate(KEY_SIZE)
+    return (keyPair.publickey().export_key().decode('ascii'),
+            keyPair.export_key().decode('ascii'))
+
+
+def _count(name):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def take():
+    """
+    Claim a key pair from the pool.
+
+    Returns a (publickey, privatekey) tuple or None when the pool is empty.
+    A row is only handed out by the caller whose delete removed it, so two
+    workers never get the same key.
+    """
+    from .models import PooledKey
+
+    while True:
+        key = PooledKey.objects.order_by('id').first()
+        if key is None:
+            _count('misses')
+            return None
+        if PooledKey.objects.filter(id=key.id).delete()[0]:
+            _count('hits')
+            return key.publickey, key.privatekey
+
+
+def refill(count, workers=None):
+    """Generate ``count`` key pairs and add them to the pool."""
+    from .models import KeyRefill, PooledKey
+
+    if count <= 0:
+        return 0
+    if workers is None:
+        workers = pool_settings()['WORKERS']
+
+    if workers:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pairs = list(executor.map(generate_keypair, range(count)))
+    else:
+        pairs = [generate_keypair() for _ in range(count)]
+
+    # the refill is recorded in the database, the producer usually runs in
+    # its own process and the web workers report the rate
+    since = timezone.now() - timedelta(seconds=pool_settings()['RATE_WINDOW'])
+    with transaction.atomic():
+        PooledKey.objects.bulk_create([
+            PooledKey(publickey=publickey, privatekey=privatekey)
+            for publickey, privatekey in pairs
+        ])
+        KeyRefill.objects.create(keys=len(pairs))
+        KeyRefill.objects.filter(created_at__lt=since).delete()
+    return len(pairs)
+
+
+def top_up():
+    """Fill the pool back to its size if it dropped below the low water mark."""
+    from .models import PooledKey
+
+    config = pool_settings()
+    depth = PooledKey.objects.count()
+    if depth >= config['LOW_WATER']:
+        return 0
+    added = refill(config['SIZE'] - depth)
+    logger.info("Key pool refilled with %d keys", added)
+    return added
+
+
+def stats():
+    """Pool depth, refill rate (keys per second) and this process' hit counters."""
+    from .models import KeyRefill, PooledKey
+
+    config = pool_settings()
+    since = timezone.now() - timedelta(seconds=config['RATE_WINDOW'])
+    generated = KeyRefill.objects.filter(created_at__gte=since).aggregate(keys=Sum('keys'))['keys'] or 0
+    with _counters_lock:
+        counters = dict(_counters)
+    return {
+        'depth': PooledKey.objects.count(),
+        'size': config['SIZE'],
+        'refill_rate': generated / config['RATE_WINDOW'],
+        # keys generated within RATE_WINDOW, by every process
+        'generated': generated,
+        'hits': counters['hits'],
+        'misses': counters['misses'],
+    }
+
+
+class Producer:
+    """Background thread that keeps the pool topped up."""
+
+    def __init__(self, interval=None):
+        self.interval = interval if interval is not None else pool_settings()['INTERVAL']
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                top_up()
+            except Exception as err:
+                logger.warning("Key pool refill failed: %s", err)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.run, name='keypool-producer', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,187 @@
+"""
+Top holders of each currency.
+
+A board keeps the ``SIZE`` biggest wallets of a currency in memory, read
+once through the (currency, -balance, id) index of the wallets. Transfers
+and wallet saves update the boards of their process when they commit, so
+reading the top holders or the rank of a wallet on the board costs no
+query.
+
+The wallets off a board held at most its ``bound``, the balance of the
+last wallet when it was read, and a wallet that passes it joins the board.
+A board only answers with the wallets above the bound. When a holder drops
+to the bound or below, it leaves the board, and a board that gets shorter
+than a request is read again. Other processes move balances too, so a
+board is also read again after ``TTL`` seconds.
+"""
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+
+from . import shards
+from .models import Wallet
+
+DEFAULTS = {
+    # wallets kept per currency, bigger requests read the index
+    'SIZE': 100,
+    # seconds a board trusts the balances it was not told about
+    'TTL': 30,
+    'DEFAULT_LIMIT': 10,
+}
+
+Holder = namedtuple('Holder', ('rank', 'wallet_id', 'balance'))
+
+
+def leaderboard_settings():
+    return {**DEFAULTS, **getattr(settings, 'LEADERBOARD', {})}
+
+
+def holders(currency_id):
+    """The wallets of the currency, biggest balance first."""
+    return shards.by_currency(Wallet.objects.all(), currency_id).order_by('-balance', 'id')
+
+
+def ranked_above(wallet):
+    """The wallets of the currency ranked before ``wallet``, as two index range queries."""
+    wallets = shards.by_currency(Wallet.objects.all(), wallet.currency_id)
+    return (wallets.filter(balance__gt=wallet.balance),
+            wallets.filter(balance=wallet.balance, id__lt=wallet.pk))
+
+
+class _Board:
+    __slots__ = ('entries', 'bound', 'loaded_at')
+
+    def __init__(self, entries, bound):
+        # [balance, wallet id] pairs, biggest balance first
+        self.entries = entries
+        # the biggest balance a wallet off the board may have, None when every wallet is on it
+        self.bound = bound
+        self.loaded_at = time.monotonic()
+
+
+class Leaderboards:
+    def __init__(self):
+        self._boards = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _fresh(self, currency_id):
+        board = self._boards.get(currency_id)
+        if board is not None and time.monotonic() - board.loaded_at < leaderboard_settings()['TTL']:
+            return board
+        return None
+
+    def entries(self, currency_id, limit):
+        """Return up to ``limit`` (balance, wallet id) pairs of the biggest holders."""
+        size = leaderboard_settings()['SIZE']
+        if limit > size:
+            return list(holders(currency_id).values_list('balance', 'id')[:limit])
+        with self._lock:
+            board = self._fresh(currency_id)
+            if board is not None and (len(board.entries) >= limit or board.bound is None):
+                self.hits += 1
+                return [tuple(entry) for entry in board.entries[:limit]]
+            self.misses += 1
+
+        rows = list(holders(currency_id).values_list('balance', 'id')[:size])
+        bound = rows[-1][0] if len(rows) == size else None
+        with self._lock:
+            self._boards[currency_id] = _Board([list(row) for row in rows], bound)
+        return rows[:limit]
+
+    def position(self, currency_id, wallet_id):
+        """Return the 1-based rank of the wallet when it is on a fresh board, else None."""
+        with self._lock:
+            board = self._fresh(currency_id)
+            if board is None:
+                return None
+            for position, (balance, entry_id) in enumerate(board.entries, 1):
+                if entry_id == wallet_id:
+                    return position, balance
+        return None
+
+    def update(self, currency_id, balances):
+        """Apply the new ``balances``, (wallet id, balance) pairs, to the board of the currency."""
+        size = leaderboard_settings()['SIZE']
+        with self._lock:
+            board = self._boards.get(currency_id)
+            if board is None:
+                return
+            on_board = {entry[1]: entry for entry in board.entries}
+            for wallet_id, balance in balances:
+                if wallet_id in on_board:
+                    on_board[wallet_id][0] = balance
+                elif board.bound is None or balance > board.bound:
+                    board.entries.append([balance, wallet_id])
+            board.entries.sort(key=lambda entry: (-entry[0], entry[1]))
+            if len(board.entries) > size:
+                evicted = board.entries[size][0]
+                board.bound = evicted if board.bound is None else max(board.bound, evicted)
+                del board.entries[size:]
+            if board.bound is not None:
+                board.entries = [entry for entry in board.entries if entry[0] > board.bound]
+
+    def remove(self, currency_id, wallet_id):
+        with self._lock:
+            board = self._boards.get(currency_id)
+            if board is not None:
+                board.entries = [entry for entry in board.entries if entry[1] != wallet_id]
+
+    def forget(self, currency_id=None):
+        with self._lock:
+            if currency_id is None:
+                self._boards.clear()
+            else:
+                self._boards.pop(currency_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'boards': len(self._boards),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+boards = Leaderboards()
+
+
+def top(currency_id, limit=None):
+    """Return the Holders of the ``limit`` biggest wallets of the currency."""
+    config = leaderboard_settings()
+    limit = config['DEFAULT_LIMIT'] if limit is None else limit
+    if limit <= 0:
+        return []
+    return [Holder(rank, wallet_id, balance)
+            for rank, (balance, wallet_id) in enumerate(boards.entries(int(currency_id), limit), 1)]
+
+
+def rank(wallet):
+    """Return the Holder of ``wallet``, counting the wallets above it when it is not on the board."""
+    found = boards.position(wallet.currency_id, wallet.pk)
+    if found is not None:
+        return Holder(found[0], wallet.pk, found[1])
+    bigger, tied = ranked_above(wallet)
+    return Holder(bigger.count() + tied.count() + 1, wallet.pk, wallet.balance)
+
+
+def record(transactions, using=None):
+    """Move the wallets of ``transactions`` on the boards once the current transaction of ``using`` commits."""
+    balances = defaultdict(dict)
+    for transaction in transactions:
+        balances[transaction.currency_id][transaction.sender_id] = transaction.after_sender_amount_snapshot
+        balances[transaction.currency_id][transaction.receiver_id] = transaction.after_receiver_amount_snapshot
+
+    def apply():
+        for currency_id, wallets in balances.items():
+            boards.update(currency_id, wallets.items())
+
+    db_transaction.on_commit(apply, using=using)
+
+
+def stats():
+    return boards.stats()
@@ -0,0 +1,99 @@
+"""
+Per-request DataLoaders for the GraphQL schema.
+
+Every relation of the schema types resolves through these loaders, so the
+rows of one level of a nested query are fetched with a single ``IN (...)``
+query per ledger shard instead of one query per parent row. A fresh set of loaders is kept
+on each request, which also keeps their caches from leaking across users.
+"""
+from collections import defaultdict
+from itertools import chain
+
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from . import shards
+from .models import Currency, Transaction, User, Wallet
+
+
+class ModelLoader(DataLoader):
+    """Loads rows of ``model`` by primary key."""
+    model = None
+
+    def batch_load_fn(self, keys):
+        rows = shards.in_bulk(self.model.objects.all(), keys)
+        return Promise.resolve([rows.get(key) for key in keys])
+
+
+class RelatedLoader(DataLoader):
+    """Loads the rows of ``model`` whose ``field`` points to each key."""
+    model = None
+    field = None
+    # the keys are currency ids, their rows are read from the shard of each currency
+    by_currency = False
+
+    def __init__(self, primes=None, **kwargs):
+        super().__init__(**kwargs)
+        self.primes = primes
+
+    def get_queryset(self):
+        return self.model.objects.all()
+
+    def get_querysets(self, keys):
+        if not self.by_currency or not shards.is_sharded():
+            return [self.get_queryset().filter(**{f'{self.field}__in': keys})]
+        by_shard = defaultdict(list)
+        for key in keys:
+            by_shard[shards.for_currency(key)].append(key)
+        return [self.get_queryset().using(using).filter(**{f'{self.field}__in': group})
+                for using, group in by_shard.items()]
+
+    def batch_load_fn(self, keys):
+        groups = defaultdict(list)
+        for row in chain.from_iterable(self.get_querysets(keys)):
+            groups[getattr(row, f'{self.field}_id')].append(row)
+            if self.primes is not None:
+                self.primes.prime(row.pk, row)
+        return Promise.resolve([groups.get(key, []) for key in keys])
+
+
+class UserLoader(ModelLoader):
+    model = User
+
+
+class WalletLoader(ModelLoader):
+    model = Wallet
+
+
+class CurrencyLoader(ModelLoader):
+    model = Currency
+
+
+class WalletsByCurrencyLoader(RelatedLoader):
+    model = Wallet
+    field = 'currency'
+    by_currency = True
+
+
+class TransactionsByCurrencyLoader(RelatedLoader):
+    model = Transaction
+    field = 'currency'
+    by_currency = True
+
+
+class Loaders:
+    def __init__(self):
+        self.users = UserLoader()
+        self.wallets = WalletLoader()
+        self.currencies = CurrencyLoader()
+        self.wallets_by_currency = WalletsByCurrencyLoader(primes=self.wallets)
+        self.transactions_by_currency = TransactionsByCurrencyLoader()
+
+
+def get_loaders(context):
+    """Return the loaders of the request, creating them on first use."""
+    loaders = getattr(context, 'loaders', None)
+    if loaders is None:
+        loaders = Loaders()
+        context.loaders = loaders
+    return loaders
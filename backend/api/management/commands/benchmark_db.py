@@ -0,0 +1,84 @@
+import random
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections
+
+from api import transfers
+from api.models import Currency, Transaction, User, Wallet
+
+
+class Command(BaseCommand):
+    help = 'Measure transfer and read throughput of the configured database under concurrency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=float, default=10,
+                            help='Seconds to run')
+        parser.add_argument('--writers', type=int, default=4,
+                            help='Threads making transfers')
+        parser.add_argument('--readers', type=int, default=8,
+                            help='Threads reading wallets and transactions')
+        parser.add_argument('--wallets', type=int, default=10,
+                            help='Wallets the transfers move money between')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'engine={connection.settings_dict["ENGINE"]} name={connection.settings_dict["NAME"]}')
+        prefix = f'bench{int(time.time())}'
+        admin = User.objects.create_user(username=f'{prefix}admin', email='', password=None)
+        currency = Currency.objects.create(
+            name=prefix, symbol=prefix[-10:], admin=admin, initial_balance=10 ** 6)
+        wallets = [
+            Wallet.objects.create(
+                user=User.objects.create_user(username=f'{prefix}user{index}', email='', password=None),
+                currency=currency, balance=10 ** 6)
+            for index in range(options['wallets'])
+        ]
+        wallet_ids = [wallet.id for wallet in wallets]
+        user_ids = [wallet.user_id for wallet in wallets]
+
+        counts = {'transfers': 0, 'reads': 0}
+        errors = {'transfers': 0, 'reads': 0}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + options['duration']
+
+        def transfer():
+            sender, receiver = random.sample(wallet_ids, 2)
+            transfers.transfer(sender, receiver, 1, currency.id)
+
+        def read():
+            user_id = random.choice(user_ids)
+            list(Wallet.objects.filter(user_id=user_id))
+            list(Transaction.objects.filter(receiver_id=random.choice(wallet_ids))
+                 .order_by('-created_at')[:20])
+
+        def worker(kind, operation):
+            try:
+                while time.perf_counter() < deadline:
+                    try:
+                        operation()
+                        failed = False
+                    except OperationalError:
+                        failed = True
+                    with lock:
+                        counts[kind] += not failed
+                        errors[kind] += failed
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker, args=('transfers', transfer))
+                   for _ in range(options['writers'])]
+        threads += [threading.Thread(target=worker, args=('reads', read))
+                    for _ in range(options['readers'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for kind in counts:
+            self.stdout.write(
+                f'{kind}: {counts[kind]} ok, {errors[kind]} locked, '
+                f'{counts[kind] / options["duration"]:.1f}/s')
+
+        Transaction.objects.filter(currency=currency).delete()
+        User.objects.filter(username__startswith=prefix).delete()
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import rollups
+from api.models import Currency
+
+
+class Command(BaseCommand):
+    help = 'Roll up the transfer volume of every currency, or of one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--currency', default=None,
+                            help='Currency id or symbol, by default every currency')
+        parser.add_argument('--every', type=float, default=None,
+                            help='Keep running, rolling up every this many seconds')
+
+    def handle(self, *args, **options):
+        currency_id = None
+        if options['currency'] is not None:
+            lookup = {'pk': options['currency']} if options['currency'].isdigit() else {'symbol': options['currency']}
+            currency_id = Currency.objects.filter(**lookup).values_list('id', flat=True).first()
+            if currency_id is None:
+                raise CommandError(f'Currency {options["currency"]} not found')
+
+        while True:
+            if currency_id is None:
+                days = rollups.build_all()
+            else:
+                days = rollups.build(currency_id)
+            self.stdout.write(f'Rolled up {days} days')
+            if options['every'] is None:
+                return
+            try:
+                time.sleep(options['every'])
+            except KeyboardInterrupt:
+                return
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api import blacklist
+
+
+class Command(BaseCommand):
+    help = 'Delete expired outstanding and blacklisted tokens in small chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help='Tokens deleted per transaction')
+        parser.add_argument('--every', type=float, default=None,
+                            help='Keep running, compacting every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            deleted = blacklist.compact(chunk_size=options['chunk_size'])
+            self.stdout.write(f'Deleted {deleted} expired tokens')
+            if options['every'] is None:
+                return
+            try:
+                time.sleep(options['every'])
+            except KeyboardInterrupt:
+                return
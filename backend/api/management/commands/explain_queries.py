@@ -0,0 +1,95 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+
+from api.models import Currency, Transaction, User, Wallet
+
+
+def resolver_queries():
+    """
+    The query each resolver of schema.Query runs, with sample arguments.
+
+    The flag marks resolvers that scan the table by design, such as the
+    unfiltered lists and the substring search.
+    """
+    now = timezone.now()
+    return [
+        ('allUsers', User.objects.all(), True),
+        ('userById', User.objects.filter(pk=1), False),
+        ('userByUsername', User.objects.filter(username='user'), False),
+        ('allWallets', Wallet.objects.all(), True),
+        ('walletById', Wallet.objects.filter(pk=1), False),
+        ('walletsByUser', Wallet.objects.filter(user=1), False),
+        ('walletsByCurrency', Wallet.objects.filter(currency=1), False),
+        ('allTransactions', Transaction.objects.all(), True),
+        ('transactionById', Transaction.objects.filter(pk=1), False),
+        ('transactionsBySender', Transaction.objects.filter(sender=1), False),
+        ('transactionsByReciever', Transaction.objects.filter(receiver=1), False),
+        ('transactionsByTimePeriod', Transaction.objects.filter(
+            created_at__range=[now - timedelta(days=1), now]), False),
+        ('transactionsByCurrency', Transaction.objects.filter(currency=1), False),
+        ('allCurrencies', Currency.objects.all(), True),
+        ('currencyById', Currency.objects.filter(pk=1), False),
+        ('currencyBySymbol', Currency.objects.filter(symbol='BTC'), False),
+        ('searchCurrenciesByName', Currency.objects.filter(name__icontains='coin'), True),
+        ('currencyByInviteCode', Currency.objects.filter(invite_code='code'), False),
+        ('currenciesByAdmin', Currency.objects.filter(admin=1), False),
+        ('usersConnection', User.objects.order_by('date_joined', 'id')[:101], False),
+        ('walletsConnection', Wallet.objects.order_by('created_at', 'id')[:101], False),
+        ('walletsConnectionAfter', Wallet.objects.filter(
+            Q(created_at__gt=now) | Q(created_at=now, id__gt=1)).order_by('created_at', 'id')[:101], False),
+        ('transactionsConnection', Transaction.objects.order_by('created_at', 'id')[:101], False),
+        ('currenciesConnection', Currency.objects.order_by('created_at', 'id')[:101], False),
+        ('topHolders', Wallet.objects.filter(currency=1).order_by('-balance', 'id')[:100], False),
+        ('holderRank', Wallet.objects.filter(currency=1, balance__gt=100), False),
+    ]
+
+
+def is_full_scan(line, limited=False):
+    # SQLite reports "SCAN <table>", PostgreSQL "Seq Scan on <table>"
+    line = line.strip(' |-`')
+    if limited and ' USING INDEX ' in line:
+        # the page is read in the order of the index and stops at the limit
+        return False
+    for prefix in ('SCAN ', 'Seq Scan'):
+        if line.startswith(prefix) or f' {prefix}' in line:
+            return 'COVERING INDEX' not in line
+    return False
+
+
+def is_sort(line):
+    # sorting every matching row costs as much as reading them
+    line = line.strip(' |-`')
+    return 'USE TEMP B-TREE FOR ORDER BY' in line or line.startswith('Sort ')
+
+
+class Command(BaseCommand):
+    help = 'Run EXPLAIN for the query of every GraphQL resolver and flag full table scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fail', action='store_true',
+                            help='Exit with an error when an unexpected full scan is found')
+        parser.add_argument('--verbose-plans', action='store_true',
+                            help='Print the full plan of every query')
+
+    def handle(self, *args, **options):
+        unexpected = []
+        for name, queryset, scan_expected in resolver_queries():
+            plan = queryset.explain()
+            limited = queryset.query.high_mark is not None
+            scans = [line for line in plan.splitlines() if is_full_scan(line, limited) or is_sort(line)]
+            if scans and not scan_expected:
+                unexpected.append(name)
+                self.stdout.write(self.style.ERROR(f'{name}: full table scan'))
+            elif scans:
+                self.stdout.write(f'{name}: full table scan (expected)')
+            else:
+                self.stdout.write(self.style.SUCCESS(f'{name}: ok'))
+            if options['verbose_plans'] or (scans and not scan_expected):
+                for line in plan.splitlines():
+                    self.stdout.write(f'    {line}')
+
+        if unexpected and options['fail']:
+            raise CommandError(f'Unexpected full table scans: {", ".join(unexpected)}')
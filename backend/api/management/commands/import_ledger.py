@@ -0,0 +1,46 @@
+import gzip
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import imports
+
+
+class Command(BaseCommand):
+    help = 'Import users, currencies, wallets and transaction history from NDJSON or CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Input file, - reads stdin, a .gz file is decompressed')
+        parser.add_argument('--format', dest='input_format', choices=imports.FORMATS, default=None,
+                            help='Input format, by default from the file extension')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Rows written per bulk insert')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Processes generating keys and signing, 0 works in-process')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        input_format = options['input_format']
+        if input_format is None:
+            name = path[:-3] if path.endswith('.gz') else path
+            input_format = 'csv' if name.endswith('.csv') else 'ndjson'
+
+        if path == '-':
+            source = sys.stdin
+        elif path.endswith('.gz'):
+            source = gzip.open(path, 'rt', encoding='utf-8', newline='')
+        else:
+            source = open(path, encoding='utf-8', newline='')
+
+        importer = imports.Importer(
+            batch_size=options['batch_size'], workers=options['workers'], log=self.stdout.write)
+        try:
+            counts = importer.run(imports.read_records(source, input_format))
+        except imports.LedgerImportError as err:
+            raise CommandError(err.message)
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        total = sum(counts.values())
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {total} rows in {importer.elapsed():.1f}s'))
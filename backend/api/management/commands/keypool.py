@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api import keypool
+
+
+class Command(BaseCommand):
+    help = 'Fill the pre-generated RSA key pool and report its metrics'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fill', type=int, default=None,
+                            help='Generate this many keys and exit')
+        parser.add_argument('--watch', action='store_true',
+                            help='Keep the pool topped up until interrupted')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Worker processes used to generate keys')
+
+    def handle(self, *args, **options):
+        if options['fill'] is not None:
+            added = keypool.refill(options['fill'], workers=options['workers'])
+            self.stdout.write(f'Added {added} keys to the pool')
+        elif options['watch']:
+            producer = keypool.Producer().start()
+            self.stdout.write('Key pool producer started, press CTRL-C to stop')
+            try:
+                while True:
+                    time.sleep(producer.interval)
+                    self.stdout.write(self.format_stats(keypool.stats()))
+            except KeyboardInterrupt:
+                producer.stop()
+            return
+
+        self.stdout.write(self.format_stats(keypool.stats()))
+
+    def format_stats(self, stats):
+        return ' '.join(f'{name}={value}' for name, value in stats.items())
@@ -0,0 +1,107 @@
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from django.core.management.base import BaseCommand
+
+
+def post(url, data, token=None):
+    request = urllib.request.Request(url, json.dumps(data).encode('utf-8'), method='POST')
+    request.add_header('Content-Type', 'application/json')
+    if token:
+        request.add_header('Authorization', f'Bearer {token}')
+    return request
+
+
+def timed(request):
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            response.read()
+            ok = response.status < 400
+    except urllib.error.HTTPError as err:
+        ok = err.code < 500
+    except OSError:
+        ok = False
+    return time.perf_counter() - started, ok
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = 'Measure a running server under a mix of cheap and CPU heavy requests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='Base URL of the server, e.g. http://127.0.0.1:8000')
+        parser.add_argument('--duration', type=float, default=20,
+                            help='Seconds to run')
+        parser.add_argument('--cheap', type=int, default=16,
+                            help='Clients sending healthcheck requests')
+        parser.add_argument('--heavy', type=int, default=4,
+                            help='Clients sending logins and transfers')
+        parser.add_argument('--username', default='loadtest')
+        parser.add_argument('--password', default='loadtest-password')
+
+    def handle(self, *args, **options):
+        base = options['url'].rstrip('/')
+        username, password = options['username'], options['password']
+        timed(post(f'{base}/api/register', {
+            'username': username, 'email': f'{username}@example.com', 'password': password}))
+        with urllib.request.urlopen(post(f'{base}/api/login', {
+                'username': username, 'password': password})) as response:
+            token = json.loads(response.read())['access']
+        with urllib.request.urlopen(post(f'{base}/api/currency', {
+                'name': f'{username} coin', 'symbol': f'L{int(time.time()) % 10 ** 8}',
+                'initial_balance': 10 ** 9}, token)) as response:
+            currency = json.loads(response.read())['id']
+        wallets = []
+        for _ in range(2):
+            with urllib.request.urlopen(post(f'{base}/api/wallet/create', {'currency': currency}, token)) as response:
+                wallets.append(json.loads(response.read())['wallet']['id'])
+
+        def cheap():
+            return urllib.request.Request(f'{base}/api/healthcheck')
+
+        def heavy(turn):
+            if turn % 2:
+                return post(f'{base}/api/login', {'username': username, 'password': password})
+            return post(f'{base}/api/transaction/create', {
+                'sender': wallets[0], 'receiver': wallets[1], 'amount': 1, 'currency': currency}, token)
+
+        results = {'cheap': [], 'heavy': []}
+        errors = {'cheap': 0, 'heavy': 0}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + options['duration']
+
+        def client(kind):
+            turn = 0
+            while time.perf_counter() < deadline:
+                turn += 1
+                elapsed, ok = timed(cheap() if kind == 'cheap' else heavy(turn))
+                with lock:
+                    results[kind].append(elapsed)
+                    errors[kind] += not ok
+
+        threads = [threading.Thread(target=client, args=('cheap',)) for _ in range(options['cheap'])]
+        threads += [threading.Thread(target=client, args=('heavy',)) for _ in range(options['heavy'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for kind, latencies in results.items():
+            if not latencies:
+                self.stdout.write(f'{kind}: no requests completed')
+                continue
+            self.stdout.write(
+                f'{kind}: requests={len(latencies)} errors={errors[kind]} '
+                f'rps={len(latencies) / options["duration"]:.1f} '
+                f'p50={statistics.median(latencies) * 1000:.1f}ms '
+                f'p95={percentile(latencies, 0.95) * 1000:.1f}ms '
+                f'p99={percentile(latencies, 0.99) * 1000:.1f}ms')
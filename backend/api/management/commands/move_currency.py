@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api import shards
+from api.models import Currency
+
+
+class Command(BaseCommand):
+    help = 'Move the wallets and transactions of a currency to another ledger shard while it stays in use'
+
+    def add_arguments(self, parser):
+        parser.add_argument('currency', help='Currency id or symbol')
+        parser.add_argument('shard', help='Target database alias, one of LEDGER_SHARDS')
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help='Rows copied or deleted per transaction')
+        parser.add_argument('--pause', type=float, default=None,
+                            help='Seconds to wait between two chunks')
+
+    def handle(self, *args, **options):
+        lookup = {'pk': options['currency']} if options['currency'].isdigit() else {'symbol': options['currency']}
+        currency = Currency.objects.filter(**lookup).first()
+        if currency is None:
+            raise CommandError(f'Currency {options["currency"]} not found')
+        if options['shard'] not in shards.shards():
+            raise CommandError(f'{options["shard"]} is not one of {", ".join(shards.shards())}')
+
+        self.stdout.write(f'Moving {currency.name} from {shards.for_currency(currency.pk)} to {options["shard"]}')
+        copied = shards.move_currency(
+            currency.pk, options['shard'], chunk_size=options['chunk_size'],
+            pause=options['pause'], log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(f'Moved {currency.name}, {copied} rows copied'))
@@ -0,0 +1,90 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from api import shards
+from api.models import Currency, Transaction, Wallet
+
+
+class Command(BaseCommand):
+    help = 'Recompute the ledger counters from the wallets and report any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help='Overwrite drifted counters with the recomputed values')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Rows locked and checked per transaction')
+
+    def handle(self, *args, **options):
+        drifted = self.check_supply(options['fix'], options['chunk_size'])
+        for using in shards.shards():
+            drifted += self.check_wallets(options['fix'], using, options['chunk_size'])
+        if drifted:
+            self.stdout.write(self.style.WARNING(f'{drifted} counters drifted'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Ledger counters are consistent'))
+
+    def check_supply(self, fix, chunk_size):
+        """Compare every currency's supply and holder count with its wallets."""
+        drifted, after = 0, 0
+        while True:
+            # the wallets are counted while the currencies are locked, a
+            # wallet created or deleted meanwhile waits to move the counters
+            with transaction.atomic():
+                chunk = list(Currency.objects.select_for_update().filter(id__gt=after).order_by('id')
+                             .only('id', 'name', *Currency.COUNTER_FIELDS)[:chunk_size])
+                if not chunk:
+                    return drifted
+                totals = shards.counters([currency.id for currency in chunk])
+                for currency in chunk:
+                    supply, holders = totals.get(currency.id, (0, 0))
+                    if currency.circulating_supply == supply and currency.holder_count == holders:
+                        continue
+                    drifted += 1
+                    self.stdout.write(
+                        f'{currency.name} ({currency.id}): supply {currency.circulating_supply} != {supply}'
+                        f', holders {currency.holder_count} != {holders}')
+                    if fix:
+                        Currency.objects.filter(pk=currency.id).update(
+                            circulating_supply=supply, holder_count=holders)
+            after = chunk[-1].id
+
+    def check_wallets(self, fix, using, chunk_size):
+        """Compare the running totals of every wallet of a shard with its history and its balance."""
+        transactions = Transaction.objects.using(using)
+        wallets = Wallet.objects.using(using)
+        drifted, after = 0, 0
+        while True:
+            # the sums are read while the wallets are locked, so no transfer
+            # of theirs commits between the sums and the fix
+            with transaction.atomic(using=using):
+                chunk = list(wallets.select_for_update().filter(id__gt=after).order_by('id')
+                             .only('id', 'balance', *Wallet.TOTAL_FIELDS)[:chunk_size])
+                if not chunk:
+                    return drifted
+                ids = [wallet.id for wallet in chunk]
+                received = dict(transactions.filter(receiver_id__in=ids)
+                                .values_list('receiver').order_by().annotate(Sum('amount')))
+                sent = dict(transactions.filter(sender_id__in=ids)
+                            .values_list('sender').order_by().annotate(Sum('amount')))
+                for wallet in chunk:
+                    drifted += self.check_wallet(wallet, (received.get(wallet.id, 0), sent.get(wallet.id, 0)),
+                                                 fix, wallets)
+            after = chunk[-1].id
+
+    def check_wallet(self, wallet, expected, fix, wallets):
+        drifted = 0
+        if (wallet.total_received, wallet.total_sent) != expected:
+            drifted += 1
+            self.stdout.write(
+                f'Wallet {wallet.id}: received {wallet.total_received} != {expected[0]}'
+                f', sent {wallet.total_sent} != {expected[1]}')
+            if fix:
+                wallets.filter(pk=wallet.id).update(
+                    total_received=expected[0], total_sent=expected[1])
+                wallet.total_received, wallet.total_sent = expected
+        # balances changed outside of a transfer, these are reported but never fixed
+        if wallet.balance != wallet.opening_balance + wallet.total_received - wallet.total_sent:
+            drifted += 1
+            self.stdout.write(f'Wallet {wallet.id}: balance {wallet.balance} does not match its history')
+        return drifted
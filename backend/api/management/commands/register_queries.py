@@ -0,0 +1,51 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from graphql import parse, validate
+
+from api import documents
+from api.models import PersistedQuery
+from api.schema import schema
+
+
+def read_queries(path):
+    """Yield (name, query) from a .graphql file or a JSON manifest of {name: query}."""
+    text = path.read_text()
+    if path.suffix == '.json':
+        try:
+            manifest = json.loads(text)
+        except ValueError as e:
+            raise CommandError(f'{path}: {e}')
+        if isinstance(manifest, list):
+            yield from (('', query) for query in manifest)
+        else:
+            yield from manifest.items()
+    else:
+        yield path.stem, text
+
+
+class Command(BaseCommand):
+    help = 'Validate GraphQL documents and register them as persisted queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+',
+                            help='.graphql files or JSON manifests mapping names to queries')
+
+    def handle(self, *args, **options):
+        for filename in options['paths']:
+            path = Path(filename)
+            if not path.exists():
+                raise CommandError(f'{path} does not exist')
+            for name, query in read_queries(path):
+                try:
+                    errors = validate(schema, parse(query))
+                except Exception as e:
+                    errors = [e]
+                if errors:
+                    raise CommandError(f'{name or path}: {"; ".join(str(error) for error in errors)}')
+
+                digest = documents.query_hash(query)
+                _, created = PersistedQuery.objects.update_or_create(
+                    sha256=digest, defaults={'query': query, 'name': name})
+                self.stdout.write(f'{digest} {name} {"registered" if created else "updated"}')
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api import routers
+
+
+class Command(BaseCommand):
+    help = 'Copy the primary SQLite database into the SQLite read replicas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=float, default=None,
+                            help='Keep running, copying every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            synced = routers.sync_replicas()
+            self.stdout.write(
+                f'Synced {", ".join(synced) or "no replicas"} in {time.perf_counter() - started:.2f}s')
+            if options['every'] is None:
+                return
+            try:
+                time.sleep(options['every'])
+            except KeyboardInterrupt:
+                return
@@ -1,30 +1,97 @@
+import asyncio
 import logging
 
+from asgiref.sync import markcoroutinefunction
+from django.conf import settings
 from django.contrib.auth import authenticate
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages.middleware import MessageMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils.functional import SimpleLazyObject
 
 
 class JWTAuthMiddleware:
+    # supports both, so async views are not adapted back to sync under ASGI
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
         # One-time configuration and initialization.
+        if asyncio.iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
         # Code to be executed for each request before
         # the view (and later middleware) are called.
+        self.authenticate(request)
+
+        response = self.get_response(request)
+
+        # Code to be executed for each request/response after
+        # the view is called.
+
+        return response
+
+    async def __acall__(self, request):
+        self.authenticate(request)
+        return await self.get_response(request)
 
+    def authenticate(self, request):
+        # resolved on first use, views answering from the token claims
+        # (ClaimsJWTAuthentication) never load the user
+        previous = getattr(request, 'user', None)
+        request.user = SimpleLazyObject(lambda: self.get_user(request, previous))
+
+    def get_user(self, request, previous):
         logging.info("JWTAuthMiddleware called")
         # authenticate user
         try:
             user = authenticate(request)
             if user is not None and user.is_authenticated:
                 logging.info("JWTAuthMiddleware user set " + str(user))
-                request.user = user
+                return user
         except Exception as err:
             logging.info("JWTAuthMiddleware failed " + str(err))
+        # AuthenticationMiddleware does not run on the API fast path
+        return previous if previous is not None else AnonymousUser()
 
-        response = self.get_response(request)
 
-        # Code to be executed for each request/response after
-        # the view is called.
+def is_api_path(path):
+    return path.startswith(tuple(getattr(settings, 'API_PATH_PREFIXES', ())))
+
+
+class WebOnlyMixin:
+    """
+    Skips the middleware for the token authenticated API routes of
+    API_PATH_PREFIXES, which use neither sessions, messages nor CSRF cookies.
+    """
+
+    def __call__(self, request):
+        if is_api_path(request.path_info):
+            return self.get_response(request)
+        return super().__call__(request)
+
+
+class WebSessionMiddleware(WebOnlyMixin, SessionMiddleware):
+    pass
+
+
+class WebCsrfViewMiddleware(WebOnlyMixin, CsrfViewMiddleware):
+    def process_view(self, request, callback, callback_args, callback_kwargs):
+        if is_api_path(request.path_info):
+            return None
+        return super().process_view(request, callback, callback_args, callback_kwargs)
+
+
+class WebAuthenticationMiddleware(WebOnlyMixin, AuthenticationMiddleware):
+    pass
+
 
-        return response
\ No newline at end of file
+class WebMessageMiddleware(WebOnlyMixin, MessageMiddleware):
+    pass
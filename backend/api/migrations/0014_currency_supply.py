@@ -0,0 +1,34 @@
+# Generated by Django 3.2.11 on 2026-10-18 11:01
+
+from django.db import migrations, models
+
+
+def count_supply(apps, schema_editor):
+    Currency = apps.get_model('api', 'Currency')
+    Wallet = apps.get_model('api', 'Wallet')
+    totals = Wallet.objects.values('currency').annotate(
+        supply=models.Sum('balance'), holders=models.Count('id'))
+    for total in totals:
+        Currency.objects.filter(pk=total['currency']).update(
+            circulating_supply=total['supply'], holder_count=total['holders'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_pooledkey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='currency',
+            name='circulating_supply',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='currency',
+            name='holder_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_supply, migrations.RunPython.noop),
+    ]
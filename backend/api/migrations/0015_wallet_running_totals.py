@@ -0,0 +1,44 @@
+# Generated by Django 3.2.11 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+
+def count_totals(apps, schema_editor):
+    Transaction = apps.get_model('api', 'Transaction')
+    Wallet = apps.get_model('api', 'Wallet')
+    received = dict(Transaction.objects.values_list('receiver').order_by()
+                    .annotate(models.Sum('amount')))
+    sent = dict(Transaction.objects.values_list('sender').order_by()
+                .annotate(models.Sum('amount')))
+    for wallet in Wallet.objects.all():
+        wallet.total_received = received.get(wallet.id, 0)
+        wallet.total_sent = sent.get(wallet.id, 0)
+        # the balance before any history is unknown, take the one the history implies
+        wallet.opening_balance = wallet.balance - wallet.total_received + wallet.total_sent
+        wallet.save(update_fields=['total_received', 'total_sent', 'opening_balance'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_currency_supply'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wallet',
+            name='opening_balance',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='wallet',
+            name='total_received',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='wallet',
+            name='total_sent',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(count_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 3.2.11 on 2026-10-18 11:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def rename_duplicates(apps, schema_editor):
+    # the currency endpoint used to accept a symbol already in use, the
+    # oldest currency keeps it and the others get their id appended
+    Currency = apps.get_model('api', 'Currency')
+    taken = set(Currency.objects.values_list('symbol', flat=True))
+    duplicates = (Currency.objects.values('symbol').annotate(count=models.Count('id'))
+                  .filter(count__gt=1).values_list('symbol', flat=True))
+    for symbol in list(duplicates):
+        for currency in Currency.objects.filter(symbol=symbol).order_by('id')[1:]:
+            suffix = f'-{currency.id}'
+            renamed = symbol[:10 - len(suffix)] + suffix
+            while renamed in taken:
+                suffix = '-' + suffix
+                renamed = symbol[:max(10 - len(suffix), 0)] + suffix
+            taken.add(renamed)
+            Currency.objects.filter(pk=currency.pk).update(symbol=renamed)
+    # invite codes are regenerated on the next save
+    codes = (Currency.objects.exclude(invite_code=None).values('invite_code')
+             .annotate(count=models.Count('id')).filter(count__gt=1).values_list('invite_code', flat=True))
+    for code in list(codes):
+        keep = Currency.objects.filter(invite_code=code).order_by('id').values_list('id', flat=True)[0]
+        Currency.objects.filter(invite_code=code).exclude(pk=keep).update(invite_code=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_wallet_running_totals'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='currency',
+            name='invite_code',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='currency',
+            name='symbol',
+            field=models.CharField(max_length=10, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='currency',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='transactions', to='api.currency'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='receiver',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='received', to='api.wallet'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='sender',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sent', to='api.wallet'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['currency', 'created_at'], name='transaction_currency_time'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['sender', 'created_at'], name='transaction_sender_time'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['receiver', 'created_at'], name='transaction_receiver_time'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['created_at'], name='transaction_time'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 3.2.11 on 2026-10-18 12:12
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_user_token_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CurrencyPlacement',
+            fields=[
+                ('currency', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='placement', serialize=False, to='api.currency')),
+                ('shard', models.CharField(max_length=100)),
+                ('moving', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LedgerSequence',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('next', models.BigIntegerField()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='currency',
+            field=models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='transactions', to='api.currency'),
+        ),
+        migrations.AlterField(
+            model_name='wallet',
+            name='currency',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='wallets', to='api.currency'),
+        ),
+        migrations.AlterField(
+            model_name='wallet',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='wallets', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.11 on 2026-10-18 12:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_balance_checkpoints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupMark',
+            fields=[
+                ('currency', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='rollup_mark', serialize=False, to='api.currency')),
+                ('through', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='VolumeRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('minute', 'Minute'), ('hour', 'Hour'), ('day', 'Day')], max_length=10)),
+                ('bucket', models.DateTimeField()),
+                ('volume', models.BigIntegerField(default=0)),
+                ('transactions', models.IntegerField(default=0)),
+                ('active_wallets', models.IntegerField(default=0)),
+                ('currency', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='api.currency')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='volumerollup',
+            constraint=models.UniqueConstraint(fields=('currency', 'granularity', 'bucket'), name='rollup_currency_bucket'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.11 on 2026-10-18 12:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0021_volume_rollups'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='wallet',
+            name='currency',
+            field=models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='wallets', to='api.currency'),
+        ),
+        migrations.AddIndex(
+            model_name='wallet',
+            index=models.Index(fields=['currency', '-balance', 'id'], name='wallet_currency_balance'),
+        ),
+    ]
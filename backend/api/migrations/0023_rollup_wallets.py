@@ -0,0 +1,36 @@
+# Generated by Django 3.2.11 on 2026-10-18 13:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def rewind_marks(apps, schema_editor):
+    # the wallets of a day rolled up in part are unknown, its next run starts it over
+    RollupMark = apps.get_model('api', 'RollupMark')
+    for mark in RollupMark.objects.all():
+        mark.through = mark.through.replace(hour=0, minute=0, second=0, microsecond=0)
+        mark.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_wallet_currency_balance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWallet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateTimeField()),
+                ('wallet_id', models.BigIntegerField()),
+                ('currency', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api.currency')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='rollupwallet',
+            constraint=models.UniqueConstraint(fields=('currency', 'day', 'wallet_id'), name='rollup_wallet_day'),
+        ),
+        migrations.RunPython(rewind_marks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.11 on 2026-10-18 13:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0023_rollup_wallets'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='currency',
+            index=models.Index(fields=['created_at', 'id'], name='currency_created'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['date_joined', 'id'], name='user_joined'),
+        ),
+        migrations.AddIndex(
+            model_name='wallet',
+            index=models.Index(fields=['created_at', 'id'], name='wallet_created'),
+        ),
+    ]
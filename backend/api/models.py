@@ -1,15 +1,17 @@
 # Modules import
 # import rsa
-from Crypto.PublicKey import RSA
-from Crypto.Signature.pkcs1_15 import PKCS115_SigScheme
 from Crypto.Hash import SHA256
 import binascii
 
 
 # Django import
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models import F
 from django.contrib.auth.models import AbstractUser
 from django.core.signing import Signer
+from django.utils import timezone
+
+from . import keycache, keypool, shards
 # Create your models here.
 
 
@@ -21,12 +23,47 @@ class User(AbstractUser):
     pfp = models.ImageField(
         upload_to=pfp_path, blank=True, null=True, default=None)
 
+    # bumped when a field copied into the token claims changes, tokens
+    # carrying an older version are stale, see api/tokens.py
+    token_version = models.PositiveIntegerField(default=0)
+
     USERNAME_FIELD = 'username'
     REQUIRED_FIELDS = ['email', 'password']
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # the order of usersConnection pages, see api/pagination.py
+            models.Index(fields=['date_joined', 'id'], name='user_joined'),
+        ]
+
+    CLAIM_FIELDS = ('username', 'email', 'is_staff', 'is_active')
+
     def __str__(self):
         return self.username
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_claims = instance.claim_values()
+        return instance
+
+    def claim_values(self):
+        return tuple(getattr(self, field) for field in self.CLAIM_FIELDS)
+
+    def save(self, *args, **kwargs):
+        loaded = getattr(self, '_loaded_claims', None)
+        changed = loaded is not None and loaded != self.claim_values()
+        update_fields = kwargs.get('update_fields')
+        if changed and update_fields is not None:
+            kwargs['update_fields'] = list(update_fields) + ['token_version']
+        if changed:
+            self.token_version += 1
+        super().save(*args, **kwargs)
+        self._loaded_claims = self.claim_values()
+        if changed:
+            from . import tokens
+            tokens.publish_version(self)
+
     def create_user(self, username, email, password):
         self.username = username
         self.email = email
@@ -46,8 +83,8 @@ class User(AbstractUser):
 
 class Currency(models.Model):
     name = models.CharField(max_length=100)
-    symbol = models.CharField(max_length=10)
-    invite_code = models.CharField(max_length=100, blank=True, null=True)
+    symbol = models.CharField(max_length=10, unique=True)
+    invite_code = models.CharField(max_length=100, blank=True, null=True, unique=True)
     admin = models.ForeignKey(
         User, on_delete=models.CASCADE, related_name='admin')
     market_cap = models.IntegerField(default=-1)
@@ -56,19 +93,36 @@ class Currency(models.Model):
     initial_balance = models.IntegerField(default=0)
     # ledger = models.ForeignKey('Ledger', on_delete=models.CASCADE, related_name='currencies', blank=True, null=True)
 
+    # maintained by Wallet.save and the wallet post_delete signal
+    circulating_supply = models.BigIntegerField(default=0)
+    holder_count = models.IntegerField(default=0)
+
+    COUNTER_FIELDS = ('circulating_supply', 'holder_count')
+
+    class Meta:
+        indexes = [
+            # the order of currenciesConnection pages, see api/pagination.py
+            models.Index(fields=['created_at', 'id'], name='currency_created'),
+        ]
+
     def __str__(self):
         return self.name
 
-    def generateInvite(self):
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_admin_id = instance.admin_id
+        return instance
+
+    def generateInvite(self, commit=True):
         signer = Signer()
         self.invite_code = signer.sign(f"{self.id}-{self.name}-{self.symbol}")
-        self.save()
+        if commit:
+            self.save()
         return self.invite_code
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        if self.invite_code == None:
-            self.generateInvite()
+        adding = self._state.adding
 
         if self.market_cap == None:
             self.market_cap = -1
@@ -81,13 +135,31 @@ class Currency(models.Model):
             if self.market_cap != -1:
                 self.initial_balance = 0
 
-        if self.admin.wallets.filter(currency=self).count() == 0:
-            wallet = Wallet(user=self.admin, currency=self,
-                            balance=self.initial_balance if self.market_cap == -1 else self.market_cap)
-            wallet.save()
-            self.admin.wallets.add(wallet)
+        # the counters are only written with F() updates, never from a stale instance
+        if not adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS]
 
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if self.invite_code == None:
+                self.generateInvite(commit=False)
+                super().save(update_fields=['invite_code'])
+
+            if adding:
+                shards.place(self)
+
+            # only a new currency or a new admin can be missing the admin wallet
+            if adding or self.admin_id != getattr(self, '_loaded_admin_id', self.admin_id):
+                if adding or not self.wallets.filter(user_id=self.admin_id).exists():
+                    wallet = Wallet(user=self.admin, currency=self,
+                                    balance=self.initial_balance if self.market_cap == -1 else self.market_cap)
+                    wallet.save()
+        self._loaded_admin_id = self.admin_id
+
+        if adding:
+            self.refresh_from_db(fields=self.COUNTER_FIELDS)
 
     def get_users(self):
         return self.wallets.all().values_list('user', flat=True)
@@ -97,57 +169,124 @@ class Currency(models.Model):
         return self.invite_code == signer.unsign(self.invite_code)
 
     def validate_cap(self):
-        total = self.wallets.all().aggregate(
-            models.Sum('balance'))['balance__sum']
-        return self.market_cap == -1 or total == None or total <= self.market_cap
+        self.refresh_from_db(fields=['circulating_supply'])
+        return self.market_cap == -1 or self.circulating_supply <= self.market_cap
+
+    def unreconciled_wallets(self):
+        """Wallets whose balance does not match their running totals."""
+        return self.wallets.exclude(
+            balance=F('opening_balance') + F('total_received') - F('total_sent'))
 
     def get_admin_wallet(self):
-        return self.admin.wallets.filter(currency=self).first()
+        return self.wallets.filter(user_id=self.admin_id).first()
 
 
 class Wallet(models.Model):
+    # users and currencies live on the primary, the wallet on the shard of
+    # its currency, so there is no database constraint, see api/shards.py.
+    # The index in Meta leads with the currency, it needs no index of its own.
     user = models.ForeignKey(
-        User, on_delete=models.CASCADE, related_name='wallets')
+        User, on_delete=models.CASCADE, related_name='wallets', db_constraint=False)
     balance = models.IntegerField(default=0)
     currency = models.ForeignKey(
-        Currency, on_delete=models.CASCADE, related_name='wallets')
+        Currency, on_delete=models.CASCADE, related_name='wallets', db_constraint=False, db_index=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     publickey = models.TextField(max_length=5000, blank=True, null=True)
     privatekey = models.TextField(max_length=5000, blank=True, null=True)
 
+    # running totals kept by the transfer service,
+    # opening_balance + total_received - total_sent == balance
+    opening_balance = models.BigIntegerField(default=0)
+    total_received = models.BigIntegerField(default=0)
+    total_sent = models.BigIntegerField(default=0)
+
+    TOTAL_FIELDS = ('opening_balance', 'total_received', 'total_sent')
+
+    class Meta:
+        indexes = [
+            # the biggest holders of a currency, see api/leaderboard.py
+            models.Index(fields=['currency', '-balance', 'id'], name='wallet_currency_balance'),
+            # the order of walletsConnection pages, see api/pagination.py
+            models.Index(fields=['created_at', 'id'], name='wallet_created'),
+        ]
+
     def __str__(self):
         return f'{self.user.username}\'s wallet'
 
     def deposit(self, amount):
-        self.balance += amount
-        self.save()
-        return self.balance
+        return self._adjust(amount)
 
     def withdraw(self, amount):
-        self.balance -= amount
-        self.save()
+        return self._adjust(-amount, balance__gte=amount)
+
+    def _adjust(self, amount, **guard):
+        # a change outside of a transfer moves the opening balance with the
+        # balance, so the running totals still add up, and the supply with both
+        from . import leaderboard
+
+        using = self._state.db or router.db_for_write(Wallet, instance=self)
+        with transaction.atomic(using=using):
+            updated = Wallet.objects.using(using).filter(pk=self.pk, **guard).update(
+                balance=F('balance') + amount, opening_balance=F('opening_balance') + amount,
+                updated_at=timezone.now())
+            if updated:
+                Currency.objects.filter(pk=self.currency_id).update(
+                    circulating_supply=F('circulating_supply') + amount)
+            self.refresh_from_db(fields=['balance', 'opening_balance'])
+            if updated:
+                currency_id, balances = self.currency_id, [(self.pk, self.balance)]
+                transaction.on_commit(lambda: leaderboard.boards.update(currency_id, balances), using=using)
         return self.balance
 
     def validate_amount(self):
-        amount_earn = self.received.all().aggregate(
-            models.Sum('amount'))['amount__sum'] if self.received.all().aggregate(models.Sum('amount'))['amount__sum'] != None else 0
-        amount_spend = self.sent.all().aggregate(
-            models.Sum('amount'))['amount__sum'] if self.sent.all().aggregate(models.Sum('amount'))['amount__sum'] != None else 0
-        return amount_earn - amount_spend == self.balance
-
-    def generateKey(self):
-        keyPair = RSA.generate(2048)
-        self.publickey = keyPair.publickey().export_key().decode('ascii')
-        self.privatekey = keyPair.export_key().decode('ascii')
-        self.save()
+        opening, received, sent, balance = Wallet.objects.db_manager(self._state.db).values_list(
+            'opening_balance', 'total_received', 'total_sent', 'balance').get(pk=self.pk)
+        return opening + received - sent == balance
+
+    def generateKey(self, commit=True):
+        # take a pre-generated key pair, generate inline only when the pool is empty
+        keyPair = keypool.take()
+        if keyPair is None:
+            keyPair = keypool.generate_keypair()
+        self.publickey, self.privatekey = keyPair
+        if commit:
+            self.save()
         return keyPair
 
     def save(self, *args, **kwargs):
         if not self.publickey or not self.privatekey:
-            self.generateKey()
-        super().save(*args, **kwargs)
+            self.generateKey(commit=False)
+
+        # the running totals are only written with F() updates, never from a stale instance
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.TOTAL_FIELDS]
+
+        update_fields = kwargs.get('update_fields')
+        using = kwargs.get('using') or router.db_for_write(Wallet, instance=self)
+        kwargs['using'] = using
+        if shards.assign_ids([self]):
+            kwargs['force_insert'] = True
+        # the counters of the currency are on the primary, the wallet may be on another shard
+        with transaction.atomic(using=using):
+            supply, holders = 0, 0
+            if self._state.adding:
+                supply, holders = self.balance, 1
+                self.opening_balance = self.balance
+            elif update_fields is None or 'balance' in update_fields:
+                stored = Wallet.objects.using(using).filter(pk=self.pk).values_list('balance', flat=True).first()
+                if stored is None:
+                    supply, holders = self.balance, 1
+                else:
+                    supply = self.balance - stored
+            super().save(*args, **kwargs)
+            if supply or holders:
+                Currency.objects.filter(pk=self.currency_id).update(
+                    circulating_supply=F('circulating_supply') + supply,
+                    holder_count=F('holder_count') + holders)
 
     # def create(self, user, currency):
     #     self.user = user
@@ -163,19 +302,21 @@ class Wallet(models.Model):
 
     def sign(self, message):
         hash = SHA256.new(message.encode('utf-8'))
-        signer = PKCS115_SigScheme(RSA.import_key(self.privatekey))
+        signer = keycache.signer(self)
         signature = signer.sign(hash)
         return binascii.hexlify(signature).decode('ascii')
 
 
 class Transaction(models.Model):
+    # the composite indexes in Meta lead with these columns, so the
+    # single column foreign key indexes are not needed
     sender = models.ForeignKey(
-        Wallet, on_delete=models.CASCADE, related_name='sent')
+        Wallet, on_delete=models.CASCADE, related_name='sent', db_index=False)
     receiver = models.ForeignKey(
-        Wallet, on_delete=models.CASCADE, related_name='received')
+        Wallet, on_delete=models.CASCADE, related_name='received', db_index=False)
     amount = models.IntegerField()
     currency = models.ForeignKey(
-        Currency, on_delete=models.CASCADE, related_name='transactions')
+        Currency, on_delete=models.CASCADE, related_name='transactions', db_index=False, db_constraint=False)
     created_at = models.DateTimeField(auto_now_add=True)
     sender_signature = models.TextField(max_length=5000, blank=True, null=True)
     receiver_signature = models.TextField(
@@ -186,13 +327,25 @@ class Transaction(models.Model):
     after_sender_amount_snapshot = models.IntegerField(default=0)
     after_receiver_amount_snapshot = models.IntegerField(default=0)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['currency', 'created_at'], name='transaction_currency_time'),
+            models.Index(fields=['sender', 'created_at'], name='transaction_sender_time'),
+            models.Index(fields=['receiver', 'created_at'], name='transaction_receiver_time'),
+            models.Index(fields=['created_at'], name='transaction_time'),
+        ]
+
     def __str__(self):
-        return f'{self.sender.user.username} sent {self.amount} to {self.receiver.user.username}'
+        return Transaction.message_for(self.sender, self.receiver, self.amount)
+
+    @staticmethod
+    def message_for(sender, receiver, amount):
+        return f"{sender.user.username} sent {amount} to {receiver.user.username}"
 
     def validate_signature(self):
-        verifier = PKCS115_SigScheme(RSA.import_key(self.receiver.publickey))
-        hash = SHA256.new(
-            f"{self.sender.user.username} sent {self.amount} to {self.receiver.user.username}".encode('utf-8'))
+        verifier = keycache.verifier(self.sender)
+        hash = SHA256.new(Transaction.message_for(
+            self.sender, self.receiver, self.amount).encode('utf-8'))
         return verifier.verify(hash, binascii.unhexlify(self.sender_signature))
 
     def create(self, sender, receiver, amount, currency):
@@ -209,23 +362,111 @@ class Transaction(models.Model):
             return None
 
     def save(self, *args, **kwargs):
-        if self.sender.currency == self.currency and self.receiver.currency == self.currency:
-            self.before_sender_amount_snapshot = self.sender.balance
-            self.before_receiver_amount_snapshot = self.receiver.balance
-            self.sender_signature = self.sender.sign(
-                f"{self.sender.user.username} sent {self.amount} to {self.receiver.user.username}")
-            self.receiver_signature = self.receiver.sign(
-                f"{self.sender.user.username} sent {self.amount} to {self.receiver.user.username}")
+        if self._state.adding:
+            # new transfers move the balances through the transfer service
+            from . import transfers
+            transfers.apply(self)
+        else:
             super().save(*args, **kwargs)
-            if self.sender.balance >= self.amount and self.amount > 0:
-                self.sender.withdraw(self.amount)
-                self.receiver.deposit(self.amount)
-                self.after_sender_amount_snapshot = self.sender.balance
-                self.after_receiver_amount_snapshot = self.receiver.balance
-                super().save(*args, **kwargs)
 
     def validate_currency(self):
         return self.sender.currency == self.currency and self.receiver.currency == self.currency
 
     def validate_amount(self):
         return (self.sender_amount_snapshot - self.amount == self.after_sender_amount_snapshot and self.receiver_amount_snapshot + self.amount == self.after_receiver_amount_snapshot) or self.amount > 0
+
+
+class BalanceCheckpoint(models.Model):
+    """The balance of a wallet at a checkpoint of its currency, see api/checkpoints.py."""
+    # the unique constraint leads with the wallet
+    wallet = models.ForeignKey(
+        Wallet, on_delete=models.CASCADE, related_name='checkpoints', db_index=False)
+    currency = models.ForeignKey(
+        Currency, on_delete=models.CASCADE, related_name='checkpoints', db_index=False, db_constraint=False)
+    as_of = models.DateTimeField()
+    balance = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['wallet', 'as_of'], name='checkpoint_wallet_time'),
+        ]
+        indexes = [
+            models.Index(fields=['currency', 'as_of'], name='checkpoint_currency_time'),
+        ]
+
+
+class VolumeRollup(models.Model):
+    """The transfers of a currency in one minute, hour or day, see api/rollups.py."""
+    GRANULARITIES = [('minute', 'Minute'), ('hour', 'Hour'), ('day', 'Day')]
+
+    # the unique constraint leads with the currency
+    currency = models.ForeignKey(
+        Currency, on_delete=models.CASCADE, related_name='rollups', db_index=False)
+    granularity = models.CharField(max_length=10, choices=GRANULARITIES)
+    bucket = models.DateTimeField()
+    volume = models.BigIntegerField(default=0)
+    transactions = models.IntegerField(default=0)
+    active_wallets = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['currency', 'granularity', 'bucket'], name='rollup_currency_bucket'),
+        ]
+
+
+class RollupWallet(models.Model):
+    """A wallet active in the day the rollups of its currency are being built for."""
+    # the unique constraint leads with the currency
+    currency = models.ForeignKey(Currency, on_delete=models.CASCADE, related_name='+', db_index=False)
+    day = models.DateTimeField()
+    # wallets may live on another shard, see api/shards.py
+    wallet_id = models.BigIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['currency', 'day', 'wallet_id'], name='rollup_wallet_day'),
+        ]
+
+
+class RollupMark(models.Model):
+    """The transactions of the currency created before ``through`` are rolled up."""
+    currency = models.OneToOneField(
+        Currency, on_delete=models.CASCADE, primary_key=True, related_name='rollup_mark')
+    through = models.DateTimeField()
+
+
+class CurrencyPlacement(models.Model):
+    """The ledger shard holding the wallets and transactions of a currency, see api/shards.py."""
+    currency = models.OneToOneField(
+        Currency, on_delete=models.CASCADE, primary_key=True, related_name='placement')
+    shard = models.CharField(max_length=100)
+    # writes to the ledger of the currency are refused while it moves
+    moving = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class LedgerSequence(models.Model):
+    """The next free id of a sharded ledger model, handed out in blocks."""
+    name = models.CharField(max_length=100, primary_key=True)
+    next = models.BigIntegerField()
+
+
+class PooledKey(models.Model):
+    """A ready RSA key pair waiting to be handed to a new wallet."""
+    publickey = models.TextField(max_length=5000)
+    privatekey = models.TextField(max_length=5000)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class KeyRefill(models.Model):
+    """The key pairs one refill added to the pool, read for the refill rate."""
+    keys = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class PersistedQuery(models.Model):
+    """A registered GraphQL document that clients may run by its SHA-256 hash."""
+    sha256 = models.CharField(max_length=64, unique=True)
+    query = models.TextField()
+    name = models.CharField(max_length=200, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
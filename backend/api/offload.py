@@ -0,0 +1,54 @@
+"""
+Bounded pools for the CPU heavy work of the async views.
+
+Password hashing and RSA signing release the GIL for most of their run and
+go to a thread pool. RSA key generation does not, so a key pair that can not
+be taken from the key pool is generated in a process pool. Both pools are
+bounded, which caps the number of expensive requests in flight while the
+event loop keeps serving the cheap ones.
+"""
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+
+DEFAULTS = {
+    # threads hashing passwords and signing transactions
+    'THREADS': 4,
+    # processes generating RSA keys when the key pool is empty, 0 uses the threads
+    'PROCESSES': 2,
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def offload_settings():
+    return {**DEFAULTS, **getattr(settings, 'ASYNC_VIEWS', {})}
+
+
+def _pool(kind):
+    with _pools_lock:
+        pool = _pools.get(kind)
+        if pool is None:
+            config = offload_settings()
+            if kind == 'process':
+                pool = ProcessPoolExecutor(max_workers=config['PROCESSES'])
+            else:
+                pool = ThreadPoolExecutor(max_workers=config['THREADS'], thread_name_prefix='offload')
+            _pools[kind] = pool
+        return pool
+
+
+async def run_in_thread(fn, *args, **kwargs):
+    """Run ``fn`` in the thread pool, it must not use the database."""
+    return await asyncio.get_running_loop().run_in_executor(_pool('thread'), partial(fn, *args, **kwargs))
+
+
+async def run_in_process(fn, *args):
+    """Run ``fn``, a picklable module level function, in the process pool."""
+    if not offload_settings()['PROCESSES']:
+        return await run_in_thread(fn, *args)
+    return await asyncio.get_running_loop().run_in_executor(_pool('process'), partial(fn, *args))
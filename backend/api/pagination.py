@@ -0,0 +1,83 @@
+"""
+Keyset pagination for the Relay connections of the GraphQL schema.
+
+Pages are ordered by (created_at, id) and a cursor encodes the position of
+the last row, so the next page is an indexed range read that costs the same
+for page 1000 as for page 1, where OFFSET would skip every earlier row.
+Rows spread over the ledger shards are paged by merging the page read
+from each shard, without the copies of a currency being moved.
+"""
+import base64
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from graphene.relay import PageInfo
+from graphene_django import settings as graphene_django_settings
+
+from . import shards
+
+
+def max_page_size():
+    # looked up on the module, graphene-django replaces the object when settings change
+    return graphene_django_settings.graphene_settings.RELAY_CONNECTION_MAX_LIMIT
+
+
+def encode_cursor(position, pk):
+    return base64.urlsafe_b64encode(f'{position.isoformat()}|{pk}'.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        position, pk = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+        position = parse_datetime(position)
+        if position is None:
+            raise ValueError(cursor)
+        return position, int(pk)
+    except (ValueError, UnicodeError):
+        raise Exception('Invalid cursor')
+
+
+def page_size(first):
+    if first is None:
+        return max_page_size()
+    if first < 0:
+        raise Exception('first must not be negative')
+    return min(first, max_page_size())
+
+
+def keyset_page(queryset, connection_type, first=None, after=None, order_field='created_at'):
+    """
+    Return the page of ``queryset`` following the ``after`` cursor as a
+    connection. ``queryset`` may be a list of querysets, one per shard.
+    """
+    size = page_size(first)
+    querysets = queryset if isinstance(queryset, list) else [queryset]
+    if after:
+        position, pk = decode_cursor(after)
+        querysets = [queryset.filter(
+            Q(**{f'{order_field}__gt': position}) | Q(**{order_field: position, 'id__gt': pk}))
+            for queryset in querysets]
+
+    rows = []
+    for queryset in querysets:
+        rows.extend(row for row in queryset.order_by(order_field, 'id')[:size + 1]
+                    if shards.belongs(row, queryset.db))
+    if len(querysets) > 1:
+        rows.sort(key=lambda row: (getattr(row, order_field), row.pk))
+    rows = rows[:size + 1]
+    has_next_page = len(rows) > size
+    rows = rows[:size]
+
+    edges = [
+        connection_type.Edge(node=row, cursor=encode_cursor(getattr(row, order_field), row.pk))
+        for row in rows
+    ]
+    return connection_type(
+        edges=edges,
+        page_info=PageInfo(
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+            has_next_page=has_next_page,
+            has_previous_page=bool(after),
+        ),
+    )
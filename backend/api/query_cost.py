@@ -0,0 +1,149 @@
+"""
+Static depth and cost analysis of GraphQL documents.
+
+The schema is cyclic (currency -> wallets -> user -> ...), so one nested
+query can ask for an unbounded amount of work. Before a document runs, its
+selected operation is walked once: every field costs 1 and the cost of the
+fields below a list is multiplied by the number of rows the list can return,
+which is the requested ``first`` (capped at the maximum page size) for
+connections and DEFAULT_LIST_SIZE for plain lists. Introspection fields are
+bounded by the schema and are not counted.
+"""
+from django.conf import settings
+from graphql.error import GraphQLError
+from graphql.language import ast
+from graphql.type.definition import GraphQLList, get_named_type, get_nullable_type
+
+from .pagination import max_page_size
+
+DEFAULTS = {
+    'MAX_DEPTH': 10,
+    'MAX_COST': 20000,
+    'DEFAULT_LIST_SIZE': 100,
+}
+
+
+def limits():
+    return {**DEFAULTS, **getattr(settings, 'GRAPHQL_LIMITS', {})}
+
+
+def get_operation(document_ast, operation_name=None):
+    for definition in document_ast.definitions:
+        if isinstance(definition, ast.OperationDefinition):
+            if operation_name is None or (definition.name and definition.name.value == operation_name):
+                return definition
+    return None
+
+
+def _fragments(document_ast):
+    return {
+        definition.name.value: definition for definition in document_ast.definitions
+        if isinstance(definition, ast.FragmentDefinition)
+    }
+
+
+def _fields(selection_set, fragments, type_name, visited=()):
+    """Yield (field, parent type name) for a selection set, expanding fragments."""
+    for selection in selection_set.selections:
+        if isinstance(selection, ast.Field):
+            yield selection, type_name
+        elif isinstance(selection, ast.InlineFragment):
+            condition = selection.type_condition.name.value if selection.type_condition else type_name
+            yield from _fields(selection.selection_set, fragments, condition, visited)
+        elif isinstance(selection, ast.FragmentSpread):
+            name = selection.name.value
+            if name in visited or name not in fragments:
+                continue
+            fragment = fragments[name]
+            yield from _fields(fragment.selection_set, fragments,
+                               fragment.type_condition.name.value, visited + (name,))
+
+
+def _argument(field, name, variables):
+    for argument in field.arguments or []:
+        if argument.name.value != name:
+            continue
+        value = argument.value
+        if isinstance(value, ast.Variable):
+            return (variables or {}).get(value.name.value)
+        if isinstance(value, ast.IntValue):
+            return int(value.value)
+    return None
+
+
+class QueryAnalysis:
+    def __init__(self, schema, document_ast, operation_name=None, variables=None):
+        self.schema = schema
+        self.document_ast = document_ast
+        self.operation = get_operation(document_ast, operation_name)
+        self.fragments = _fragments(document_ast)
+        self.variables = variables
+        self.list_size = limits()['DEFAULT_LIST_SIZE']
+
+    def root_type(self):
+        if self.operation.operation == 'mutation':
+            return self.schema.get_mutation_type()
+        if self.operation.operation == 'subscription':
+            return self.schema.get_subscription_type()
+        return self.schema.get_query_type()
+
+    def depth(self):
+        if self.operation is None:
+            return 0
+        return self._depth(self.operation.selection_set, self.root_type().name)
+
+    def _depth(self, selection_set, type_name):
+        deepest = 0
+        for field, _ in _fields(selection_set, self.fragments, type_name):
+            if field.name.value.startswith('__'):
+                continue
+            depth = 1
+            if field.selection_set:
+                depth += self._depth(field.selection_set, None)
+            deepest = max(deepest, depth)
+        return deepest
+
+    def cost(self):
+        if self.operation is None:
+            return 0
+        return self._cost(self.operation.selection_set, self.root_type())
+
+    def _cost(self, selection_set, parent_type, in_connection=False):
+        total = 0
+        for field, type_name in _fields(selection_set, self.fragments, parent_type.name):
+            name = field.name.value
+            if name.startswith('__'):
+                continue
+            owner = self.schema.get_type(type_name) if type_name else parent_type
+            definition = getattr(owner, 'fields', {}).get(name)
+            if definition is None:
+                # unknown fields are reported by validation
+                continue
+
+            field_type = get_named_type(definition.type)
+            multiplier = 1
+            is_connection = field_type.name.endswith('Connection')
+            if is_connection:
+                first = _argument(field, 'first', self.variables)
+                multiplier = max_page_size() if first is None else min(max(first, 0), max_page_size())
+            elif isinstance(get_nullable_type(definition.type), GraphQLList) and not in_connection:
+                multiplier = self.list_size
+
+            children = 0
+            if field.selection_set:
+                children = self._cost(field.selection_set, field_type, in_connection=is_connection)
+            total += 1 + multiplier * children
+        return total
+
+
+def check(schema, document_ast, operation_name=None, variables=None):
+    """Return the estimated cost of the operation, raise GraphQLError over the limits."""
+    config = limits()
+    analysis = QueryAnalysis(schema, document_ast, operation_name, variables)
+    depth = analysis.depth()
+    if depth > config['MAX_DEPTH']:
+        raise GraphQLError(f"Query depth {depth} exceeds the limit of {config['MAX_DEPTH']}")
+    cost = analysis.cost()
+    if cost > config['MAX_COST']:
+        raise GraphQLError(f"Query cost {cost} exceeds the limit of {config['MAX_COST']}")
+    return cost
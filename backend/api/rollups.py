@@ -0,0 +1,225 @@
+"""
+Per-currency transfer volume by minute, hour and day.
+
+Each VolumeRollup row holds the volume, the number of transfers and the
+number of distinct wallets that sent or received in one bucket. The rows
+are kept by a catch-up job, ``python manage.py build_rollups --every``,
+rather than by the transfers: a distinct wallet count can not be raised
+with an F() update, and the transfer path stays as short as it is.
+
+A currency's RollupMark is its high-water mark: its transactions created
+before ``through`` are rolled up. build() moves it forward one UTC day at
+a time and reads the transactions after it. The minute and hour buckets
+from the hour of the mark on are recomputed, which rereads at most an hour.
+The bucket of the day is added to, and the wallets already active in it are
+kept in RollupWallet rows until the next day starts. Transactions younger
+than ``SETTLE_SECONDS`` wait for the next run, since a transfer stamped
+earlier may still be committing.
+
+series() reads only the rollups. It picks the finest granularity that
+returns at most ``MAX_POINTS`` buckets. Over longer ranges it merges days,
+and the wallet count of a merged bucket is unknown.
+"""
+import math
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from . import shards
+from .models import Currency, RollupMark, RollupWallet, Transaction, VolumeRollup
+
+DEFAULTS = {
+    # transactions younger than this may still be committing
+    'SETTLE_SECONDS': 60,
+    # most buckets returned by series()
+    'MAX_POINTS': 500,
+    # wallets looked up per query
+    'CHUNK_SIZE': 500,
+}
+
+GRANULARITIES = {
+    'minute': timedelta(minutes=1),
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+}
+
+
+class RollupError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def rollup_settings():
+    return {**DEFAULTS, **getattr(settings, 'ROLLUPS', {})}
+
+
+def floor(moment, granularity):
+    """Return the start of the bucket of ``moment``."""
+    moment = moment.astimezone(timezone.utc)
+    if granularity == 'minute':
+        return moment.replace(second=0, microsecond=0)
+    if granularity == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def parse_time(value, end=False):
+    if value is None:
+        return None
+    try:
+        parsed = parse_datetime(value)
+        day = parse_date(value) if parsed is None else None
+    except ValueError:
+        # well formed but impossible, like February 30th
+        raise RollupError(f'Invalid date {value}')
+    if parsed is None:
+        if day is None:
+            raise RollupError(f'Invalid date {value}')
+        # a bare end date includes the whole day
+        parsed = datetime.combine(day, time.max if end else time.min)
+    if settings.USE_TZ and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def aggregate(currency_id, transactions, since):
+    """
+    Return the unsaved minute and hour VolumeRollup rows of ``transactions``,
+    and the (volume, count, wallets) of the ones created from ``since`` on.
+    """
+    buckets = defaultdict(lambda: [0, 0, set()])
+    volume, count, wallets = 0, 0, set()
+    for created_at, sender_id, receiver_id, amount in transactions.values_list(
+            'created_at', 'sender_id', 'receiver_id', 'amount').iterator():
+        for granularity in ('minute', 'hour'):
+            bucket = buckets[granularity, floor(created_at, granularity)]
+            bucket[0] += amount
+            bucket[1] += 1
+            bucket[2].update((sender_id, receiver_id))
+        if created_at >= since:
+            volume += amount
+            count += 1
+            wallets.update((sender_id, receiver_id))
+    rows = [
+        VolumeRollup(currency_id=currency_id, granularity=granularity, bucket=start,
+                     volume=bucket_volume, transactions=bucket_count, active_wallets=len(bucket_wallets))
+        for (granularity, start), (bucket_volume, bucket_count, bucket_wallets) in buckets.items()
+    ]
+    return rows, (volume, count, wallets)
+
+
+def _new_wallets(currency_id, day, wallet_ids):
+    """Record ``wallet_ids`` as active in ``day``, return how many were not yet."""
+    chunk_size = rollup_settings()['CHUNK_SIZE']
+    wallet_ids = list(wallet_ids)
+    known = set()
+    for start in range(0, len(wallet_ids), chunk_size):
+        known.update(RollupWallet.objects.filter(
+            currency_id=currency_id, day=day, wallet_id__in=wallet_ids[start:start + chunk_size],
+        ).values_list('wallet_id', flat=True))
+    new = [RollupWallet(currency_id=currency_id, day=day, wallet_id=wallet_id)
+           for wallet_id in wallet_ids if wallet_id not in known]
+    RollupWallet.objects.bulk_create(new, batch_size=chunk_size)
+    return len(new)
+
+
+def _roll_up(currency_id, transactions, start, end):
+    """Add the transactions from ``start`` to ``end``, both in one day, to the rollups."""
+    day = floor(start, 'day')
+    hour = floor(start, 'hour')
+    # the hour of the mark is read whole, its distinct wallets are not kept
+    rows, (volume, count, wallets) = aggregate(
+        currency_id, transactions.filter(created_at__gte=hour, created_at__lt=end), start)
+    with transaction.atomic():
+        rollups = VolumeRollup.objects.filter(currency_id=currency_id)
+        if start == day:
+            # a day starting over, its earlier rows may be left from an interrupted run
+            rollups.filter(bucket__gte=day, bucket__lt=day + GRANULARITIES['day']).delete()
+            RollupWallet.objects.filter(currency_id=currency_id, day__lte=day).delete()
+        rollups.filter(granularity__in=('minute', 'hour'), bucket__gte=hour, bucket__lt=end).delete()
+        VolumeRollup.objects.bulk_create(rows)
+        if count:
+            active = _new_wallets(currency_id, day, wallets)
+            updated = rollups.filter(granularity='day', bucket=day).update(
+                volume=F('volume') + volume, transactions=F('transactions') + count,
+                active_wallets=F('active_wallets') + active)
+            if not updated:
+                VolumeRollup.objects.create(currency_id=currency_id, granularity='day', bucket=day,
+                                            volume=volume, transactions=count, active_wallets=active)
+        RollupMark.objects.update_or_create(currency_id=currency_id, defaults={'through': end})
+
+
+def build(currency_id, now=None):
+    """Roll up the settled transactions of a currency after its mark, return the days rolled up."""
+    settled = (now or timezone.now()) - timedelta(seconds=rollup_settings()['SETTLE_SECONDS'])
+    transactions = Transaction.objects.using(shards.for_currency(currency_id)).filter(currency_id=currency_id)
+    through = RollupMark.objects.filter(currency_id=currency_id).values_list('through', flat=True).first()
+    days = 0
+    while through is None or through < settled:
+        following = transactions.filter(created_at__lt=settled)
+        if through is not None:
+            following = following.filter(created_at__gte=through)
+        first = following.order_by('created_at').values_list('created_at', flat=True).first()
+        if first is None:
+            # nothing to roll up before settled, the mark can skip ahead
+            RollupMark.objects.update_or_create(currency_id=currency_id, defaults={'through': settled})
+            return days
+        # a mark in the day of the next transaction goes on from there
+        start = through if through is not None and floor(through, 'day') == floor(first, 'day') else floor(first, 'day')
+        end = min(floor(start, 'day') + GRANULARITIES['day'], settled)
+        _roll_up(currency_id, transactions, start, end)
+        through = end
+        days += 1
+    return days
+
+
+def build_all(now=None):
+    """Roll up the settled transactions of every currency, return the days rolled up."""
+    return sum(build(currency_id, now=now) for currency_id in Currency.objects.values_list('id', flat=True))
+
+
+def series(currency_id, start=None, end=None, granularity=None):
+    """
+    Return (granularity, bucket seconds, rows) of the currency between
+    ``start`` and ``end``, by default the last day. The rows are dicts of
+    bucket, volume, transactions and active_wallets, buckets without
+    transfers are left out. ``granularity`` is the finest one wanted.
+    """
+    max_points = rollup_settings()['MAX_POINTS']
+    end = end or timezone.now()
+    start = start or end - GRANULARITIES['day']
+    if start > end:
+        raise RollupError('start is after end')
+    names = list(GRANULARITIES)
+    if granularity is not None:
+        if granularity not in GRANULARITIES:
+            raise RollupError(f'Granularity must be one of {", ".join(names)}')
+        names = names[names.index(granularity):]
+    span = end - start
+    chosen = next((name for name in names if span / GRANULARITIES[name] <= max_points), 'day')
+
+    rows = list(VolumeRollup.objects.filter(
+        currency_id=currency_id, granularity=chosen,
+        bucket__gte=floor(start, chosen), bucket__lte=end,
+    ).order_by('bucket').values('bucket', 'volume', 'transactions', 'active_wallets'))
+    width = GRANULARITIES[chosen]
+    days = span / width
+    if chosen != 'day' or days <= max_points:
+        return chosen, int(width.total_seconds()), rows
+
+    # merge runs of days, their distinct wallets can not be added up
+    width = width * math.ceil(days / max_points)
+    origin = floor(start, 'day')
+    merged = {}
+    for row in rows:
+        bucket = origin + (row['bucket'] - origin) // width * width
+        total = merged.setdefault(bucket, {'bucket': bucket, 'volume': 0, 'transactions': 0, 'active_wallets': None})
+        total['volume'] += row['volume']
+        total['transactions'] += row['transactions']
+    return 'day', int(width.total_seconds()), list(merged.values())
@@ -0,0 +1,162 @@
+"""
+Read replica routing.
+
+Writes always go to ``default``. Reads go to a replica of
+``DATABASE_REPLICAS`` only inside replica_reads(), which wraps the read-only
+GraphQL operations and reporting queries, every other read stays on the
+primary. Once a request writes, its remaining reads use the primary, and
+ReplicaMiddleware keeps the client on the primary for ``STICKY_SECONDS``
+more so it reads its own writes while the replicas catch up.
+
+A replica can be any database alias, including a second SQLite file kept in
+step by ``python manage.py sync_replicas``.
+"""
+import asyncio
+import contextvars
+import hashlib
+import random
+import sqlite3
+from contextlib import closing, contextmanager
+
+from asgiref.sync import markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+
+DEFAULTS = {
+    # seconds a client that wrote keeps reading from the primary
+    'STICKY_SECONDS': 5,
+    'CACHE_ALIAS': 'default',
+    # pages copied per step by sync_replicas, readers of the replica run in between
+    'COPY_PAGES': 1024,
+}
+
+PRIMARY = 'default'
+
+# per request: {'replica': bool, 'wrote': bool}
+_state = contextvars.ContextVar('replica_routing', default=None)
+
+
+def routing_settings():
+    return {**DEFAULTS, **getattr(settings, 'REPLICA_ROUTING', {})}
+
+
+def replicas():
+    return list(getattr(settings, 'DATABASE_REPLICAS', []))
+
+
+@contextmanager
+def replica_reads():
+    """Send the reads made inside the block to a replica, unless the context wrote."""
+    state = _state.get()
+    if state is None:
+        token = _state.set({'replica': True, 'wrote': False})
+        try:
+            yield
+        finally:
+            _state.reset(token)
+        return
+    previous = state['replica']
+    state['replica'] = True
+    try:
+        yield
+    finally:
+        state['replica'] = previous
+
+
+@contextmanager
+def request_context(sticky=False):
+    token = _state.set({'replica': False, 'wrote': sticky})
+    try:
+        yield _state.get()
+    finally:
+        _state.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state['replica'] or state['wrote']:
+            return PRIMARY
+        choices = replicas()
+        return random.choice(choices) if choices else PRIMARY
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state['wrote'] = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {PRIMARY, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas are copies of the primary
+        if db in replicas():
+            return False
+        return None
+
+
+def _sticky_key(request):
+    authorization = request.META.get('HTTP_AUTHORIZATION')
+    if not authorization:
+        return None
+    return 'replica-sticky:' + hashlib.sha256(authorization.encode('utf-8')).hexdigest()
+
+
+class ReplicaMiddleware:
+    """Tracks the writes of a request and pins its client to the primary after one."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        key, cache = _sticky_key(request), self.cache()
+        with request_context(sticky=bool(key and cache.get(key))) as state:
+            response = self.get_response(request)
+            self.pin(key, cache, state)
+        return response
+
+    async def __acall__(self, request):
+        key, cache = _sticky_key(request), self.cache()
+        with request_context(sticky=bool(key and cache.get(key))) as state:
+            response = await self.get_response(request)
+            self.pin(key, cache, state)
+        return response
+
+    def cache(self):
+        return caches[routing_settings()['CACHE_ALIAS']]
+
+    def pin(self, key, cache, state):
+        if key and state['wrote'] and replicas():
+            cache.set(key, True, routing_settings()['STICKY_SECONDS'])
+
+
+def copy_database(source, target, pages=None):
+    """Copy the SQLite database ``source`` into ``target`` with the online backup API."""
+    pages = pages or routing_settings()['COPY_PAGES']
+    with closing(sqlite3.connect(source)) as src, closing(sqlite3.connect(target)) as dst:
+        src.backup(dst, pages=pages)
+
+
+def sync_replicas():
+    """Refresh the SQLite replicas from the primary, return the aliases copied."""
+    from django.db import connections
+
+    primary = connections[PRIMARY].settings_dict
+    synced = []
+    for alias in replicas():
+        replica = connections[alias].settings_dict
+        if 'sqlite' not in primary['ENGINE'] or 'sqlite' not in replica['ENGINE']:
+            continue
+        copy_database(str(primary['NAME']), str(replica['NAME']))
+        synced.append(alias)
+    return synced
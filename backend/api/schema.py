@@ -3,6 +3,9 @@ from graphene_django import DjangoObjectType
 # from graphene_django.rest_framework.mutation import SerializerMutation
 from .serializers import *
 from .models import *
+from .loaders import get_loaders
+from . import checkpoints, leaderboard, rollups, shards
+from .pagination import keyset_page, max_page_size
 # from django.contrib.auth.mixins import LoginRequiredMixin
 
 # from backend.api import serializers
@@ -21,16 +24,90 @@ class WalletType(DjangoObjectType):
         fields = ('id', 'user', 'currency', 'balance',
                   'created_at', 'updated_at', 'publickey')
 
+    def resolve_user(self, info):
+        return get_loaders(info.context).users.load(self.user_id)
+
+    def resolve_currency(self, info):
+        return get_loaders(info.context).currencies.load(self.currency_id)
+
 
 class TransactionType(DjangoObjectType):
     class Meta:
         model = Transaction
 
+    def resolve_sender(self, info):
+        return get_loaders(info.context).wallets.load(self.sender_id)
+
+    def resolve_receiver(self, info):
+        return get_loaders(info.context).wallets.load(self.receiver_id)
+
+    def resolve_currency(self, info):
+        return get_loaders(info.context).currencies.load(self.currency_id)
+
 
 class CurrencyType(DjangoObjectType):
     class Meta:
         model = Currency
 
+    def resolve_admin(self, info):
+        return get_loaders(info.context).users.load(self.admin_id)
+
+    def resolve_wallets(self, info):
+        return get_loaders(info.context).wallets_by_currency.load(self.id)
+
+    def resolve_transactions(self, info):
+        return get_loaders(info.context).transactions_by_currency.load(self.id)
+
+
+class WalletBalanceType(graphene.ObjectType):
+    """The balance of a wallet at a point in time."""
+    wallet = graphene.Field(WalletType)
+    balance = graphene.Int()
+
+
+class VolumeBucketType(graphene.ObjectType):
+    """The transfers of a currency in one bucket, active_wallets is null for merged days."""
+    bucket = graphene.DateTime()
+    volume = graphene.Int()
+    transactions = graphene.Int()
+    active_wallets = graphene.Int()
+
+
+class VolumeSeriesType(graphene.ObjectType):
+    granularity = graphene.String()
+    bucket_seconds = graphene.Int()
+    buckets = graphene.List(VolumeBucketType)
+
+
+class HolderType(graphene.ObjectType):
+    """A wallet and its rank among the holders of its currency, 1 holds the most."""
+    rank = graphene.Int()
+    balance = graphene.Int()
+    wallet = graphene.Field(WalletType)
+
+    def resolve_wallet(self, info):
+        return get_loaders(info.context).wallets.load(self.wallet_id)
+
+
+class UserConnection(graphene.relay.Connection):
+    class Meta:
+        node = UserType
+
+
+class WalletConnection(graphene.relay.Connection):
+    class Meta:
+        node = WalletType
+
+
+class TransactionConnection(graphene.relay.Connection):
+    class Meta:
+        node = TransactionType
+
+
+class CurrencyConnection(graphene.relay.Connection):
+    class Meta:
+        node = CurrencyType
+
 
 class UpdateCurrencies(graphene.Mutation):
     class Arguments:
@@ -48,6 +125,8 @@ class UpdateCurrencies(graphene.Mutation):
             if name:
                 currency.name = name
             if symbol:
+                if Currency.objects.filter(symbol=symbol).exclude(id=id).exists():
+                    raise Exception('Symbol already in use')
                 currency.symbol = symbol
             if admin:
                 currency.admin = User.objects.get(id=admin)
@@ -77,45 +156,142 @@ class DeleteCurrencies(graphene.Mutation):
 
 
 class Query(graphene.ObjectType):
-    all_users = graphene.List(UserType, description="List of all users")
+    all_users = graphene.List(UserType, description="List of all users", deprecation_reason="Use usersConnection")
     user_by_id = graphene.Field(
         UserType, id=graphene.Int(), description="Get user by id")
     user_by_username = graphene.Field(
         UserType, username=graphene.String(), description="Get user by username")
 
-    all_wallets = graphene.List(WalletType, description="List of all wallets")
+    all_wallets = graphene.List(WalletType, description="List of all wallets", deprecation_reason="Use walletsConnection")
     wallet_by_id = graphene.Field(
         WalletType, id=graphene.Int(), description="Get wallet by id")
     wallets_by_user = graphene.List(
-        WalletType, user=graphene.String(), description="List of all wallets of a user")
+        WalletType, user=graphene.String(), description="List of all wallets of a user", deprecation_reason="Use walletsConnection")
     wallets_by_currency = graphene.List(WalletType,
-                                        currency=graphene.String(), description="List of all wallets of a currency")
+                                        currency=graphene.String(), description="List of all wallets of a currency", deprecation_reason="Use walletsConnection")
 
     all_transactions = graphene.List(
-        TransactionType, description="List of all transactions")
+        TransactionType, description="List of all transactions", deprecation_reason="Use transactionsConnection")
     transaction_by_id = graphene.Field(
         TransactionType, id=graphene.Int(), description="Get transaction by id")
     transactions_by_sender = graphene.List(TransactionType, sender=graphene.String(
-    ), description="List of all transactions of a sender")
+    ), description="List of all transactions of a sender", deprecation_reason="Use transactionsConnection")
     transactions_by_reciever = graphene.List(TransactionType, receiver=graphene.String(
-    ), description="List of all transactions of a receiver")
+    ), description="List of all transactions of a receiver", deprecation_reason="Use transactionsConnection")
     transactions_by_time_period = graphene.List(TransactionType, start_date=graphene.String(
-    ), end_date=graphene.String(), description="List of all transactions between two dates")
+    ), end_date=graphene.String(), description="List of all transactions between two dates", deprecation_reason="Use transactionsConnection")
     transactions_by_currency = graphene.List(TransactionType, currency=graphene.String(
-    ), description="List of all transactions of a currency")
+    ), description="List of all transactions of a currency", deprecation_reason="Use transactionsConnection")
 
     all_currencies = graphene.List(
-        CurrencyType, description="List of all currencies")
+        CurrencyType, description="List of all currencies", deprecation_reason="Use currenciesConnection")
     currency_by_id = graphene.Field(
         CurrencyType, id=graphene.Int(), description="Get currency by id")
     currency_by_symbol = graphene.Field(
         CurrencyType, symbol=graphene.String(), description="Get currency by symbol")
     search_currencies_by_name = graphene.List(
-        CurrencyType, name=graphene.String(), description="Search currencies by name")
+        CurrencyType, name=graphene.String(), description="Search currencies by name", deprecation_reason="Use currenciesConnection")
     currency_by_invite_code = graphene.Field(
         CurrencyType, invite_code=graphene.String(), description="Get currency by invite code")
     currencies_by_admin = graphene.List(CurrencyType, admin=graphene.String(
-    ), description="List of all currencies of a user")
+    ), description="List of all currencies of a user", deprecation_reason="Use currenciesConnection")
+
+    users_connection = graphene.Field(
+        UserConnection, first=graphene.Int(), after=graphene.String(),
+        description="Page through all users")
+    wallets_connection = graphene.Field(
+        WalletConnection, first=graphene.Int(), after=graphene.String(),
+        user=graphene.String(), currency=graphene.String(),
+        description="Page through wallets, optionally of a user or a currency")
+    transactions_connection = graphene.Field(
+        TransactionConnection, first=graphene.Int(), after=graphene.String(),
+        sender=graphene.String(), receiver=graphene.String(), currency=graphene.String(),
+        start_date=graphene.String(), end_date=graphene.String(),
+        description="Page through transactions, optionally filtered by wallet, currency or dates")
+    currencies_connection = graphene.Field(
+        CurrencyConnection, first=graphene.Int(), after=graphene.String(),
+        admin=graphene.String(), name=graphene.String(),
+        description="Page through currencies, optionally of an admin or by name")
+
+    balance_at = graphene.Int(
+        wallet=graphene.Int(required=True), at=graphene.String(),
+        description="Balance of a wallet at a point in time, now by default")
+    balances_at = graphene.List(
+        WalletBalanceType, currency=graphene.String(required=True), at=graphene.String(),
+        description="Balances of the wallets of a currency at a point in time, now by default")
+
+    volume = graphene.Field(
+        VolumeSeriesType, currency=graphene.String(required=True), start=graphene.String(),
+        end=graphene.String(), granularity=graphene.String(),
+        description="Transfer volume of a currency from its rollups, the last day by default")
+
+    top_holders = graphene.List(
+        HolderType, currency=graphene.String(required=True), limit=graphene.Int(),
+        description="Wallets of a currency holding the most, biggest first")
+    holder_rank = graphene.Field(
+        HolderType, wallet=graphene.Int(required=True),
+        description="Rank of a wallet among the holders of its currency")
+
+    def resolve_balance_at(self, info, wallet, at=None):
+        return checkpoints.balance_at(shards.find(Wallet.objects.all(), wallet), checkpoints.parse_time(at))
+
+    def resolve_balances_at(self, info, currency, at=None):
+        return [
+            WalletBalanceType(wallet=wallet, balance=balance)
+            for wallet, balance in checkpoints.balances_at(currency, checkpoints.parse_time(at))
+        ]
+
+    def resolve_volume(self, info, currency, start=None, end=None, granularity=None):
+        granularity, bucket_seconds, rows = rollups.series(
+            currency, rollups.parse_time(start), rollups.parse_time(end, end=True), granularity)
+        return VolumeSeriesType(granularity=granularity, bucket_seconds=bucket_seconds,
+                                buckets=[VolumeBucketType(**row) for row in rows])
+
+    def resolve_top_holders(self, info, currency, limit=None):
+        if limit is not None:
+            limit = min(limit, max_page_size())
+        return leaderboard.top(currency, limit)
+
+    def resolve_holder_rank(self, info, wallet):
+        return leaderboard.rank(shards.find(Wallet.objects.all(), wallet))
+
+    def resolve_users_connection(self, info, first=None, after=None):
+        return keyset_page(User.objects.all(), UserConnection, first, after, order_field='date_joined')
+
+    def resolve_wallets_connection(self, info, first=None, after=None, user=None, currency=None):
+        wallets = Wallet.objects.all()
+        if user is not None:
+            wallets = wallets.filter(user=user)
+        if currency is not None:
+            wallets = shards.by_currency(wallets, currency)
+        else:
+            wallets = shards.fan_out(wallets)
+        return keyset_page(wallets, WalletConnection, first, after)
+
+    def resolve_transactions_connection(self, info, first=None, after=None, sender=None, receiver=None,
+                                        currency=None, start_date=None, end_date=None):
+        transactions = Transaction.objects.all()
+        if sender is not None:
+            transactions = transactions.filter(sender=sender)
+        if receiver is not None:
+            transactions = transactions.filter(receiver=receiver)
+        if start_date is not None:
+            transactions = transactions.filter(created_at__gte=start_date)
+        if end_date is not None:
+            transactions = transactions.filter(created_at__lte=end_date)
+        if currency is not None:
+            transactions = shards.by_currency(transactions, currency)
+        else:
+            transactions = shards.fan_out(transactions)
+        return keyset_page(transactions, TransactionConnection, first, after)
+
+    def resolve_currencies_connection(self, info, first=None, after=None, admin=None, name=None):
+        currencies = Currency.objects.all()
+        if admin is not None:
+            currencies = currencies.filter(admin=admin)
+        if name is not None:
+            currencies = currencies.filter(name__icontains=name)
+        return keyset_page(currencies, CurrencyConnection, first, after)
 
     def resolve_all_users(self, info, **kwargs):
         return User.objects.all()
@@ -133,45 +309,45 @@ class Query(graphene.ObjectType):
         return None
 
     def resolve_all_wallets(self, info, **kwargs):
-        return Wallet.objects.all()
+        return shards.fan_out_list(Wallet.objects.all())
 
     def resolve_wallet_by_id(self, info, **kwargs):
         id = kwargs.get('id')
         if id is not None:
-            return Wallet.objects.get(pk=id)
+            return shards.find(Wallet.objects.all(), id)
         return None
 
     def resolve_wallets_by_user(self, info, **kwargs):
         user = kwargs.get('user')
         if user is not None:
-            return Wallet.objects.filter(user=user)
+            return shards.fan_out_list(Wallet.objects.filter(user=user))
         return None
 
     def resolve_wallets_by_currency(self, info, **kwargs):
         currency = kwargs.get('currency')
         if currency is not None:
-            return Wallet.objects.filter(currency=currency)
+            return shards.by_currency(Wallet.objects.all(), currency)
         return None
 
     def resolve_all_transactions(self, info, **kwargs):
-        return Transaction.objects.all()
+        return shards.fan_out_list(Transaction.objects.all())
 
     def resolve_transaction_by_id(self, info, **kwargs):
         id = kwargs.get('id')
         if id is not None:
-            return Transaction.objects.get(pk=id)
+            return shards.find(Transaction.objects.all(), id)
         return None
 
     def resolve_transactions_by_sender(self, info, **kwargs):
         sender = kwargs.get('sender')
         if sender is not None:
-            return Transaction.objects.filter(sender=sender)
+            return shards.fan_out_list(Transaction.objects.filter(sender=sender))
         return None
 
     def resolve_transactions_by_reciever(self, info, **kwargs):
         receiver = kwargs.get('receiver')
         if receiver is not None:
-            return Transaction.objects.filter(receiver=receiver)
+            return shards.fan_out_list(Transaction.objects.filter(receiver=receiver))
         return None
 
     def resolve_transactions_by_time_period(self, info, **kwargs):
@@ -191,13 +367,13 @@ class Query(graphene.ObjectType):
         start_date = kwargs.get('start_date')
         end_date = kwargs.get('end_date')
         if start_date is not None and end_date is not None:
-            return Transaction.objects.filter(created_at__range=[start_date, end_date])
+            return shards.fan_out_list(Transaction.objects.filter(created_at__range=[start_date, end_date]))
         return None
 
     def resolve_transactions_by_currency(self, info, **kwargs):
         currency = kwargs.get('currency')
         if currency is not None:
-            return Transaction.objects.filter(currency=currency)
+            return shards.by_currency(Transaction.objects.all(), currency)
         return None
 
     def resolve_all_currencies(self, info, **kwargs):
@@ -0,0 +1,418 @@
+"""
+Ledger sharding by currency.
+
+The wallets, transactions and balance checkpoints of a currency live in
+one database of ``LEDGER_SHARDS``, the shard its CurrencyPlacement names.
+Users, currencies and everything else stay in ``default``, which is also
+the first shard and holds the currencies without a placement. With a
+single shard nothing is looked up and every query runs on ``default`` as
+before.
+
+ShardRouter sends the reads and writes of a wallet or transaction instance,
+and of the ledger rows reached from a currency, wallet or transaction, to
+the shard of their currency. Queries that only know a currency use
+for_currency(), queries by id or user fan out over every shard. Placements
+are cached per process for ``PLACEMENT_TTL`` seconds.
+
+Ledger ids are unique across the shards so the rows can move: they are
+handed out in blocks of ``ID_BLOCK`` from a LedgerSequence row of
+``default`` instead of each shard's own sequence.
+
+move_currency() moves a currency to another shard while it stays in use.
+The rows are copied in chunks, then writes to the currency are refused
+(LedgerMoving) for about ``PLACEMENT_TTL`` seconds while the rows written
+meanwhile are copied, the rows deleted meanwhile are dropped from the
+target and the placement switches, and the old copy is deleted once no
+process can still read it.
+"""
+import threading
+import time
+from collections import defaultdict
+from itertools import chain
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, Sum
+
+DEFAULTS = {
+    # seconds a process trusts its cached placement of a currency
+    'PLACEMENT_TTL': 5,
+    'ID_BLOCK': 100,
+    'MOVE_CHUNK_SIZE': 1000,
+    # seconds between two copied or deleted chunks, lets other writers in
+    'MOVE_PAUSE': 0.05,
+}
+
+PRIMARY = 'default'
+
+LEDGER_MODELS = ('api.wallet', 'api.transaction', 'api.balancecheckpoint')
+
+
+class LedgerMoving(Exception):
+    """The currency is being moved to another shard, its ledger is read-only."""
+
+
+def shard_settings():
+    return {**DEFAULTS, **getattr(settings, 'SHARDING', {})}
+
+
+def shards():
+    return list(getattr(settings, 'LEDGER_SHARDS', [PRIMARY]))
+
+
+def is_sharded():
+    return len(shards()) > 1
+
+
+def is_ledger(model):
+    return model._meta.label_lower in LEDGER_MODELS
+
+
+class Placements:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, currency_id):
+        """Return (shard, moving) for the currency."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(currency_id)
+        if entry is not None and now - entry[2] < shard_settings()['PLACEMENT_TTL']:
+            return entry[0], entry[1]
+
+        from .models import CurrencyPlacement
+
+        # always from the primary, a replica may not know a new placement yet
+        row = (CurrencyPlacement.objects.using(PRIMARY).filter(currency_id=currency_id)
+               .values_list('shard', 'moving').first())
+        shard, moving = row or (PRIMARY, False)
+        with self._lock:
+            self._entries[currency_id] = (shard, moving, now)
+        return shard, moving
+
+    def forget(self, currency_id=None):
+        with self._lock:
+            if currency_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(currency_id, None)
+
+
+placements = Placements()
+
+
+def for_currency(currency_id, write=False):
+    """Return the shard holding the ledger of the currency."""
+    if not is_sharded() or currency_id is None:
+        return PRIMARY
+    shard, moving = placements.get(int(currency_id))
+    if write and moving:
+        raise LedgerMoving(f'Currency {currency_id} is moving to another shard')
+    return shard
+
+
+def place(currency):
+    """Place a new currency on the shard holding the fewest currencies."""
+    from .models import CurrencyPlacement
+
+    if not is_sharded():
+        return PRIMARY
+    counts = dict(CurrencyPlacement.objects.using(PRIMARY).values_list('shard')
+                  .order_by().annotate(Count('currency')))
+    shard = min(shards(), key=lambda alias: (counts.get(alias, 0), shards().index(alias)))
+    CurrencyPlacement.objects.using(PRIMARY).update_or_create(
+        currency_id=currency.pk, defaults={'shard': shard, 'moving': False})
+    placements.forget(currency.pk)
+    return shard
+
+
+def fan_out(queryset):
+    """Return a ledger ``queryset`` on every shard."""
+    if not is_sharded() or not is_ledger(queryset.model):
+        return [queryset]
+    return [queryset.using(alias) for alias in shards()]
+
+
+def belongs(row, alias):
+    """
+    Whether ``row``, read from ``alias``, is on the shard of its currency.
+    While move_currency() runs, the rows of the currency are on both shards.
+    """
+    if not is_sharded() or not is_ledger(type(row)):
+        return True
+    return for_currency(row.currency_id) == alias
+
+
+def fan_out_list(queryset):
+    return [row for shard_queryset in fan_out(queryset) for row in shard_queryset
+            if belongs(row, shard_queryset.db)]
+
+
+def on_shard(queryset, currency_id):
+    """Return a ledger ``queryset`` on the shard of the currency."""
+    if not is_sharded():
+        # left to the routers, reads may go to a replica
+        return queryset
+    return queryset.using(for_currency(currency_id))
+
+
+def by_currency(queryset, currency_id):
+    return on_shard(queryset.filter(currency_id=currency_id), currency_id)
+
+
+def find(queryset, pk):
+    """Return the row ``pk`` of ``queryset`` from whichever shard holds it."""
+    for shard_queryset in fan_out(queryset):
+        row = shard_queryset.filter(pk=pk).first()
+        if row is not None and belongs(row, shard_queryset.db):
+            return row
+    raise queryset.model.DoesNotExist(f'{queryset.model.__name__} matching query does not exist.')
+
+
+def in_bulk(queryset, ids, users=False):
+    """Return {id: row} for the rows ``ids`` of every shard, wallets optionally with their users."""
+    rows = {}
+    for shard_queryset in fan_out(queryset):
+        if users:
+            found = with_users(shard_queryset.filter(pk__in=ids))
+        else:
+            found = shard_queryset.in_bulk(ids).values()
+        rows.update((row.pk, row) for row in found if belongs(row, shard_queryset.db))
+    return rows
+
+
+def with_users(queryset):
+    """Evaluate a wallet ``queryset`` with the users of its wallets attached."""
+    if queryset.db == PRIMARY or queryset.db not in shards():
+        # the primary or one of its replicas, which have the users
+        return list(queryset.select_related('user'))
+    from . import usercache
+
+    wallets = list(queryset)
+    for wallet in wallets:
+        # the users live on the primary, the user cache spares a query per wallet
+        wallet.user = usercache.get_user(wallet.user_id)
+    return wallets
+
+
+class IdBlocks:
+    """Hands out ids of a ledger model reserved in blocks from its LedgerSequence."""
+
+    def __init__(self):
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def take(self, model, count=1):
+        label = model._meta.label_lower
+        ids = []
+        with self._lock:
+            while len(ids) < count:
+                start, end = self._blocks.get(label, (0, 0))
+                if start >= end:
+                    size = max(shard_settings()['ID_BLOCK'], count - len(ids))
+                    start = self._reserve(model, label, size)
+                    end = start + size
+                taken = min(end - start, count - len(ids))
+                ids.extend(range(start, start + taken))
+                self._blocks[label] = (start + taken, end)
+        return ids
+
+    def _reserve(self, model, label, size):
+        from .models import LedgerSequence
+
+        sequences = LedgerSequence.objects.using(PRIMARY)
+        while True:
+            with transaction.atomic(using=PRIMARY):
+                if sequences.filter(name=label).update(next=F('next') + size):
+                    return sequences.values_list('next', flat=True).get(name=label) - size
+                # the first block starts after every row written before sharding
+                start = 1 + max(
+                    model.objects.using(alias).aggregate(last=Max('id'))['last'] or 0
+                    for alias in shards())
+                try:
+                    with transaction.atomic(using=PRIMARY):
+                        sequences.create(name=label, next=start + size)
+                except IntegrityError:
+                    continue
+                return start
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+
+ids = IdBlocks()
+
+
+def assign_ids(rows):
+    """Give unsaved ledger rows their ids, when the ledger is sharded."""
+    rows = [row for row in rows if row.pk is None]
+    if not rows or not is_sharded():
+        return []
+    for row, pk in zip(rows, ids.take(type(rows[0]), len(rows))):
+        row.pk = pk
+    return rows
+
+
+class ShardRouter:
+    def _ledger_db(self, model, hints, write):
+        if not is_ledger(model) or not is_sharded():
+            return None
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if is_ledger(type(instance)) or instance._meta.label_lower == 'api.currency':
+            currency_id = instance.pk if not is_ledger(type(instance)) else instance.currency_id
+            return for_currency(currency_id, write=write)
+        # a user's wallets span the shards, see fan_out()
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._ledger_db(model, hints, write=False)
+
+    def db_for_write(self, model, **hints):
+        return self._ledger_db(model, hints, write=True)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # ledger rows point to users and currencies of the primary
+        if is_ledger(type(obj1)) or is_ledger(type(obj2)):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == PRIMARY or db not in shards():
+            return None
+        # the other shards hold only the ledger tables
+        return f'{app_label}.{model_name}' in LEDGER_MODELS
+
+
+def _copy_missing(model, source, target, ids, update_fields=None):
+    """Copy the rows ``ids`` of ``source`` missing from ``target``, optionally updating the others."""
+    present = set(model.objects.using(target).filter(pk__in=ids).values_list('pk', flat=True))
+    missing = [pk for pk in ids if pk not in present]
+    if missing:
+        model.objects.using(target).bulk_create(model.objects.using(source).filter(pk__in=missing))
+    if present and update_fields:
+        model.objects.using(target).bulk_update(
+            model.objects.using(source).filter(pk__in=present), update_fields)
+    return len(missing)
+
+
+def _delete_removed(model, source, target, currency_id, chunk_size):
+    """Delete the rows of ``target`` that no longer exist on ``source``, return their number."""
+    removed, after = 0, 0
+    while True:
+        chunk = list(model.objects.using(target).filter(currency_id=currency_id, id__gt=after)
+                     .order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not chunk:
+            return removed
+        present = set(model.objects.using(source).filter(pk__in=chunk).values_list('pk', flat=True))
+        gone = [pk for pk in chunk if pk not in present]
+        if gone:
+            with transaction.atomic(using=target):
+                model.objects.using(target).filter(pk__in=gone).delete()
+            removed += len(gone)
+        after = chunk[-1]
+
+
+def move_currency(currency_id, target, chunk_size=None, pause=None, log=None):
+    """
+    Move the wallets, transactions and balance checkpoints of a currency to
+    the shard ``target``, return the number of rows copied.
+    """
+    from .models import BalanceCheckpoint, CurrencyPlacement, Transaction, Wallet
+
+    config = shard_settings()
+    chunk_size = chunk_size or config['MOVE_CHUNK_SIZE']
+    pause = config['MOVE_PAUSE'] if pause is None else pause
+    log = log or (lambda message: None)
+    if target not in shards():
+        raise ValueError(f'{target} is not a ledger shard')
+    placements.forget(currency_id)
+    source = for_currency(currency_id)
+    if source == target:
+        return 0
+    wallet_fields = [field.name for field in Wallet._meta.concrete_fields if not field.primary_key]
+
+    def copy(model, update_fields=None):
+        # ids come in blocks per process, not in insertion order, so every
+        # pass compares all the ids instead of starting from the last one
+        copied, after = 0, 0
+        while True:
+            chunk = list(model.objects.using(source).filter(currency_id=currency_id, id__gt=after)
+                         .order_by('id').values_list('id', flat=True)[:chunk_size])
+            if not chunk:
+                return copied
+            with transaction.atomic(using=target):
+                if model is Transaction:
+                    wallet_ids = set(chain.from_iterable(
+                        Transaction.objects.using(source).filter(id__in=chunk)
+                        .values_list('sender_id', 'receiver_id')))
+                    copied += _copy_missing(Wallet, source, target, list(wallet_ids))
+                copied += _copy_missing(model, source, target, chunk, update_fields)
+            after = chunk[-1]
+            if pause:
+                time.sleep(pause)
+
+    # 1. copy while the currency stays writable
+    copied = copy(Wallet) + copy(Transaction) + copy(BalanceCheckpoint)
+    log(f'copied {copied} rows, freezing writes')
+
+    # 2. refuse writes until every process has seen the freeze, then catch up
+    CurrencyPlacement.objects.using(PRIMARY).update_or_create(
+        currency_id=currency_id, defaults={'shard': source, 'moving': True})
+    placements.forget(currency_id)
+    time.sleep(config['PLACEMENT_TTL'])
+    try:
+        copied += copy(Wallet, update_fields=wallet_fields) + copy(Transaction) + copy(BalanceCheckpoint)
+        # rows deleted since they were copied must not come back after the switch
+        removed = sum(_delete_removed(model, source, target, currency_id, chunk_size)
+                      for model in (Transaction, BalanceCheckpoint, Wallet))
+        log(f'deleted {removed} rows removed during the copy')
+        # 3. switch
+        CurrencyPlacement.objects.using(PRIMARY).filter(currency_id=currency_id).update(
+            shard=target, moving=False)
+    except Exception:
+        CurrencyPlacement.objects.using(PRIMARY).filter(currency_id=currency_id).update(moving=False)
+        raise
+    finally:
+        placements.forget(currency_id)
+    log(f'switched to {target}, copied {copied} rows')
+
+    # 4. delete the old copy once no process can still read it
+    time.sleep(config['PLACEMENT_TTL'])
+    _delete_copy(Transaction, source, currency_id, chunk_size, pause)
+    _delete_copy(BalanceCheckpoint, source, currency_id, chunk_size, pause)
+    _delete_copy(Wallet, source, currency_id, chunk_size, pause)
+    return copied
+
+
+def _delete_copy(model, source, currency_id, chunk_size, pause):
+    while True:
+        chunk = list(model.objects.using(source).filter(currency_id=currency_id)
+                     .values_list('id', flat=True)[:chunk_size])
+        if not chunk:
+            return
+        with transaction.atomic(using=source):
+            model.objects.using(source).filter(id__in=chunk).delete()
+        if pause:
+            time.sleep(pause)
+
+
+def counters(currency_ids=None):
+    """Return {currency id: (supply, holders)} summed from the wallets of every shard."""
+    from .models import Wallet
+
+    totals = defaultdict(lambda: (0, 0))
+    wallets = Wallet.objects.all()
+    if currency_ids is not None:
+        wallets = wallets.filter(currency_id__in=currency_ids)
+    for shard_wallets in fan_out(wallets.values('currency').order_by()
+                                 .annotate(supply=Sum('balance'), holders=Count('id'))):
+        for total in shard_wallets:
+            if for_currency(total['currency']) != shard_wallets.db:
+                continue
+            supply, holders = totals[total['currency']]
+            totals[total['currency']] = (supply + total['supply'], holders + total['holders'])
+    return dict(totals)
@@ -0,0 +1,65 @@
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+from . import blacklist, leaderboard, shards, tokens, usercache
+from .models import Currency, Transaction, User, Wallet
+
+
+@receiver(post_delete, sender=Wallet)
+def wallet_deleted(sender, instance, using, **kwargs):
+    # also runs for cascades from a deleted user or currency, but not for the
+    # copy a moved currency leaves on its old shard
+    if using != shards.for_currency(instance.currency_id):
+        return
+    Currency.objects.filter(pk=instance.currency_id).update(
+        circulating_supply=F('circulating_supply') - instance.balance,
+        holder_count=F('holder_count') - 1)
+    # the deletion clears the pk before the commit
+    currency_id, wallet_id = instance.currency_id, instance.pk
+    transaction.on_commit(lambda: leaderboard.boards.remove(currency_id, wallet_id), using=using)
+
+
+@receiver(post_save, sender=Wallet)
+def wallet_saved(sender, instance, created, update_fields, using, **kwargs):
+    # transfers move the boards themselves, see api/transfers.py
+    if not created and update_fields is not None and 'balance' not in update_fields:
+        return
+    currency_id, balances = instance.currency_id, [(instance.pk, instance.balance)]
+    transaction.on_commit(lambda: leaderboard.boards.update(currency_id, balances), using=using)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    usercache.invalidate(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    # tokens of a deleted user are never current
+    tokens.forget_version(instance.pk)
+
+
+@receiver(post_save, sender=BlacklistedToken)
+def token_blacklisted(sender, instance, created, **kwargs):
+    if created:
+        blacklist.jtis.add(instance.token.jti, instance.token.expires_at)
+
+
+@receiver(pre_delete, sender=Currency)
+def currency_deleting(sender, instance, **kwargs):
+    # the cascade only reaches the ledger rows on the primary
+    using = shards.for_currency(instance.pk)
+    if using != shards.PRIMARY:
+        Transaction.objects.using(using).filter(currency_id=instance.pk).delete()
+        Wallet.objects.using(using).filter(currency_id=instance.pk).delete()
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, **kwargs):
+    for using in shards.shards():
+        if using != shards.PRIMARY:
+            Wallet.objects.using(using).filter(user_id=instance.pk).delete()
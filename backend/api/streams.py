@@ -0,0 +1,114 @@
+"""
+Server-sent event stream of wallet events, served by the ASGI application.
+
+``GET /api/events/stream`` authenticates with the usual access token, in the
+Authorization header or, since EventSource can not set headers, in the
+``token`` query parameter. It sends the current balance of every wallet of
+the user (or of the wallets named by ``wallet`` parameters) and then the
+``transaction`` and ``balance`` events of those wallets as they happen, so
+clients no longer poll for incoming transfers.
+"""
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+from . import events, shards
+from .models import Wallet
+
+EVENT_STREAM_PATH = '/api/events/stream'
+
+
+def authenticate(headers, params):
+    authentication = JWTAuthentication()
+    raw_token = None
+    header = headers.get(b'authorization')
+    if header:
+        raw_token = authentication.get_raw_token(header)
+    elif params.get('token'):
+        raw_token = params['token'][0].encode('utf-8')
+    if raw_token is None:
+        return None
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+
+def user_wallets(user, wallet_ids=None):
+    """Return {wallet id: balance} for the wallets of ``user`` that are streamed."""
+    wallets = Wallet.objects.filter(user=user)
+    if wallet_ids:
+        try:
+            wallets = wallets.filter(id__in=[int(wallet_id) for wallet_id in wallet_ids])
+        except ValueError:
+            return {}
+    return {wallet.id: wallet.balance for wallet in shards.fan_out_list(wallets.only('balance', 'currency_id'))}
+
+
+def format_event(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n".encode('utf-8')
+
+
+async def send_json(send, status, data):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json')],
+    })
+    await send({'type': 'http.response.body', 'body': json.dumps(data).encode('utf-8')})
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def event_stream(scope, receive, send):
+    if scope['method'] != 'GET':
+        return await send_json(send, 405, {'message': 'Method not allowed'})
+
+    params = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    headers = dict(scope['headers'])
+    user = await sync_to_async(authenticate)(headers, params)
+    if user is None:
+        return await send_json(send, 401, {'message': 'Authentication credentials were not provided or are invalid'})
+    balances = await sync_to_async(user_wallets)(user, params.get('wallet'))
+    if not balances:
+        return await send_json(send, 404, {'message': 'No wallets to stream'})
+
+    heartbeat = events.events_settings()['HEARTBEAT']
+    subscription = events.get_broker().subscribe(events.wallet_channel(wallet_id) for wallet_id in balances)
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        snapshot = b''.join(
+            format_event({'type': 'balance', 'data': {'wallet': wallet_id, 'balance': balance}})
+            for wallet_id, balance in balances.items())
+        await send({'type': 'http.response.body', 'body': snapshot, 'more_body': True})
+
+        while not disconnect.done():
+            next_event = asyncio.ensure_future(subscription.get(heartbeat))
+            await asyncio.wait({next_event, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_event.done():
+                next_event.cancel()
+                break
+            event = next_event.result()
+            body = format_event(event) if event is not None else b': keep-alive\n\n'
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    finally:
+        subscription.close()
+        disconnect.cancel()
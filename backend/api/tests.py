@@ -1,11 +1,39 @@
+import csv
 import email
-from django.test import TestCase
+import gzip
+import json
+import os
+import sqlite3
+import tempfile
+from io import StringIO
+from unittest import mock
+from datetime import timedelta
+from django.core.cache import caches
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from django.core.management import CommandError, call_command
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.test import AsyncClient, AsyncRequestFactory, RequestFactory, TestCase, override_settings
 from rest_framework.test import APIClient
 from rest_framework import status
 from django.urls import reverse
 from django.core.signing import Signer
 # from django.contrib.auth.
 from .models import *
+from . import async_views, blacklist, checkpoints, events, exports, imports, keycache, keypool, leaderboard, rollups, routers, shards, tokens, transfers, usercache
+from .schema import schema
+from . import documents, query_cost
+from graphql import parse
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from rest_framework_simplejwt.tokens import AccessToken
+from .streams import EVENT_STREAM_PATH, event_stream
+from .authentication import CachedJWTAuthentication
+from .middleware import WebSessionMiddleware
+from .db.sqlite_tuned import base as sqlite_tuned
 
 # Create your tests here.
 
@@ -312,6 +340,19 @@ class CurrencyAPITestCase(TestCase):
         self.assertEqual(response.data['initial_balance'], 0)
         self.assertEqual(response.data['market_cap'], 100)
 
+    def test_api_rejects_a_duplicate_symbol(self):
+        """Test the api refuses a symbol that is already used."""
+        url = reverse('currency')
+        data = {
+            'name': "Bitcoin Cash",
+            'symbol': "BTC",
+            'initial_balance': 100
+        }
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.auth_token.data['access'])
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_api_try_create_a_currency_without_login(self):
         """Test the api has currency creation capability."""
         url = reverse('currency')
@@ -928,4 +969,1859 @@ class TransactionAPITestCase(TestCase):
         self.client.credentials(
             HTTP_AUTHORIZATION='Bearer ' + self.auth_token.data['access'])
         response = self.client.post(url, data, format='json')
-        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class KeyPoolTestCase(TestCase):
+    """Test the pre-generated RSA key pool."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email="test@example.com",
+            password='testpassword'
+        )
+        self.currency = Currency(
+            name='Bitcoin',
+            symbol='BTC',
+            admin=self.user
+        )
+        self.currency.save()
+
+    def test_wallet_takes_key_from_pool(self):
+        """Test a new wallet uses a pooled key and removes it from the pool."""
+        keypool.refill(1, workers=0)
+        pooled = PooledKey.objects.get()
+        wallet = Wallet(user=self.user, currency=self.currency)
+        wallet.save()
+        self.assertEqual(wallet.publickey, pooled.publickey)
+        self.assertEqual(wallet.privatekey, pooled.privatekey)
+        self.assertEqual(PooledKey.objects.count(), 0)
+
+    def test_wallet_generates_key_when_pool_is_empty(self):
+        """Test a wallet still gets a key when the pool is empty."""
+        wallet = Wallet(user=self.user, currency=self.currency)
+        wallet.save()
+        self.assertIsNotNone(wallet.publickey)
+        self.assertIsNotNone(wallet.privatekey)
+
+    def test_stats_report_depth(self):
+        """Test the pool stats report the pool depth and refill rate."""
+        keypool.refill(2, workers=0)
+        stats = keypool.stats()
+        self.assertEqual(stats['depth'], 2)
+        self.assertGreater(stats['refill_rate'], 0)
+
+    def test_refill_rate_counts_taken_keys(self):
+        """Test keys already taken from the pool still count toward the refill rate."""
+        keypool.refill(2, workers=0)
+        keypool.take()
+        keypool.take()
+        stats = keypool.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['generated'], 2)
+        self.assertGreater(stats['refill_rate'], 0)
+
+    def test_old_refills_leave_the_rate(self):
+        """Test refills older than the rate window are not counted and are pruned."""
+        keypool.refill(1, workers=0)
+        KeyRefill.objects.update(created_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(keypool.stats()['refill_rate'], 0)
+        keypool.refill(1, workers=0)
+        self.assertEqual(KeyRefill.objects.count(), 1)
+
+
+class KeyCacheTestCase(TestCase):
+    """Test the parsed key cache used for signing."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email="test@example.com",
+            password='testpassword'
+        )
+        self.user2 = User.objects.create_user(
+            username='testuser2',
+            email="test2@example.com",
+            password='testpassword'
+        )
+        self.currency = Currency(
+            name='Bitcoin',
+            symbol='BTC',
+            admin=self.user
+        )
+        self.currency.save()
+        self.wallet = Wallet(user=self.user, currency=self.currency, balance=1000)
+        self.wallet.save()
+        self.wallet2 = Wallet(user=self.user2, currency=self.currency, balance=1000)
+        self.wallet2.save()
+        keycache.cache.clear()
+
+    def test_repeated_signing_hits_cache(self):
+        """Test a wallet's key is only parsed once."""
+        self.wallet.sign("first")
+        self.wallet.sign("second")
+        stats = keycache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_key_change_invalidates_cache(self):
+        """Test a new key for the wallet is parsed again."""
+        self.wallet.sign("first")
+        old_signer = keycache.signer(self.wallet)
+        self.wallet.generateKey()
+        self.assertIsNot(keycache.signer(self.wallet), old_signer)
+
+    def test_transaction_signature_is_valid(self):
+        """Test the sender signature of a transaction can be verified."""
+        transaction = Transaction(
+            sender=self.wallet, receiver=self.wallet2, amount=100, currency=self.currency)
+        transaction.save()
+        self.assertIsNone(transaction.validate_signature())
+
+
+class TransferServiceTestCase(TestCase):
+    """Test the transfer service used by transactions."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email="test@example.com",
+            password='testpassword'
+        )
+        self.user2 = User.objects.create_user(
+            username='testuser2',
+            email="test2@example.com",
+            password='testpassword'
+        )
+        self.currency = Currency(
+            name='Bitcoin',
+            symbol='BTC',
+            admin=self.user
+        )
+        self.currency.save()
+        self.wallet = Wallet(user=self.user, currency=self.currency, balance=1000)
+        self.wallet.save()
+        self.wallet2 = Wallet(user=self.user2, currency=self.currency, balance=1000)
+        self.wallet2.save()
+
+    def test_transfer_records_snapshots(self):
+        """Test a transfer stores the balances before and after."""
+        transaction = transfers.transfer(
+            self.wallet.id, self.wallet2.id, 100, self.currency.id)
+        transaction = Transaction.objects.get(id=transaction.id)
+        self.assertEqual(transaction.before_sender_amount_snapshot, 1000)
+        self.assertEqual(transaction.before_receiver_amount_snapshot, 1000)
+        self.assertEqual(transaction.after_sender_amount_snapshot, 900)
+        self.assertEqual(transaction.after_receiver_amount_snapshot, 1100)
+
+    def test_transfer_uses_stored_balance(self):
+        """Test a transfer checks the stored balance, not a stale instance."""
+        Wallet.objects.filter(id=self.wallet.id).update(balance=50)
+        with self.assertRaises(transfers.InsufficientFunds):
+            Transaction(sender=self.wallet, receiver=self.wallet2,
+                        amount=100, currency=self.currency).save()
+        self.assertEqual(Transaction.objects.count(), 0)
+        self.assertEqual(Wallet.objects.get(id=self.wallet2.id).balance, 1000)
+
+    def test_transfer_round_trips(self):
+        """Test a transfer is one read and two writes inside its savepoint."""
+        # parse the keys up front so only the queries are measured
+        self.wallet.sign("warm up")
+        self.wallet2.sign("warm up")
+        with self.assertNumQueries(5):
+            transfers.transfer(
+                self.wallet.id, self.wallet2.id, 100, self.currency.id)
+
+    def test_transfer_checks_owner(self):
+        """Test a transfer refuses a sender wallet of another user."""
+        with self.assertRaises(transfers.NotWalletOwner):
+            transfers.transfer(self.wallet2.id, self.wallet.id,
+                               100, self.currency.id, user=self.user)
+
+
+class TransactionBatchAPITestCase(TestCase):
+    """Test the batch transaction api."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email="test@example.com",
+            password='testpassword'
+        )
+        self.user2 = User.objects.create_user(
+            username='testuser2',
+            email="test2@example.com",
+            password='testpassword'
+        )
+        self.currency = Currency(
+            name='Bitcoin',
+            symbol='BTC',
+            admin=self.user
+        )
+        self.currency.save()
+        self.wallet = Wallet(user=self.user, currency=self.currency, balance=1000)
+        self.wallet.save()
+        self.wallet2 = Wallet(user=self.user2, currency=self.currency, balance=1000)
+        self.wallet2.save()
+
+        self.client = APIClient()
+        self.auth_token = self.client.post(
+            reverse('login'),
+            {'username': 'testuser', 'password': 'testpassword'},
+            format='json'
+        )
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.auth_token.data['access'])
+
+    def transfer(self, amount, sender=None):
+        return {
+            'sender': (sender or self.wallet).id,
+            'receiver': self.wallet2.id,
+            'amount': amount,
+            'currency': self.currency.id
+        }
+
+    def test_batch_applies_all_transfers(self):
+        """Test every transfer of a batch is applied."""
+        url = reverse('transaction_batch')
+        data = {'transfers': [self.transfer(100), self.transfer(200)]}
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['applied'], 2)
+        self.assertEqual(Transaction.objects.count(), 2)
+        self.assertEqual([result['transaction']['id'] for result in response.data['results']],
+                         list(Transaction.objects.order_by('id').values_list('id', flat=True)))
+        self.assertEqual(Wallet.objects.get(id=self.wallet.id).balance, 700)
+        self.assertEqual(Wallet.objects.get(id=self.wallet2.id).balance, 1300)
+
+        snapshots = Transaction.objects.order_by('id').values_list(
+            'before_sender_amount_snapshot', 'after_sender_amount_snapshot')
+        self.assertEqual(list(snapshots), [(1000, 900), (900, 700)])
+
+    def test_atomic_batch_rejects_everything(self):
+        """Test one invalid transfer rejects an atomic batch."""
+        url = reverse('transaction_batch')
+        data = {'transfers': [self.transfer(600), self.transfer(600)]}
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['results'][1]['message'], 'Insufficient funds')
+        self.assertEqual(Transaction.objects.count(), 0)
+        self.assertEqual(Wallet.objects.get(id=self.wallet.id).balance, 1000)
+
+    def test_best_effort_batch_skips_invalid(self):
+        """Test a best effort batch applies the valid transfers."""
+        url = reverse('transaction_batch')
+        data = {
+            'mode': 'best_effort',
+            'transfers': [self.transfer(600), self.transfer(600), self.transfer(10, self.wallet2)]
+        }
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(
+            [result['status'] for result in response.data['results']], ['ok', 'error', 'error'])
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(Wallet.objects.get(id=self.wallet.id).balance, 400)
+        self.assertEqual(Wallet.objects.get(id=self.wallet2.id).balance, 1600)
+
+    def test_batch_losing_a_race_is_rejected(self):
+        """Test a batch whose guarded update finds a drained wallet returns its error, not a server error."""
+        url = reverse('transaction_batch')
+        data = {'mode': 'best_effort', 'transfers': [self.transfer(100)]}
+        with mock.patch.object(transfers, '_apply_balances', side_effect=transfers.InsufficientFunds('Insufficient funds')):
+            response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['message'], 'Insufficient funds')
+        self.assertEqual(Transaction.objects.count(), 0)
+
+
+class CurrencySupplyTestCase(TestCase):
+    """Test the circulating supply counters of a currency."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email="test@example.com",
+            password='testpassword'
+        )
+        self.user2 = User.objects.create_user(
+            username='testuser2',
+            email="test2@example.com",
+            password='testpassword'
+        )
+        self.currency = Currency(
+            name='Bitcoin',
+            symbol='BTC',
+            admin=self.user,
+            market_cap=2000
+        )
+        self.currency.save()
+
+    def test_admin_wallet_is_counted(self):
+        """Test the admin wallet is counted when a currency is created."""
+        self.assertEqual(self.currency.circulating_supply, 2000)
+        self.assertEqual(self.currency.holder_count, 1)
+
+    def test_wallet_create_and_delete_update_counters(self):
+        """Test creating and deleting a wallet moves the counters."""
+        wallet = Wallet(user=self.user2, currency=self.currency, balance=300)
+        wallet.save()
+        self.currency.refresh_from_db()
+        self.assertEqual(self.currency.circulating_supply, 2300)
+        self.assertEqual(self.currency.holder_count, 2)
+        self.assertFalse(self.currency.validate_cap())
+
+        wallet.delete()
+        self.currency.refresh_from_db()
+        self.assertEqual(self.currency.circulating_supply, 2000)
+        self.assertEqual(self.currency.holder_count, 1)
+        self.assertTrue(self.currency.validate_cap())
+
+    def test_deposit_and_withdraw_update_counters(self):
+        """Test deposits and withdrawals move the supply, the running totals and the board."""
+        wallet = Wallet(user=self.user2, currency=self.currency, balance=0)
+        wallet.save()
+        leaderboard.boards.forget()
+        leaderboard.top(self.currency.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(wallet.deposit(3000), 3000)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(wallet.withdraw(500), 2500)
+        self.assertEqual(wallet.withdraw(5000), 2500)
+        self.currency.refresh_from_db()
+        self.assertEqual(self.currency.circulating_supply, 4500)
+        self.assertTrue(wallet.validate_amount())
+        self.assertFalse(self.currency.unreconciled_wallets().exists())
+        self.assertEqual(leaderboard.top(self.currency.id)[0].wallet_id, wallet.id)
+
+    def test_transfer_keeps_supply(self):
+        """Test a transfer does not change the supply."""
+        wallet = Wallet(user=self.user2, currency=self.currency, balance=0)
+        wallet.save()
+        transfers.transfer(self.currency.get_admin_wallet().id,
+                           wallet.id, 500, self.currency.id)
+        self.currency.save()
+        self.currency.refresh_from_db()
+        self.assertEqual(self.currency.circulating_supply, 2000)
+
+    def test_reconcile_command_fixes_drift(self):
+        """Test the reconcile command reports and repairs drift."""
+        Currency.objects.filter(pk=self.currency.pk).update(circulating_supply=5)
+        out = StringIO()
+        call_command('reconcile_ledger', '--fix', '--chunk-size', '1', stdout=out)
+        self.assertIn('1 counters drifted', out.getvalue())
+        self.currency.refresh_from_db()
+        self.assertEqual(self.currency.circulating_supply, 2000)
+
+
+class WalletReconciliationTestCase(TestCase):
+    """Test the running totals used to reconcile wallets."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email="test@example.com",
+            password='testpassword'
+        )
+        self.user2 = User.objects.create_user(
+            username='testuser2',
+            email="test2@example.com",
+            password='testpassword'
+        )
+        self.currency = Currency(
+            name='Bitcoin',
+            symbol='BTC',
+            admin=self.user
+        )
+        self.currency.save()
+        self.wallet = Wallet(user=self.user, currency=self.currency, balance=1000)
+        self.wallet.save()
+        self.wallet2 = Wallet(user=self.user2, currency=self.currency, balance=1000)
+        self.wallet2.save()
+
+    def test_transfers_keep_wallets_reconciled(self):
+        """Test single and batch transfers keep the running totals."""
+        transfers.transfer(self.wallet.id, self.wallet2.id, 100, self.currency.id)
+        transfers.transfer_batch([
+            {'sender': self.wallet2.id, 'receiver': self.wallet.id,
+             'amount': 30, 'currency': self.currency.id},
+            {'sender': self.wallet.id, 'receiver': self.wallet2.id,
+             'amount': 10, 'currency': self.currency.id},
+        ])
+        wallet = Wallet.objects.get(id=self.wallet.id)
+        self.assertEqual(wallet.opening_balance, 1000)
+        self.assertEqual(wallet.total_sent, 110)
+        self.assertEqual(wallet.total_received, 30)
+        self.assertTrue(wallet.validate_amount())
+        self.assertTrue(Wallet.objects.get(id=self.wallet2.id).validate_amount())
+
+    def test_direct_balance_change_is_detected(self):
+        """Test a balance changed outside a transfer fails the check."""
+        self.wallet.balance = 5000
+        self.wallet.save()
+        self.assertFalse(self.wallet.validate_amount())
+        with self.assertNumQueries(1):
+            unreconciled = list(self.currency.unreconciled_wallets())
+        self.assertEqual(unreconciled, [self.wallet])
+
+    def test_save_keeps_running_totals(self):
+        """Test saving a stale wallet does not overwrite its totals."""
+        transfers.transfer(self.wallet.id, self.wallet2.id, 100, self.currency.id)
+        stale = Wallet.objects.get(id=self.wallet2.id)
+        transfers.transfer(self.wallet.id, self.wallet2.id, 100, self.currency.id)
+        stale.save()
+        self.assertEqual(Wallet.objects.get(id=self.wallet2.id).total_received, 200)
+
+    def test_reconcile_command_fixes_running_totals(self):
+        """Test the reconcile command repairs drifted totals chunk by chunk."""
+        transfers.transfer(self.wallet.id, self.wallet2.id, 100, self.currency.id)
+        Wallet.objects.filter(id=self.wallet2.id).update(total_received=7)
+        out = StringIO()
+        call_command('reconcile_ledger', '--fix', '--chunk-size', '1', stdout=out)
+        self.assertIn(f'Wallet {self.wallet2.id}: received 7 != 100', out.getvalue())
+        self.assertIn('1 counters drifted', out.getvalue())
+        self.assertTrue(Wallet.objects.get(id=self.wallet2.id).validate_amount())
+
+
+class QueryPlanTestCase(TestCase):
+    """Test the resolver queries use indexes."""
+
+    def test_resolvers_do_not_scan(self):
+        """Test no resolver does an unexpected full table scan."""
+        out = StringIO()
+        call_command('explain_queries', '--fail', stdout=out)
+        self.assertIn('transactionsByCurrency: ok', out.getvalue())
+
+
+class GraphQLLoaderTestCase(TestCase):
+    """Test nested GraphQL relations are batched."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email="test@example.com",
+            password='testpassword'
+        )
+        self.user2 = User.objects.create_user(
+            username='testuser2',
+            email="test2@example.com",
+            password='testpassword'
+        )
+        self.currency = Currency(
+            name='Bitcoin',
+            symbol='BTC',
+            admin=self.user
+        )
+        self.currency.save()
+        self.wallet = Wallet(user=self.user, currency=self.currency, balance=1000)
+        self.wallet.save()
+        self.wallet2 = Wallet(user=self.user2, currency=self.currency, balance=1000)
+        self.wallet2.save()
+        for amount in (10, 20, 30):
+            transfers.transfer(self.wallet.id, self.wallet2.id, amount, self.currency.id)
+            transfers.transfer(self.wallet2.id, self.wallet.id, amount, self.currency.id)
+
+    def execute(self, query):
+        return schema.execute(query, context_value=RequestFactory().post('/graphql/'))
+
+    def test_nested_transactions_take_one_query_per_level(self):
+        """Test each level of a nested transaction query is one query."""
+        query = """
+            {
+                allTransactions {
+                    sender { user { username } }
+                    receiver { user { username } }
+                    currency { name }
+                }
+            }
+        """
+        with self.assertNumQueries(4):
+            result = self.execute(query)
+        self.assertIsNone(result.errors)
+        self.assertEqual(len(result.data['allTransactions']), 6)
+        self.assertEqual(
+            result.data['allTransactions'][0]['sender']['user']['username'], 'testuser')
+
+    def test_currency_relations_are_batched(self):
+        """Test the reverse relations of currencies are batched."""
+        query = """
+            {
+                allCurrencies {
+                    admin { username }
+                    wallets { user { username } }
+                    transactions { amount }
+                }
+            }
+        """
+        # currencies, admins, wallets, transactions and the wallet users
+        with self.assertNumQueries(5):
+            result = self.execute(query)
+        self.assertIsNone(result.errors)
+        self.assertEqual(len(result.data['allCurrencies'][0]['wallets']), 3)
+        self.assertEqual(len(result.data['allCurrencies'][0]['transactions']), 6)
+
+
+class GraphQLConnectionTestCase(TestCase):
+    """Test the keyset paginated connection fields."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email="test@example.com",
+            password='testpassword'
+        )
+        self.user2 = User.objects.create_user(
+            username='testuser2',
+            email="test2@example.com",
+            password='testpassword'
+        )
+        self.currency = Currency(
+            name='Bitcoin',
+            symbol='BTC',
+            admin=self.user
+        )
+        self.currency.save()
+        self.wallet = Wallet(user=self.user, currency=self.currency, balance=1000)
+        self.wallet.save()
+        self.wallet2 = Wallet(user=self.user2, currency=self.currency, balance=1000)
+        self.wallet2.save()
+        for amount in (1, 2, 3, 4, 5):
+            transfers.transfer(self.wallet.id, self.wallet2.id, amount, self.currency.id)
+
+    def page(self, first, after=None):
+        query = """
+            query ($first: Int, $after: String, $currency: String) {
+                transactionsConnection(first: $first, after: $after, currency: $currency) {
+                    edges { cursor node { amount } }
+                    pageInfo { hasNextPage endCursor }
+                }
+            }
+        """
+        result = schema.execute(query, context_value=RequestFactory().post('/graphql/'), variables={
+            'first': first, 'after': after, 'currency': str(self.currency.id)})
+        self.assertIsNone(result.errors)
+        return result.data['transactionsConnection']
+
+    def test_pages_follow_the_cursor(self):
+        """Test walking the pages returns every transaction once, in order."""
+        amounts, after = [], None
+        while True:
+            page = self.page(2, after)
+            amounts += [edge['node']['amount'] for edge in page['edges']]
+            if not page['pageInfo']['hasNextPage']:
+                break
+            after = page['pageInfo']['endCursor']
+        self.assertEqual(amounts, [1, 2, 3, 4, 5])
+
+    @override_settings(GRAPHENE={'SCHEMA': 'api.schema.schema', 'RELAY_CONNECTION_MAX_LIMIT': 3})
+    def test_page_size_is_capped(self):
+        """Test a page never exceeds the configured maximum."""
+        page = self.page(50)
+        self.assertEqual(len(page['edges']), 3)
+        self.assertTrue(page['pageInfo']['hasNextPage'])
+
+    def test_invalid_cursor_is_rejected(self):
+        """Test a malformed cursor is an error."""
+        result = schema.execute(
+            '{ transactionsConnection(after: "bogus") { edges { cursor } } }',
+            context_value=RequestFactory().post('/graphql/'))
+        self.assertIsNotNone(result.errors)
+
+
+class GraphQLLimitsTestCase(TestCase):
+    """Test the depth and cost limits of the GraphQL endpoint."""
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def post(self, query, variables=None):
+        return self.client.post('/graphql/', {'query': query, 'variables': variables}, format='json')
+
+    def test_cost_counts_page_sizes(self):
+        """Test the estimated cost multiplies by the requested page size."""
+        document = parse('{ transactionsConnection(first: 10) { edges { node { amount } } } }')
+        # connection + 10 * (edges + node + amount)
+        self.assertEqual(query_cost.QueryAnalysis(schema, document).cost(), 31)
+
+    @override_settings(GRAPHQL_LIMITS={'MAX_DEPTH': 3})
+    def test_deep_query_is_rejected(self):
+        """Test a query nested deeper than the limit does not run."""
+        response = self.post('{ allCurrencies { wallets { user { username } } } }')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('depth', response.json()['errors'][0]['message'])
+
+    @override_settings(GRAPHQL_LIMITS={'MAX_COST': 1000})
+    def test_expensive_query_is_rejected(self):
+        """Test a query over the cost budget does not run."""
+        response = self.post('{ allCurrencies { wallets { user { username } } } }')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('cost', response.json()['errors'][0]['message'])
+
+    def test_cheap_query_runs(self):
+        """Test a query within the limits runs and uses variables for page sizes."""
+        response = self.post(
+            'query ($first: Int) { currenciesConnection(first: $first) { edges { node { name } } } }',
+            {'first': 5})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['data']['currenciesConnection']['edges'], [])
+
+
+class GraphQLDocumentsTestCase(TestCase):
+    """Test the parsed document cache and persisted queries of the GraphQL endpoint."""
+
+    query = '{ allCurrencies { name } }'
+
+    def setUp(self):
+        self.client = APIClient()
+        documents.cache.clear()
+        documents.registry.clear()
+        self.addCleanup(documents.registry.clear)
+
+    def post(self, data):
+        return self.client.post('/graphql/', data, format='json')
+
+    def test_repeated_query_is_parsed_once(self):
+        """Test a repeated query is served from the document cache."""
+        self.post({'query': self.query})
+        self.post({'query': self.query})
+        self.assertEqual(documents.cache.misses, 1)
+        self.assertEqual(documents.cache.hits, 1)
+
+    def test_invalid_query_is_not_cached(self):
+        """Test a query failing validation is reported and not cached."""
+        response = self.post({'query': '{ allCurrencies { nope } }'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIsNone(documents.cache.get(documents.query_hash('{ allCurrencies { nope } }')))
+
+    def test_hash_only_request(self):
+        """Test a registered query runs from its hash alone."""
+        call_command('register_queries', self.write_query(), stdout=StringIO())
+        response = self.post({'extensions': {'persistedQuery': {
+            'version': 1, 'sha256Hash': documents.query_hash(self.query)}}})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['data'], {'allCurrencies': []})
+
+    def test_unknown_hash(self):
+        """Test an unknown hash asks the client to send the query."""
+        response = self.post({'extensions': {'persistedQuery': {'version': 1, 'sha256Hash': '0' * 64}}})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()['errors'][0]['message'], 'PersistedQueryNotFound')
+
+    def test_mismatched_hash(self):
+        """Test a hash that does not match the query text is rejected."""
+        response = self.post({'query': self.query, 'id': '0' * 64})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(GRAPHQL_DOCUMENTS={'PERSISTED_ONLY': True})
+    def test_persisted_only(self):
+        """Test persisted-only mode runs registered documents and rejects others."""
+        PersistedQuery.objects.create(sha256=documents.query_hash(self.query), query=self.query)
+        self.assertEqual(self.post({'query': self.query}).status_code, status.HTTP_200_OK)
+        response = self.post({'query': '{ allUsers { username } }'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(GRAPHQL_DOCUMENTS={'PERSISTED_ONLY': True})
+    def test_registered_queries_are_read_once(self):
+        """Test persisted-only requests look a hash up in the database once per process."""
+        PersistedQuery.objects.create(sha256=documents.query_hash(self.query), query=self.query)
+        data = {'extensions': {'persistedQuery': {'version': 1, 'sha256Hash': documents.query_hash(self.query)}}}
+        self.assertEqual(self.post(data).status_code, status.HTTP_200_OK)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.post(data).status_code, status.HTTP_200_OK)
+            self.assertEqual(self.post({'query': self.query}).status_code, status.HTTP_200_OK)
+        self.assertFalse(any('api_persistedquery' in query['sql'] for query in queries))
+        self.assertEqual(documents.cache.misses, 1)
+
+    def write_query(self):
+        path = tempfile.NamedTemporaryFile('w', suffix='.graphql', delete=False)
+        with path:
+            path.write(self.query)
+        self.addCleanup(os.remove, path.name)
+        return path.name
+
+
+class WalletEventsTestCase(TestCase):
+    """Test the wallet events published by transfers and the event stream."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email="test@example.com",
+            password='testpassword'
+        )
+        self.user2 = User.objects.create_user(
+            username='testuser2',
+            email="test2@example.com",
+            password='testpassword'
+        )
+        self.currency = Currency(
+            name='Bitcoin',
+            symbol='BTC',
+            admin=self.user
+        )
+        self.currency.save()
+        self.wallet = Wallet(user=self.user, currency=self.currency, balance=1000)
+        self.wallet.save()
+        self.wallet2 = Wallet(user=self.user2, currency=self.currency, balance=1000)
+        self.wallet2.save()
+
+    def transfer(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            transfers.transfer(self.wallet.id, self.wallet2.id, 100, self.currency.id)
+
+    def test_transfer_publishes_after_commit(self):
+        """Test a transfer publishes its events only when it commits."""
+        def transfer_uncommitted():
+            with self.captureOnCommitCallbacks() as callbacks:
+                transfers.transfer(self.wallet.id, self.wallet2.id, 100, self.currency.id)
+            return callbacks
+
+        async def scenario():
+            subscription = events.get_broker().subscribe([events.wallet_channel(self.wallet2.id)])
+            try:
+                callbacks = await sync_to_async(transfer_uncommitted)()
+                self.assertIsNone(await subscription.get(0.05))
+                for callback in callbacks:
+                    callback()
+                return [await subscription.get(1), await subscription.get(1)]
+            finally:
+                subscription.close()
+
+        transaction_event, balance_event = async_to_sync(scenario)()
+        self.assertEqual(transaction_event['type'], 'transaction')
+        self.assertEqual(transaction_event['data']['amount'], 100)
+        self.assertEqual(balance_event['data'], {'wallet': self.wallet2.id, 'balance': 1100})
+
+    def test_stream_requires_token(self):
+        """Test the event stream rejects requests without a valid token."""
+        async def scenario():
+            communicator = ApplicationCommunicator(event_stream, {
+                'type': 'http', 'method': 'GET', 'path': EVENT_STREAM_PATH,
+                'query_string': b'token=invalid', 'headers': []})
+            await communicator.send_input({'type': 'http.request'})
+            return await communicator.receive_output(1)
+
+        self.assertEqual(async_to_sync(scenario)()['status'], 401)
+
+    def test_stream_sends_snapshot_and_events(self):
+        """Test the event stream sends the balances and then the wallet events."""
+        token = str(AccessToken.for_user(self.user2))
+
+        async def scenario():
+            communicator = ApplicationCommunicator(event_stream, {
+                'type': 'http', 'method': 'GET', 'path': EVENT_STREAM_PATH,
+                'query_string': f'token={token}'.encode(), 'headers': []})
+            await communicator.send_input({'type': 'http.request'})
+            start = await communicator.receive_output(1)
+            snapshot = await communicator.receive_output(1)
+            await sync_to_async(self.transfer)()
+            pushed = [await communicator.receive_output(1), await communicator.receive_output(1)]
+            await communicator.send_input({'type': 'http.disconnect'})
+            await communicator.wait(1)
+            return start, snapshot, pushed
+
+        start, snapshot, pushed = async_to_sync(scenario)()
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), start['headers'])
+        self.assertIn(f'"wallet": {self.wallet2.id}, "balance": 1000'.encode(), snapshot['body'])
+        self.assertTrue(pushed[0]['body'].startswith(b'event: transaction'))
+        self.assertIn(b'"balance": 1100', pushed[1]['body'])
+        self.assertEqual(events.get_broker().subscriber_count(), 0)
+
+
+class AsyncViewsTestCase(TestCase):
+    """Test the async versions of the CPU heavy views."""
+
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.user = User.objects.create_user(
+            username='testuser',
+            email="test@example.com",
+            password='testpassword'
+        )
+        self.user2 = User.objects.create_user(
+            username='testuser2',
+            email="test2@example.com",
+            password='testpassword'
+        )
+        self.currency = Currency(
+            name='Bitcoin',
+            symbol='BTC',
+            admin=self.user,
+            initial_balance=100
+        )
+        self.currency.save()
+        self.wallet = Wallet(user=self.user, currency=self.currency, balance=1000)
+        self.wallet.save()
+        self.wallet2 = Wallet(user=self.user2, currency=self.currency, balance=1000)
+        self.wallet2.save()
+
+    def call(self, view, data, user=None):
+        request = self.factory.post('/', data, content_type='application/json')
+        request.user = user or AnonymousUser()
+        response = async_to_sync(view)(request)
+        return response.status_code, json.loads(response.content)
+
+    def test_register_and_login(self):
+        """Test a registered user can log in through the async views."""
+        code, _ = self.call(async_views.register, {
+            'username': 'asyncuser', 'email': 'async@example.com', 'password': 'asyncpassword'})
+        self.assertEqual(code, status.HTTP_201_CREATED)
+        self.assertTrue(User.objects.get(username='asyncuser').check_password('asyncpassword'))
+        code, data = self.call(async_views.login, {'username': 'asyncuser', 'password': 'asyncpassword'})
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertIn('access', data)
+        code, _ = self.call(async_views.login, {'username': 'asyncuser', 'password': 'wrong'})
+        self.assertEqual(code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(ASYNC_VIEWS={'PROCESSES': 0})
+    def test_wallet_create(self):
+        """Test the async wallet creation gives the wallet a key pair."""
+        code, data = self.call(async_views.wallet_create, {'currency': self.currency.id}, self.user2)
+        self.assertEqual(code, status.HTTP_201_CREATED)
+        wallet = Wallet.objects.get(id=data['wallet']['id'])
+        self.assertEqual(wallet.balance, 100)
+        self.assertTrue(wallet.privatekey)
+        code, _ = self.call(async_views.wallet_create, {'currency': self.currency.id})
+        self.assertEqual(code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_transaction_create(self):
+        """Test the async transfer stores valid signatures made before the lock."""
+        code, data = self.call(async_views.transaction_create, {
+            'sender': self.wallet.id, 'receiver': self.wallet2.id,
+            'amount': 100, 'currency': self.currency.id}, self.user)
+        self.assertEqual(code, status.HTTP_201_CREATED)
+        transaction = Transaction.objects.get(id=data['id'])
+        self.assertTrue(transaction.validate_signature() is None)
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.balance, 900)
+        code, data = self.call(async_views.transaction_create, {
+            'sender': self.wallet2.id, 'receiver': self.wallet.id,
+            'amount': 100, 'currency': self.currency.id}, self.user)
+        self.assertEqual(code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_invalid_signatures_are_replaced(self):
+        """Test a transfer signs again when the given signatures do not match."""
+        message, sender_signature, receiver_signature = transfers.sign(self.wallet, self.wallet2, 50)
+        transaction = transfers.transfer(
+            self.wallet.id, self.wallet2.id, 100, self.currency.id,
+            signatures=(message, sender_signature, receiver_signature))
+        self.assertNotEqual(transaction.sender_signature, sender_signature)
+        self.assertTrue(transaction.validate_signature() is None)
+
+    def test_middleware_authenticates_async_requests(self):
+        """Test the JWT middleware authenticates requests served over ASGI."""
+        token = str(AccessToken.for_user(self.user))
+
+        async def get():
+            return await AsyncClient().get('/api/verify', AUTHORIZATION=f'Bearer {token}')
+
+        response = async_to_sync(get)()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['username'], 'testuser')
+
+
+class AuthenticationFastPathTestCase(TestCase):
+    """Test the single token decode and the API middleware fast path."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            email="test@example.com",
+            password='testpassword'
+        )
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+
+    def test_token_is_decoded_once(self):
+        """Test the middleware and DRF share one token decode and user lookup."""
+        with mock.patch.object(CachedJWTAuthentication, 'get_validated_token',
+                               wraps=CachedJWTAuthentication().get_validated_token) as decode:
+            with self.assertNumQueries(1):
+                response = self.client.get('/api/verify')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(decode.call_count, 1)
+
+    def test_invalid_token_is_rejected(self):
+        """Test an invalid token is still rejected by DRF."""
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer invalid')
+        response = self.client.get('/api/verify')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_api_paths_skip_web_middleware(self):
+        """Test API requests skip the session middleware and other paths do not."""
+        seen = {}
+
+        def get_response(request):
+            seen[request.path] = hasattr(request, 'session')
+            return HttpResponse()
+
+        middleware = WebSessionMiddleware(get_response)
+        middleware(RequestFactory().get('/api/verify'))
+        middleware(RequestFactory().get('/admin/login/'))
+        self.assertEqual(seen, {'/api/verify': False, '/admin/login/': True})
+
+    def test_web_paths_keep_csrf(self):
+        """Test the admin still gets its CSRF cookie."""
+        response = self.client.get('/admin/login/')
+        self.assertIn('csrftoken', response.cookies)
+
+
+class UserCacheTestCase(TestCase):
+    """Test the cache of authenticated users."""
+
+    def setUp(self):
+        caches['users'].clear()
+        usercache.reset_stats()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            email="test@example.com",
+            password='testpassword'
+        )
+        self.token = str(AccessToken.for_user(self.user))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+
+    def test_repeated_requests_skip_user_query(self):
+        """Test only the first authenticated request loads the user."""
+        with self.assertNumQueries(1):
+            self.client.get('/api/verify')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/verify')
+        self.assertEqual(response.json()['username'], 'testuser')
+        self.assertEqual(usercache.stats(), {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+    def test_verify_post_uses_cache(self):
+        """Test the token verification by body uses the cache."""
+        usercache.get_user(self.user.id)
+        with self.assertNumQueries(0):
+            response = self.client.post('/api/verify', {'access': self.token}, format='json')
+        self.assertEqual(response.json()['email'], 'test@example.com')
+
+    def test_saving_user_invalidates(self):
+        """Test a saved user is loaded again."""
+        usercache.get_user(self.user.id)
+        self.user.email = 'changed@example.com'
+        self.user.save()
+        self.assertEqual(usercache.get_user(self.user.id).email, 'changed@example.com')
+
+    def test_deleted_user_is_rejected(self):
+        """Test the token of a deleted user stops authenticating."""
+        self.client.get('/api/verify')
+        self.user.delete()
+        response = self.client.get('/api/verify')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class TokenClaimsTestCase(TestCase):
+    """Test the identity claims of the issued tokens."""
+
+    def setUp(self):
+        caches['users'].clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            email="test@example.com",
+            password='testpassword'
+        )
+        response = self.client.post('/api/login', {'username': 'testuser', 'password': 'testpassword'})
+        self.refresh = response.data['refresh']
+        self.access = response.data['access']
+
+    def test_login_tokens_carry_claims(self):
+        """Test the tokens from login carry the identity claims."""
+        token = AccessToken(self.access)
+        self.assertEqual(token['username'], 'testuser')
+        self.assertEqual(token['email'], 'test@example.com')
+        self.assertFalse(token['is_staff'])
+        self.assertEqual(token['ver'], 0)
+
+    def test_verify_without_queries(self):
+        """Test verify answers from the claims without database queries."""
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access}')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/verify')
+            self.assertEqual(response.data, {'username': 'testuser', 'email': 'test@example.com'})
+            response = self.client.post('/api/verify', {'access': self.access})
+            self.assertEqual(response.data, {'username': 'testuser', 'email': 'test@example.com'})
+
+    def test_edited_user_makes_claims_stale(self):
+        """Test editing a user bumps its version and verify stops trusting old claims."""
+        self.user.email = 'changed@example.com'
+        self.user.save()
+        self.assertEqual(self.user.token_version, 1)
+        response = self.client.post('/api/verify', {'access': self.access})
+        self.assertEqual(response.data['email'], 'changed@example.com')
+
+    def test_missing_version_is_read_from_the_user(self):
+        """Test a version missing from the cache, as in another worker, is read once from the user."""
+        User.objects.filter(pk=self.user.pk).update(token_version=1, is_active=False)
+        caches['users'].clear()
+        with self.assertNumQueries(1):
+            self.assertFalse(tokens.is_current(AccessToken(self.access)))
+            self.assertFalse(tokens.is_current(AccessToken(self.access)))
+        User.objects.filter(pk=self.user.pk).delete()
+        caches['users'].clear()
+        self.assertFalse(tokens.is_current(AccessToken(self.access)))
+
+    def test_deleted_user_tokens_are_not_current(self):
+        """Test deleting a user drops its cached version, so /api/verify no longer trusts its tokens."""
+        self.assertTrue(tokens.is_current(AccessToken(self.access)))
+        User.objects.get(pk=self.user.pk).delete()
+        self.assertFalse(tokens.is_current(AccessToken(self.access)))
+
+    def test_unrelated_save_keeps_version(self):
+        """Test saving a user without changing claim fields keeps the version."""
+        user = User.objects.get(id=self.user.id)
+        user.first_name = 'Test'
+        user.save()
+        self.assertEqual(user.token_version, 0)
+
+    def test_refresh_issues_current_claims(self):
+        """Test refreshing issues an access token with the current claims."""
+        self.user.username = 'renamed'
+        self.user.save()
+        response = self.client.post('/api/refresh', {'refresh': self.refresh})
+        token = AccessToken(response.data['access'])
+        self.assertEqual(token['username'], 'renamed')
+        self.assertEqual(token['ver'], 1)
+
+
+class TokenBlacklistTestCase(TestCase):
+    """Test the in-process refresh token blacklist and its compaction."""
+
+    def setUp(self):
+        blacklist.jtis.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            email="test@example.com",
+            password='testpassword'
+        )
+        response = self.client.post('/api/login', {'username': 'testuser', 'password': 'testpassword'})
+        self.refresh = response.data['refresh']
+
+    def test_refresh_skips_blacklist_tables(self):
+        """Test a refresh after the first one does not query the blacklist."""
+        self.client.post('/api/refresh', {'refresh': self.refresh})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/refresh', {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse([query for query in queries if 'blacklist' in query['sql']])
+
+    def test_logged_out_token_is_rejected(self):
+        """Test a token blacklisted by logout can not be refreshed."""
+        self.client.post('/api/refresh', {'refresh': self.refresh})
+        self.client.post('/api/logout', {'refresh': self.refresh})
+        response = self.client.post('/api/refresh', {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_other_workers_blacklist_is_synced(self):
+        """Test tokens blacklisted elsewhere are seen after a sync."""
+        jti = tokens.ClaimsRefreshToken(self.refresh)['jti']
+        self.assertFalse(blacklist.is_blacklisted(jti))
+        outstanding = OutstandingToken.objects.get(jti=jti)
+        BlacklistedToken.objects.bulk_create([BlacklistedToken(token=outstanding)])
+        self.assertFalse(blacklist.is_blacklisted(jti))
+        blacklist.jtis.sync(force=True)
+        self.assertTrue(blacklist.is_blacklisted(jti))
+
+    def test_late_commits_are_synced(self):
+        """Test a token blacklisted before the last sync but committed after it is seen."""
+        other = OutstandingToken.objects.create(
+            user=self.user, jti='other', token='token', expires_at=timezone.now() + timedelta(days=1))
+        BlacklistedToken.objects.bulk_create([BlacklistedToken(id=2, token=other)])
+        blacklist.jtis.sync(force=True)
+        jti = tokens.ClaimsRefreshToken(self.refresh)['jti']
+        outstanding = OutstandingToken.objects.get(jti=jti)
+        BlacklistedToken.objects.bulk_create([BlacklistedToken(id=1, token=outstanding)])
+        BlacklistedToken.objects.filter(id=1).update(blacklisted_at=timezone.now() - timedelta(seconds=10))
+        blacklist.jtis.sync(force=True)
+        self.assertTrue(blacklist.is_blacklisted(jti))
+
+    def test_reload_finds_rows_older_than_the_lookback(self):
+        """Test a token stamped before the lookback window is seen by the next full reload."""
+        jti = tokens.ClaimsRefreshToken(self.refresh)['jti']
+        blacklist.jtis.sync(force=True)
+        outstanding = OutstandingToken.objects.get(jti=jti)
+        BlacklistedToken.objects.bulk_create([BlacklistedToken(token=outstanding)])
+        BlacklistedToken.objects.update(blacklisted_at=timezone.now() - timedelta(hours=1))
+        blacklist.jtis.sync(force=True)
+        self.assertFalse(blacklist.is_blacklisted(jti))
+        with override_settings(TOKEN_BLACKLIST={'RELOAD_INTERVAL': 0}):
+            blacklist.jtis.sync(force=True)
+        self.assertTrue(blacklist.is_blacklisted(jti))
+
+    def test_compact_removes_expired_tokens(self):
+        """Test compaction deletes expired tokens in chunks and keeps live ones."""
+        expired = timezone.now() - timedelta(days=1)
+        for index in range(5):
+            token = OutstandingToken.objects.create(
+                user=self.user, jti=f'expired-{index}', token='token', expires_at=expired)
+            BlacklistedToken.objects.create(token=token)
+        self.assertEqual(blacklist.compact(chunk_size=2, pause=0), 5)
+        self.assertEqual(OutstandingToken.objects.count(), 1)
+        self.assertFalse(BlacklistedToken.objects.exists())
+
+
+class TunedSQLiteTestCase(TestCase):
+    """Test the pragmas and transactions of the tuned SQLite backend."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.wrapper = sqlite_tuned.DatabaseWrapper({
+            **connection.settings_dict,
+            'ENGINE': 'api.db.sqlite_tuned',
+            'NAME': os.path.join(directory.name, 'tuned.sqlite3'),
+            'OPTIONS': {'pragmas': {'cache_size': -1024}},
+        }, alias='tuned')
+        self.addCleanup(self.wrapper.close)
+
+    def pragma(self, name):
+        with self.wrapper.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_pragmas_are_applied(self):
+        """Test new connections use WAL, the busy timeout and the configured pragmas."""
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('busy_timeout'), 20000)
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('cache_size'), -1024)
+
+    def test_transactions_take_the_write_lock(self):
+        """Test a transaction holds the write lock from its start."""
+        self.wrapper.ensure_connection()
+        self.wrapper._start_transaction_under_autocommit()
+        other = sqlite3.connect(self.wrapper.settings_dict['NAME'], timeout=0)
+        self.addCleanup(other.close)
+        with self.assertRaises(sqlite3.OperationalError):
+            other.execute('BEGIN IMMEDIATE')
+        self.wrapper.connection.rollback()
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test reads are routed to the replicas and clients that wrote stick to the primary."""
+
+    def setUp(self):
+        self.router = routers.ReplicaRouter()
+        self.factory = RequestFactory()
+        caches['default'].clear()
+
+    @override_settings(DATABASE_REPLICAS=['replica0'])
+    def test_only_replica_reads_use_a_replica(self):
+        """Test reads use a replica inside replica_reads and the primary elsewhere."""
+        self.assertEqual(self.router.db_for_read(Wallet), 'default')
+        with routers.replica_reads():
+            self.assertEqual(self.router.db_for_read(Wallet), 'replica0')
+        self.assertEqual(self.router.db_for_write(Wallet), 'default')
+        self.assertFalse(self.router.allow_migrate('replica0', 'api'))
+
+    @override_settings(DATABASE_REPLICAS=['replica0'])
+    def test_reads_after_a_write_use_the_primary(self):
+        """Test a request reads its own writes from the primary."""
+        with routers.request_context(), routers.replica_reads():
+            self.router.db_for_write(Wallet)
+            self.assertEqual(self.router.db_for_read(Wallet), 'default')
+
+    @override_settings(DATABASE_REPLICAS=['replica0'])
+    def test_client_sticks_to_the_primary_after_a_write(self):
+        """Test the next request of a client that wrote reads from the primary."""
+        def write(request):
+            self.router.db_for_write(Wallet)
+            return HttpResponse()
+
+        def read(request):
+            with routers.replica_reads():
+                return HttpResponse(self.router.db_for_read(Wallet))
+
+        self.assertEqual(routers.ReplicaMiddleware(read)(
+            self.factory.get('/graphql/', HTTP_AUTHORIZATION='Bearer a')).content, b'replica0')
+        routers.ReplicaMiddleware(write)(self.factory.post('/graphql/', HTTP_AUTHORIZATION='Bearer a'))
+        self.assertEqual(routers.ReplicaMiddleware(read)(
+            self.factory.get('/graphql/', HTTP_AUTHORIZATION='Bearer a')).content, b'default')
+        self.assertEqual(routers.ReplicaMiddleware(read)(
+            self.factory.get('/graphql/', HTTP_AUTHORIZATION='Bearer b')).content, b'replica0')
+
+    def test_graphql_queries_read_from_replicas(self):
+        """Test GraphQL queries read inside replica_reads and mutations do not."""
+        seen = []
+
+        def db_for_read(router, model, **hints):
+            seen.append(routers._state.get()['replica'])
+            return 'default'
+
+        admin = User.objects.create_user('testuser', 'test@example.com', 'testpass')
+        currency = Currency.objects.create(name='Bitcoin', symbol='BTC', admin=admin)
+        client = APIClient()
+        with mock.patch.object(routers.ReplicaRouter, 'db_for_read', autospec=True, side_effect=db_for_read):
+            client.post('/graphql/', {'query': '{ allCurrencies { name } }'}, format='json')
+            self.assertTrue(seen and all(seen))
+            seen.clear()
+            client.post('/graphql/', {'query': f'mutation {{ deleteCurrency(id: {currency.id}) {{ ok }} }}'},
+                        format='json')
+            self.assertFalse(any(seen))
+
+    def test_copy_database(self):
+        """Test a SQLite database is copied into a replica file."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        source, target = (os.path.join(directory.name, name) for name in ('primary', 'replica'))
+        primary = sqlite3.connect(source)
+        self.addCleanup(primary.close)
+        with primary:
+            primary.execute('CREATE TABLE wallet (balance INTEGER)')
+            primary.execute('INSERT INTO wallet VALUES (1000)')
+        routers.copy_database(source, target, pages=1)
+        replica = sqlite3.connect(target)
+        self.addCleanup(replica.close)
+        self.assertEqual(replica.execute('SELECT balance FROM wallet').fetchall(), [(1000,)])
+
+
+SHARD = 'ledger_test'
+
+
+@override_settings(LEDGER_SHARDS=['default', SHARD], SHARDING={'PLACEMENT_TTL': 0, 'MOVE_PAUSE': 0})
+class LedgerShardingTestCase(TestCase):
+    """Test the wallets and transactions of a currency live on its shard."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # a shard of the test case only, its rows are deleted after every test
+        cls.directory = tempfile.TemporaryDirectory()
+        connections.databases[SHARD] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(cls.directory.name, 'shard.sqlite3'),
+        }
+        call_command('migrate', database=SHARD, verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections[SHARD].close()
+        del connections[SHARD]
+        del connections.databases[SHARD]
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        shards.placements.forget()
+        shards.ids.clear()
+        self.addCleanup(shards.ids.clear)
+        self.addCleanup(Wallet.objects.using(SHARD).all().delete)
+        self.addCleanup(Transaction.objects.using(SHARD).all().delete)
+        self.user = User.objects.create_user('testuser', 'test@example.com', 'testpass')
+        self.user2 = User.objects.create_user('testuser2', 'test2@example.com', 'testpass')
+        # the first currency goes to the primary, the next to the emptier shard
+        self.ether = Currency.objects.create(name='Ethereum', symbol='ETH', admin=self.user, initial_balance=1000)
+        self.currency = Currency.objects.create(name='Bitcoin', symbol='BTC', admin=self.user, initial_balance=1000)
+        self.wallet = self.currency.get_admin_wallet()
+        self.wallet2 = Wallet(user=self.user2, currency=self.currency, balance=1000)
+        self.wallet2.save()
+
+    def test_currencies_are_placed_on_shards(self):
+        """Test a new currency's wallets are created on the shard it is placed on."""
+        self.assertEqual(shards.for_currency(self.ether.id), 'default')
+        self.assertEqual(shards.for_currency(self.currency.id), SHARD)
+        self.assertEqual(set(Wallet.objects.using(SHARD).values_list('id', flat=True)),
+                         {self.wallet.id, self.wallet2.id})
+        self.assertFalse(Wallet.objects.using('default').filter(currency=self.currency).exists())
+        self.currency.refresh_from_db()
+        self.assertEqual((self.currency.circulating_supply, self.currency.holder_count), (2000, 2))
+
+    def test_transfers_run_on_the_shard(self):
+        """Test a transfer moves the balances and records the transaction on the currency's shard."""
+        transaction = transfers.transfer(self.wallet.id, self.wallet2.id, 100, self.currency.id, user=self.user)
+        ether_wallet = Wallet(user=self.user2, currency=self.ether, balance=1000)
+        ether_wallet.save()
+        ether = transfers.transfer(self.ether.get_admin_wallet().id, ether_wallet.id, 1, self.ether.id)
+        self.assertEqual((transaction._state.db, ether._state.db), (SHARD, 'default'))
+        self.assertTrue(Transaction.objects.using(SHARD).filter(pk=transaction.pk).exists())
+        self.assertNotEqual(transaction.pk, ether.pk)
+        self.wallet2.refresh_from_db()
+        self.assertEqual(self.wallet2.balance, 1100)
+        results = transfers.transfer_batch([
+            {'sender': self.wallet2.id, 'receiver': self.wallet.id, 'amount': 50, 'currency': self.currency.id},
+        ])
+        self.assertEqual(results[0]['status'], 'ok')
+        self.assertEqual(Transaction.objects.using(SHARD).count(), 2)
+
+    def test_graphql_reads_every_shard(self):
+        """Test the resolvers find wallets and transactions on their shards."""
+        transfers.transfer(self.wallet.id, self.wallet2.id, 100, self.currency.id)
+        result = schema.execute(
+            f'''{{
+                walletById(id: {self.wallet2.id}) {{ balance user {{ username }} }}
+                currencyBySymbol(symbol: "BTC") {{ wallets {{ id }} transactions {{ amount sender {{ id }} }} }}
+                walletsConnection {{ edges {{ node {{ id }} }} }}
+            }}''', context_value=RequestFactory().post('/graphql/'))
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data['walletById'], {'balance': 1100, 'user': {'username': 'testuser2'}})
+        self.assertEqual(result.data['currencyBySymbol']['transactions'],
+                         [{'amount': 100, 'sender': {'id': str(self.wallet.id)}}])
+        self.assertEqual(len(result.data['walletsConnection']['edges']), 3)
+
+    def test_move_currency(self):
+        """Test moving a currency copies its ledger to the target shard and removes the old copy."""
+        transaction = transfers.transfer(self.wallet.id, self.wallet2.id, 100, self.currency.id)
+        BalanceCheckpoint(currency=self.currency, wallet=self.wallet2, as_of=timezone.now(), balance=1100).save()
+        call_command('move_currency', 'BTC', 'default', stdout=StringIO())
+        self.assertEqual(shards.for_currency(self.currency.id), 'default')
+        self.assertFalse(Wallet.objects.using(SHARD).exists())
+        self.assertTrue(Transaction.objects.using('default').filter(pk=transaction.pk).exists())
+        self.assertEqual(Wallet.objects.using('default').get(pk=self.wallet2.pk).balance, 1100)
+        self.assertEqual(BalanceCheckpoint.objects.using('default').get(wallet=self.wallet2).balance, 1100)
+        self.assertFalse(BalanceCheckpoint.objects.using(SHARD).exists())
+        self.currency.refresh_from_db()
+        self.assertEqual((self.currency.circulating_supply, self.currency.holder_count), (2000, 2))
+        transfers.transfer(self.wallet2.id, self.wallet.id, 100, self.currency.id)
+
+    def test_reads_skip_the_other_copy_while_moving(self):
+        """Test the fan-out reads return each row once, from the shard of its currency, during a move."""
+        transaction = transfers.transfer(self.wallet.id, self.wallet2.id, 100, self.currency.id)
+        seen = []
+
+        def read(seconds):
+            # runs while the rows are on both shards, before and after the switch
+            shard = shards.for_currency(self.currency.id)
+            self.assertTrue(Wallet.objects.using('default').filter(pk=self.wallet2.pk).exists())
+            self.assertTrue(Wallet.objects.using(SHARD).filter(pk=self.wallet2.pk).exists())
+            self.assertEqual(shards.find(Wallet.objects.all(), self.wallet2.pk)._state.db, shard)
+            self.assertEqual(shards.in_bulk(Transaction.objects.all(), [transaction.pk])[transaction.pk]._state.db, shard)
+            self.assertEqual(len(shards.fan_out_list(Wallet.objects.filter(user=self.user2))), 1)
+            self.assertEqual(len(shards.fan_out_list(Transaction.objects.filter(sender=self.wallet))), 1)
+            result = schema.execute('{ walletsConnection { edges { node { id } } } }',
+                                    context_value=RequestFactory().post('/graphql/'))
+            self.assertEqual(len(result.data['walletsConnection']['edges']), 3)
+            seen.append(shard)
+
+        with mock.patch.object(shards.time, 'sleep', side_effect=read):
+            shards.move_currency(self.currency.id, 'default')
+        self.assertEqual(seen, [SHARD, 'default'])
+
+    def test_move_drops_rows_deleted_during_the_copy(self):
+        """Test a wallet deleted after it was copied does not come back on the target shard."""
+        transaction = transfers.transfer(self.wallet.id, self.wallet2.id, 100, self.currency.id)
+        deleted = []
+
+        def delete(seconds):
+            # the first pause comes after the copy, the wallet goes before the catch-up
+            if not deleted:
+                Wallet.objects.using(SHARD).filter(pk=self.wallet2.pk).delete()
+                deleted.append(self.wallet2.pk)
+
+        with mock.patch.object(shards.time, 'sleep', side_effect=delete):
+            shards.move_currency(self.currency.id, 'default')
+        self.assertFalse(Wallet.objects.using('default').filter(pk=self.wallet2.pk).exists())
+        self.assertFalse(Transaction.objects.using('default').filter(pk=transaction.pk).exists())
+        self.currency.refresh_from_db()
+        self.assertEqual((self.currency.circulating_supply, self.currency.holder_count), (900, 1))
+        self.assertEqual(shards.counters([self.currency.id]), {self.currency.id: (900, 1)})
+
+    def test_moving_currency_refuses_transfers(self):
+        """Test transfers of a currency are refused while it moves."""
+        CurrencyPlacement.objects.filter(currency=self.currency).update(moving=True)
+        with self.assertRaises(transfers.CurrencyMoving) as caught:
+            transfers.transfer(self.wallet.id, self.wallet2.id, 100, self.currency.id)
+        self.assertEqual(caught.exception.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    @override_settings(ASYNC_VIEWS={'PROCESSES': 0})
+    def test_wallet_create_while_moving_asks_to_retry(self):
+        """Test creating a wallet of a moving currency answers 503 instead of failing."""
+        CurrencyPlacement.objects.filter(currency=self.currency).update(moving=True)
+        client = APIClient()
+        client.force_authenticate(self.user2)
+        response = client.post(reverse('wallet_create'), {'currency': self.currency.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.data['message'], transfers.MOVING_MESSAGE)
+        request = AsyncRequestFactory().post('/', {'currency': self.currency.id}, content_type='application/json')
+        request.user = self.user2
+        response = async_to_sync(async_views.wallet_create)(request)
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(Wallet.objects.using(SHARD).filter(user=self.user2).count(), 1)
+
+    @override_settings(AUTHENTICATION_BACKENDS=['django.contrib.auth.backends.ModelBackend'])
+    def test_admin_finds_rows_on_their_shard(self):
+        """Test the admin lists and opens the wallets of a currency on its shard."""
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+        response = self.client.get(f'/admin/api/wallet/?currency__id__exact={self.currency.id}')
+        self.assertContains(response, f'/admin/api/wallet/{self.wallet2.id}/change/')
+        response = self.client.get(f'/admin/api/wallet/{self.wallet2.id}/change/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        transaction = transfers.transfer(self.wallet.id, self.wallet2.id, 100, self.currency.id)
+        response = self.client.get(f'/admin/api/transaction/?shard={SHARD}')
+        self.assertContains(response, f'/admin/api/transaction/{transaction.id}/change/')
+
+    def test_deleting_currency_deletes_its_shard_rows(self):
+        """Test deleting a currency also deletes its ledger on the shard."""
+        transfers.transfer(self.wallet.id, self.wallet2.id, 100, self.currency.id)
+        self.currency.delete()
+        self.assertFalse(Wallet.objects.using(SHARD).exists())
+        self.assertFalse(Transaction.objects.using(SHARD).exists())
+
+
+class HistoryExportTestCase(TestCase):
+    """Test the streaming transaction history exports."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', 'test@example.com', 'testpassword')
+        self.user2 = User.objects.create_user('testuser2', 'test2@example.com', 'testpassword')
+        self.currency = Currency.objects.create(name='Bitcoin', symbol='BTC', admin=self.user)
+        self.wallet = Wallet(user=self.user, currency=self.currency, balance=1000)
+        self.wallet.save()
+        self.wallet2 = Wallet(user=self.user2, currency=self.currency, balance=1000)
+        self.wallet2.save()
+        self.wallet3 = Wallet(user=self.user2, currency=self.currency, balance=1000)
+        self.wallet3.save()
+        self.transactions = [
+            transfers.transfer(self.wallet.id, self.wallet2.id, 10, self.currency.id),
+            transfers.transfer(self.wallet2.id, self.wallet.id, 20, self.currency.id),
+            transfers.transfer(self.wallet.id, self.wallet3.id, 30, self.currency.id),
+        ]
+        self.client = APIClient()
+        self.login('testuser')
+
+    def login(self, username):
+        token = self.client.post(reverse('login'), {'username': username, 'password': 'testpassword'}, format='json')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + token.data['access'])
+
+    def export(self, path, **params):
+        response = self.client.get(path, params)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def test_currency_history_as_csv(self):
+        """Test a currency's history is streamed as CSV in time order."""
+        response, content = self.export(reverse('currency_export', args=[self.currency.id, 'csv']))
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = content.decode('utf-8').splitlines()
+        self.assertEqual(lines[0].split(',')[:5], ['id', 'created_at', 'sender', 'receiver', 'amount'])
+        self.assertEqual([int(line.split(',')[0]) for line in lines[1:]],
+                         [transaction.id for transaction in self.transactions])
+
+    def test_wallet_history_filtered_by_counterparty(self):
+        """Test a wallet export as NDJSON keeps only the transfers with the counterparty."""
+        response, content = self.export(
+            reverse('wallet_export', args=[self.wallet.id, 'ndjson']),
+            counterparty=self.wallet2.id, start='2000-01-01', end=timezone.now().date().isoformat())
+        records = [json.loads(line) for line in content.decode('utf-8').splitlines()]
+        self.assertEqual([record['amount'] for record in records], [10, 20])
+
+    def test_gzip(self):
+        """Test the export is gzipped on request."""
+        response, content = self.export(reverse('currency_export', args=[self.currency.id, 'csv']), gzip='1')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('.csv.gz', response['Content-Disposition'])
+        self.assertEqual(len(gzip.decompress(content).decode('utf-8').splitlines()), 4)
+
+    def test_impossible_date_is_rejected(self):
+        """Test a well formed but impossible date is answered with a 400."""
+        response = self.client.get(reverse('currency_export', args=[self.currency.id, 'csv']), {'start': '2024-02-30'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['message'], 'Invalid date 2024-02-30')
+
+    def test_rows_are_read_in_keyset_batches(self):
+        """Test every row is read once with one query per batch."""
+        with CaptureQueriesContext(connection) as queries:
+            ids = [row[0] for row in exports.rows(exports.currency_history(self.currency), batch_size=2)]
+        self.assertEqual(ids, [transaction.id for transaction in self.transactions])
+        self.assertEqual(len(queries), 2)
+
+    def test_export_under_asgi(self):
+        """Test the ASGI application streams an export, reading the rows off the event loop."""
+        from backend.asgi import application
+
+        token = str(AccessToken.for_user(self.user))
+
+        async def scenario():
+            communicator = ApplicationCommunicator(application, {
+                'type': 'http', 'method': 'GET', 'path': reverse('currency_export', args=[self.currency.id, 'csv']),
+                'query_string': b'', 'headers': [(b'host', b'testserver'), (b'authorization', f'Bearer {token}'.encode())]})
+            await communicator.send_input({'type': 'http.request'})
+            start = await communicator.receive_output(5)
+            body = b''
+            while True:
+                message = await communicator.receive_output(5)
+                body += message.get('body', b'')
+                if not message.get('more_body'):
+                    return start, body
+
+        start, body = async_to_sync(scenario)()
+        self.assertEqual(start['status'], 200)
+        self.assertEqual([int(line.split(',')[0]) for line in body.decode('utf-8').splitlines()[1:]],
+                         [transaction.id for transaction in self.transactions])
+
+    def test_export_is_restricted(self):
+        """Test only the currency admin or staff export a currency, with valid filters."""
+        self.assertEqual(self.client.get(reverse('currency_export', args=[self.currency.id, 'csv']), {'end': 'soon'}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.login('testuser2')
+        self.assertEqual(self.client.get(reverse('currency_export', args=[self.currency.id, 'csv'])).status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self.client.get(reverse('wallet_export', args=[self.wallet2.id, 'csv'])).status_code,
+                         status.HTTP_200_OK)
+
+
+class LedgerImportTestCase(TestCase):
+    """Test the bulk import of users, currencies, wallets and history."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.publickey, cls.privatekey = keypool.generate_keypair()
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', 'test@example.com', 'testpassword')
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def records(self):
+        keys = {'publickey': self.publickey, 'privatekey': self.privatekey}
+        return [
+            {'type': 'user', 'username': 'alice', 'email': 'alice@example.com'},
+            {'type': 'user', 'username': 'bob'},
+            {'type': 'currency', 'symbol': 'OLD', 'name': 'Old Coin', 'admin': 'testuser'},
+            {'type': 'wallet', 'user': 'alice', 'currency': 'OLD', 'balance': 100, **keys},
+            {'type': 'wallet', 'user': 'bob', 'currency': 'OLD', 'balance': 50, **keys},
+            {'type': 'transaction', 'currency': 'OLD', 'sender': 'alice', 'receiver': 'bob',
+             'amount': 30, 'created_at': '2020-01-01T10:00:00'},
+            {'type': 'transaction', 'currency': 'OLD', 'sender': 'bob', 'receiver': 'alice',
+             'amount': 80, 'created_at': '2020-01-02T10:00:00'},
+        ]
+
+    def run_import(self, records, name='ledger.ndjson'):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', newline='') as file:
+            if name.endswith('.csv'):
+                fields = sorted({field for record in records for field in record})
+                writer = csv.DictWriter(file, fields)
+                writer.writeheader()
+                writer.writerows(records)
+            else:
+                file.writelines(json.dumps(record) + '\n' for record in records)
+        output = StringIO()
+        call_command('import_ledger', path, batch_size=2, workers=0, stdout=output)
+        return output.getvalue()
+
+    def test_import_ndjson(self):
+        """Test an NDJSON import writes the history with its snapshots, signatures and final balances."""
+        output = self.run_import(self.records())
+        self.assertIn('transactions=2', output)
+        currency = Currency.objects.get(symbol='OLD')
+        alice = currency.wallets.get(user__username='alice')
+        bob = currency.wallets.get(user__username='bob')
+        self.assertEqual((alice.balance, alice.opening_balance, alice.total_sent, alice.total_received),
+                         (150, 100, 30, 80))
+        self.assertEqual(bob.balance, 0)
+        first, second = Transaction.objects.filter(currency=currency).order_by('created_at')
+        self.assertEqual(first.created_at.date().isoformat(), '2020-01-01')
+        self.assertEqual((second.before_sender_amount_snapshot, second.after_sender_amount_snapshot,
+                          second.before_receiver_amount_snapshot, second.after_receiver_amount_snapshot),
+                         (80, 0, 70, 150))
+        first.validate_signature()
+        self.assertFalse(currency.unreconciled_wallets().exists())
+        self.assertEqual((currency.circulating_supply, currency.holder_count), (150, 3))
+        self.assertEqual(currency.get_admin_wallet().balance, 0)
+        self.assertEqual(Signer().unsign(currency.invite_code), f'{currency.id}-Old Coin-OLD')
+
+    def test_import_csv(self):
+        """Test a CSV import reads the same records."""
+        self.run_import(self.records(), name='ledger.csv')
+        self.assertEqual(Wallet.objects.get(user__username='alice').balance, 150)
+        self.assertEqual(User.objects.get(username='alice').email, 'alice@example.com')
+
+    def test_bad_record_stops_the_import(self):
+        """Test a transfer without funds stops the import and keeps the history before it consistent."""
+        records = self.records()
+        records[-1]['amount'] = 1000
+        with self.assertRaisesMessage(CommandError, 'Line 7: Insufficient funds'):
+            self.run_import(records)
+        currency = Currency.objects.get(symbol='OLD')
+        self.assertEqual(Transaction.objects.filter(currency=currency).count(), 1)
+        self.assertEqual(currency.wallets.get(user__username='bob').balance, 80)
+        self.assertFalse(currency.unreconciled_wallets().exists())
+
+    def test_interrupted_import_keeps_balances_consistent(self):
+        """Test an import failing after a written batch leaves its wallets matching the history."""
+        records = self.records()
+        records[-1]['amount'] = 10
+        records.append({'type': 'transaction', 'currency': 'OLD', 'sender': 'alice', 'receiver': 'bob', 'amount': 1})
+        with mock.patch.object(imports.Importer, '_sign', side_effect=[None, KeyboardInterrupt]):
+            with self.assertRaises(KeyboardInterrupt):
+                self.run_import(records)
+        currency = Currency.objects.get(symbol='OLD')
+        self.assertEqual(Transaction.objects.filter(currency=currency).count(), 2)
+        self.assertEqual(currency.wallets.get(user__username='alice').balance, 80)
+        self.assertFalse(currency.unreconciled_wallets().exists())
+
+
+@override_settings(BALANCE_CHECKPOINTS={'EVERY': 2, 'INTERVAL': 30 * 24 * 3600, 'SETTLE_SECONDS': 60, 'CHUNK_SIZE': 500})
+class BalanceCheckpointTestCase(TestCase):
+    """Test point-in-time balances answered from balance checkpoints."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', 'test@example.com', 'testpassword')
+        self.user2 = User.objects.create_user('testuser2', 'test2@example.com', 'testpassword')
+        self.currency = Currency.objects.create(name='Bitcoin', symbol='BTC', admin=self.user, initial_balance=1000)
+        self.wallet = self.currency.get_admin_wallet()
+        self.wallet2 = Wallet(user=self.user2, currency=self.currency, balance=1000)
+        self.wallet2.save()
+        # five transfers of 10, one an hour after the wallets were created
+        self.start = timezone.now() - timedelta(days=10)
+        Wallet.objects.filter(currency=self.currency).update(created_at=self.start)
+        for hour in range(1, 6):
+            transaction = transfers.transfer(self.wallet.id, self.wallet2.id, 10, self.currency.id)
+            Transaction.objects.filter(pk=transaction.pk).update(created_at=self.hour(hour))
+        self.wallet.refresh_from_db()
+
+    def hour(self, hour):
+        return self.start + timedelta(hours=hour)
+
+    def test_checkpoints_are_built_incrementally(self):
+        """Test a checkpoint is added every EVERY settled transactions and only once."""
+        transfers.transfer(self.wallet.id, self.wallet2.id, 10, self.currency.id)
+        self.assertEqual(checkpoints.build(self.currency.id), 2)
+        self.assertEqual(checkpoints.build(self.currency.id), 0)
+        self.assertEqual(
+            list(BalanceCheckpoint.objects.filter(as_of=self.hour(4)).order_by('wallet_id')
+                 .values_list('wallet_id', 'balance')),
+            [(self.wallet.id, 960), (self.wallet2.id, 1040)])
+        call_command('build_checkpoints', currency='BTC', stdout=StringIO())
+        self.assertEqual(BalanceCheckpoint.objects.count(), 4)
+
+    def test_balance_at(self):
+        """Test the balance at any time matches the history, with or without checkpoints."""
+        for built in (False, True):
+            if built:
+                checkpoints.build(self.currency.id)
+            for hour in range(7):
+                self.assertEqual(checkpoints.balance_at(self.wallet, self.hour(hour)), 1000 - 10 * min(hour, 5))
+            self.assertIsNone(checkpoints.balance_at(self.wallet, self.start - timedelta(days=1)))
+
+    def test_balances_at(self):
+        """Test the balances of every wallet of the currency at a time after the last checkpoint."""
+        checkpoints.build(self.currency.id)
+        Wallet(user=User.objects.create_user('testuser3', 'test3@example.com', 'testpassword'),
+               currency=self.currency, balance=5).save()
+        self.assertEqual(
+            [(wallet.id, balance) for wallet, balance in checkpoints.balances_at(self.currency.id, self.hour(3))],
+            [(self.wallet.id, 970), (self.wallet2.id, 1030)])
+        self.assertEqual(len(checkpoints.balances_at(self.currency.id, timezone.now())), 3)
+
+    def test_balance_endpoints(self):
+        """Test the REST and GraphQL point-in-time balance queries."""
+        checkpoints.build(self.currency.id)
+        client = APIClient()
+        token = client.post(reverse('login'), {'username': 'testuser', 'password': 'testpassword'}, format='json')
+        client.credentials(HTTP_AUTHORIZATION='Bearer ' + token.data['access'])
+        at = self.hour(3).isoformat()
+        response = client.get(reverse('wallet_balance', args=[self.wallet2.id]), {'at': at})
+        self.assertEqual(response.data['balance'], 1030)
+        response = client.get(reverse('currency_balances', args=[self.currency.id]), {'at': at})
+        self.assertEqual([row['balance'] for row in response.data['balances']], [970, 1030])
+        self.assertEqual(client.get(reverse('wallet_balance', args=[self.wallet.id]), {'at': 'soon'}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(client.get(reverse('wallet_balance', args=[self.wallet.id]), {'at': '2024-02-30'}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(client.get(reverse('currency_balances', args=[self.currency.id]),
+                                    {'at': '2024-02-30'}).status_code, status.HTTP_400_BAD_REQUEST)
+        result = schema.execute(
+            f'''{{
+                balanceAt(wallet: {self.wallet.id}, at: "{at}")
+                balancesAt(currency: "{self.currency.id}", at: "{at}") {{ wallet {{ id }} balance }}
+            }}''', context_value=RequestFactory().post('/graphql/'))
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data['balanceAt'], 970)
+        self.assertEqual(result.data['balancesAt'][1], {'wallet': {'id': str(self.wallet2.id)}, 'balance': 1030})
+
+
+class VolumeRollupTestCase(TestCase):
+    """Test the per-currency volume rollups and their catch-up job."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', 'test@example.com', 'testpassword')
+        self.user2 = User.objects.create_user('testuser2', 'test2@example.com', 'testpassword')
+        self.currency = Currency.objects.create(name='Bitcoin', symbol='BTC', admin=self.user, initial_balance=1000)
+        self.wallet = self.currency.get_admin_wallet()
+        self.wallet2 = Wallet(user=self.user2, currency=self.currency, balance=1000)
+        self.wallet2.save()
+        self.wallet3 = Wallet(user=self.user2, currency=self.currency, balance=1000)
+        self.wallet3.save()
+        self.day = rollups.floor(timezone.now() - timedelta(days=10), 'day')
+        self.transfer(self.wallet, self.wallet2, 10, timedelta(hours=10, seconds=30))
+        self.transfer(self.wallet2, self.wallet3, 20, timedelta(hours=10, seconds=50))
+        self.transfer(self.wallet, self.wallet3, 5, timedelta(hours=11, minutes=30))
+        self.transfer(self.wallet, self.wallet2, 7, timedelta(days=1, hours=9))
+
+    def transfer(self, sender, receiver, amount, after):
+        transaction = transfers.transfer(sender.id, receiver.id, amount, self.currency.id)
+        Transaction.objects.filter(pk=transaction.pk).update(created_at=self.day + after)
+
+    def rollup(self, granularity, after):
+        return VolumeRollup.objects.values_list('volume', 'transactions', 'active_wallets').get(
+            currency=self.currency, granularity=granularity, bucket=self.day + after)
+
+    def test_build_rolls_up_every_granularity(self):
+        """Test the volume, count and distinct wallets of each minute, hour and day."""
+        self.assertEqual(rollups.build(self.currency.id), 2)
+        self.assertEqual(self.rollup('minute', timedelta(hours=10)), (30, 2, 3))
+        self.assertEqual(self.rollup('hour', timedelta(hours=11)), (5, 1, 2))
+        self.assertEqual(self.rollup('day', timedelta()), (35, 3, 3))
+        self.assertEqual(self.rollup('day', timedelta(days=1)), (7, 1, 2))
+        self.assertEqual(VolumeRollup.objects.count(), 8)
+        self.assertEqual(rollups.build(self.currency.id), 0)
+        self.assertGreater(RollupMark.objects.get(currency=self.currency).through, self.day + timedelta(days=9))
+
+    def test_build_resumes_from_its_mark(self):
+        """Test a later run recomputes the day its mark is in and leaves the days before."""
+        self.transfer(self.wallet, self.wallet2, 3, timedelta(days=1, hours=12))
+        rollups.build(self.currency.id, now=self.day + timedelta(days=1, hours=10))
+        self.assertEqual(self.rollup('day', timedelta(days=1)), (7, 1, 2))
+        first_day = set(VolumeRollup.objects.filter(bucket__lt=self.day + timedelta(days=1)).values_list('id', flat=True))
+        self.assertEqual(rollups.build(self.currency.id), 1)
+        self.assertEqual(self.rollup('day', timedelta(days=1)), (10, 2, 2))
+        self.assertEqual(set(VolumeRollup.objects.filter(bucket__lt=self.day + timedelta(days=1))
+                             .values_list('id', flat=True)), first_day)
+
+    def test_build_adds_to_the_day_of_its_mark(self):
+        """Test a run within a day rereads only the hour of its mark and counts each active wallet once."""
+        rollups.build(self.currency.id, now=self.day + timedelta(hours=11, minutes=2))
+        self.assertEqual(self.rollup('day', timedelta()), (30, 2, 3))
+        minute = VolumeRollup.objects.get(granularity='minute', bucket=self.day + timedelta(hours=10)).pk
+        with CaptureQueriesContext(connection) as queries:
+            rollups.build(self.currency.id, now=self.day + timedelta(hours=12))
+        reads = [query['sql'] for query in queries if query['sql'].startswith('SELECT') and 'api_transaction' in query['sql']]
+        self.assertTrue(all('created_at" >=' in sql for sql in reads))
+        self.assertEqual(self.rollup('day', timedelta()), (35, 3, 3))
+        self.assertEqual(self.rollup('hour', timedelta(hours=11)), (5, 1, 2))
+        self.assertEqual(VolumeRollup.objects.get(granularity='minute', bucket=self.day + timedelta(hours=10)).pk, minute)
+        rollups.build(self.currency.id)
+        self.assertEqual(self.rollup('day', timedelta(days=1)), (7, 1, 2))
+        self.assertFalse(RollupWallet.objects.filter(day=self.day).exists())
+
+    @override_settings(ROLLUPS={'SETTLE_SECONDS': 60, 'MAX_POINTS': 100})
+    def test_series_downsamples_long_ranges(self):
+        """Test the finest granularity fitting MAX_POINTS is read, and days are merged past it."""
+        call_command('build_rollups', currency='BTC', stdout=StringIO())
+        granularity, seconds, rows = rollups.series(
+            self.currency.id, self.day + timedelta(hours=10), self.day + timedelta(hours=11))
+        self.assertEqual((granularity, seconds, [row['volume'] for row in rows]), ('minute', 60, [30]))
+        granularity, seconds, rows = rollups.series(self.currency.id, self.day, self.day + timedelta(days=3))
+        self.assertEqual((granularity, [row['volume'] for row in rows]), ('hour', [30, 5, 7]))
+        granularity, seconds, rows = rollups.series(self.currency.id, self.day, self.day + timedelta(days=300))
+        self.assertEqual((granularity, seconds), ('day', 3 * 24 * 3600))
+        self.assertEqual(rows, [{'bucket': self.day, 'volume': 42, 'transactions': 4, 'active_wallets': None}])
+        with self.assertRaises(rollups.RollupError):
+            rollups.series(self.currency.id, granularity='week')
+        with self.assertRaises(rollups.RollupError):
+            rollups.parse_time('2024-02-30')
+
+    def test_graphql_volume(self):
+        """Test the volume query reads the rollups."""
+        rollups.build(self.currency.id)
+        start = (self.day + timedelta(hours=10)).isoformat()
+        end = (self.day + timedelta(hours=12)).isoformat()
+        with CaptureQueriesContext(connection) as queries:
+            result = schema.execute(
+                f'''{{ volume(currency: "{self.currency.id}", start: "{start}", end: "{end}", granularity: "hour") {{
+                    granularity bucketSeconds buckets {{ volume transactions activeWallets }}
+                }} }}''', context_value=RequestFactory().post('/graphql/'))
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data['volume']['granularity'], 'hour')
+        self.assertEqual(result.data['volume']['buckets'],
+                         [{'volume': 30, 'transactions': 2, 'activeWallets': 3},
+                          {'volume': 5, 'transactions': 1, 'activeWallets': 2}])
+        self.assertFalse(any('api_transaction' in query['sql'] for query in queries))
+
+
+class LeaderboardTestCase(TestCase):
+    """Test the top holders kept in memory per currency."""
+
+    def setUp(self):
+        leaderboard.boards.forget()
+        self.user = User.objects.create_user('testuser', 'test@example.com', 'testpassword')
+        self.user2 = User.objects.create_user('testuser2', 'test2@example.com', 'testpassword')
+        self.currency = Currency.objects.create(name='Bitcoin', symbol='BTC', admin=self.user, initial_balance=1000)
+        self.wallet = self.currency.get_admin_wallet()
+        self.wallet2 = self.new_wallet(500)
+        self.wallet3 = self.new_wallet(300)
+        self.wallet4 = self.new_wallet(300)
+
+    def tearDown(self):
+        leaderboard.boards.forget()
+
+    def new_wallet(self, balance):
+        wallet = Wallet(user=self.user2, currency=self.currency, balance=balance)
+        wallet.save()
+        return wallet
+
+    def top(self, limit):
+        return [(holder.wallet_id, holder.balance) for holder in leaderboard.top(self.currency.id, limit)]
+
+    def test_top_holders_are_read_once(self):
+        """Test the biggest holders come in balance order, ties by id, and a second read runs no query."""
+        expected = [(self.wallet.id, 1000), (self.wallet2.id, 500), (self.wallet3.id, 300), (self.wallet4.id, 300)]
+        with self.assertNumQueries(1):
+            self.assertEqual(self.top(4), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.top(3), expected[:3])
+            self.assertEqual([holder.rank for holder in leaderboard.top(self.currency.id, 2)], [1, 2])
+
+    def test_transfers_move_the_board(self):
+        """Test committed transfers reorder the board without reading the wallets again."""
+        self.top(4)
+        with self.captureOnCommitCallbacks(execute=True):
+            transfers.transfer(self.wallet.id, self.wallet4.id, 800, self.currency.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            transfers.transfer_batch([
+                {'sender': self.wallet2.id, 'receiver': self.wallet3.id, 'amount': 100},
+                {'sender': self.wallet2.id, 'receiver': self.wallet.id, 'amount': 50},
+            ])
+        with self.assertNumQueries(0):
+            top = self.top(4)
+        self.assertEqual(top, list(leaderboard.holders(self.currency.id).values_list('id', 'balance')))
+        self.assertEqual(top[0], (self.wallet4.id, 1100))
+
+    @override_settings(LEADERBOARD={'SIZE': 2})
+    def test_bounded_board(self):
+        """Test a full board admits wallets passing its bound, drops the ones falling to it and reloads when short."""
+        self.top(2)
+        with self.captureOnCommitCallbacks(execute=True):
+            big = self.new_wallet(700)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.top(2), [(self.wallet.id, 1000), (big.id, 700)])
+        with self.captureOnCommitCallbacks(execute=True):
+            transfers.transfer(self.wallet.id, self.wallet3.id, 600, self.currency.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.top(1), [(self.wallet3.id, 900)])
+        with self.captureOnCommitCallbacks(execute=True):
+            big.delete()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.top(2), [(self.wallet3.id, 900), (self.wallet2.id, 500)])
+
+    @override_settings(LEADERBOARD={'SIZE': 2})
+    def test_rank(self):
+        """Test the rank of a wallet on the board costs no query and off it counts the wallets above."""
+        self.top(2)
+        with self.assertNumQueries(0):
+            self.assertEqual(leaderboard.rank(self.wallet2).rank, 2)
+        with self.assertNumQueries(2):
+            self.assertEqual(leaderboard.rank(self.wallet4).rank, 4)
+        self.assertEqual(leaderboard.rank(self.wallet3).rank, 3)
+
+    def test_graphql_top_holders(self):
+        """Test the topHolders and holderRank queries."""
+        result = schema.execute(
+            f'''{{
+                topHolders(currency: "{self.currency.id}", limit: 2) {{ rank balance wallet {{ id }} }}
+                holderRank(wallet: {self.wallet3.id}) {{ rank balance }}
+            }}''', context_value=RequestFactory().post('/graphql/'))
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data['topHolders'], [
+            {'rank': 1, 'balance': 1000, 'wallet': {'id': str(self.wallet.id)}},
+            {'rank': 2, 'balance': 500, 'wallet': {'id': str(self.wallet2.id)}},
+        ])
+        self.assertEqual(result.data['holderRank'], {'rank': 3, 'balance': 300})
@@ -0,0 +1,143 @@
+"""
+Tokens carrying the identity of their user as claims.
+
+Access and refresh tokens include ``username``, ``email``, ``is_staff`` and
+``ver``, the user's token_version, so identity-only endpoints such as
+/api/verify answer from the signed payload without loading the user.
+
+When a user's claim fields change, the new version is stored in the user
+cache (USER_CACHE['ALIAS']) for as long as an access token lives. Tokens with
+an older version are stale, so checking one costs a cache read. A version
+missing from the cache is read from the User row and cached the same way,
+and deleting the user drops it. With a per-process cache such as the local
+memory default, another worker keeps trusting the version it cached until
+it expires, so tokens stay current there for up to an access token lifetime
+after a change; point the alias at a shared cache to avoid that. Refreshing
+reads the user again and issues an access token with the current claims.
+Refresh tokens are checked against the in-process blacklist of
+api/blacklist.py instead of the token_blacklist tables.
+"""
+from django.core.cache import caches
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, TokenError
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from . import blacklist, usercache
+
+CLAIMS = ('username', 'email', 'is_staff', 'ver')
+
+
+def _version_key(user_id):
+    return f'user-version:{user_id}'
+
+
+def _versions():
+    return caches[usercache.cache_settings()['ALIAS']]
+
+
+def _version_timeout():
+    return int(api_settings.ACCESS_TOKEN_LIFETIME.total_seconds())
+
+
+def publish_version(user):
+    """Make tokens issued before the user's current version stale."""
+    _versions().set(_version_key(user.pk), user.token_version, _version_timeout())
+
+
+def forget_version(user_id):
+    _versions().delete(_version_key(user_id))
+
+
+def current_version(user_id):
+    """Return the token_version of the user, None when there is no such user."""
+    from .models import User
+
+    versions = _versions()
+    version = versions.get(_version_key(user_id))
+    if version is None:
+        version = User.objects.filter(pk=user_id).values_list('token_version', flat=True).first()
+        if version is not None:
+            # add, a version published meanwhile is newer
+            versions.add(_version_key(user_id), version, _version_timeout())
+    return version
+
+
+def set_claims(token, user):
+    token['username'] = user.username
+    token['email'] = user.email
+    token['is_staff'] = user.is_staff
+    token['ver'] = user.token_version
+    return token
+
+
+def has_claims(token):
+    return all(claim in token for claim in CLAIMS)
+
+
+def is_current(token):
+    """Whether the claims of ``token`` still describe its user."""
+    if not has_claims(token):
+        return False
+    version = current_version(token[api_settings.USER_ID_CLAIM])
+    return version is not None and token['ver'] >= version
+
+
+class ClaimsAccessToken(AccessToken):
+    @classmethod
+    def for_user(cls, user):
+        return set_claims(super().for_user(user), user)
+
+
+class ClaimsRefreshToken(RefreshToken):
+    # the claims are copied into the access tokens made from it
+    @classmethod
+    def for_user(cls, user):
+        return set_claims(super().for_user(user), user)
+
+    def check_blacklist(self):
+        if blacklist.is_blacklisted(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError(_('Token is blacklisted'))
+
+
+def tokens_for(user):
+    # the version was just read, checking the new tokens needs no query
+    _versions().add(_version_key(user.pk), user.token_version, _version_timeout())
+    refresh = ClaimsRefreshToken.for_user(user)
+    return {
+        'refresh': str(refresh),
+        'access': str(refresh.access_token),
+    }
+
+
+class ClaimsUser(TokenUser):
+    """A stateless user built from the claims of a token."""
+
+    @property
+    def email(self):
+        return self.token.get('email', '')
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    """Refreshes with the current claims of the user, rejecting removed or inactive users."""
+
+    def validate(self, attrs):
+        refresh = ClaimsRefreshToken(attrs['refresh'])
+        user = usercache.get_user(refresh[api_settings.USER_ID_CLAIM])
+        if user is None or not user.is_active:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+
+        set_claims(refresh, user)
+        data = {'access': str(refresh.access_token)}
+
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                refresh.blacklist()
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            data['refresh'] = str(refresh)
+
+        return data
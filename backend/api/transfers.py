@@ -0,0 +1,352 @@
+"""
+Transfers between wallets.
+
+A transfer runs in one atomic block with three statements: a SELECT that
+locks both wallets together with their users (needed for the signing
+message), one conditional UPDATE that debits and credits both balances
+and their running totals, and the INSERT of the Transaction with its
+balance snapshots. The debit only applies while ``balance >= amount``, so
+concurrent transfers can not overdraw a wallet even when the locked read
+is stale. Committed transfers are published to the subscribers of both
+wallets, see api/events.py. Both wallets and the transaction are on the
+shard of the currency, see api/shards.py.
+"""
+import binascii
+from collections import defaultdict
+from contextlib import ExitStack
+
+from Crypto.Hash import SHA256
+from django.db import connections, router, transaction as db_transaction
+from django.db.models import Case, F, Q, When
+from django.utils import timezone
+
+from . import events, keycache, leaderboard, shards
+from .models import Currency, Transaction, Wallet
+
+
+class TransferError(Exception):
+    status_code = 400
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class WalletNotFound(TransferError):
+    status_code = 404
+
+
+class CurrencyNotFound(TransferError):
+    status_code = 404
+
+
+class NotWalletOwner(TransferError):
+    status_code = 401
+
+
+class InsufficientFunds(TransferError):
+    pass
+
+
+class CurrencyMoving(TransferError):
+    status_code = 503
+
+
+# the answer to any write refused by shards.LedgerMoving, see api/views.py
+MOVING_MESSAGE = 'Currency is being moved, try again shortly'
+
+
+def _shard(currency_id):
+    # asks the routers, which also note the write for the replica routing
+    try:
+        return router.db_for_write(Wallet, instance=Currency(pk=currency_id))
+    except shards.LedgerMoving:
+        raise CurrencyMoving(MOVING_MESSAGE)
+
+
+def _check(wallets, sender_id, receiver_id, amount, currency_id, user, currency_exists, balance=None):
+    """Validate one transfer against the loaded wallets, return (sender, receiver)."""
+    sender = wallets.get(sender_id)
+    receiver = wallets.get(receiver_id)
+    if sender is None:
+        raise WalletNotFound('Invalid sender wallet id')
+    if receiver is None:
+        raise WalletNotFound('Invalid reciever wallet id')
+    if sender.currency_id != currency_id or receiver.currency_id != currency_id:
+        if not currency_exists():
+            raise CurrencyNotFound('Invalid currency id')
+        raise TransferError('Wallets do not belong to this currency')
+    if sender.id == receiver.id:
+        raise TransferError('Sender and receiver cannot be the same')
+    if user is not None and sender.user_id != user.id:
+        raise NotWalletOwner('You are not the owner of this wallet')
+    if balance is None:
+        balance = sender.balance
+    if amount <= 0 or amount > balance:
+        raise InsufficientFunds('Insufficient funds')
+    return sender, receiver
+
+
+def transfer(sender, receiver, amount, currency, user=None, signatures=None):
+    """
+    Move ``amount`` from wallet id ``sender`` to wallet id ``receiver``.
+
+    When ``user`` is given it has to own the sender wallet. ``signatures``
+    may hold the result of sign() computed before the call. Returns the saved
+    Transaction or raises a TransferError.
+    """
+    try:
+        sender, receiver, currency = int(sender), int(receiver), int(currency)
+    except (TypeError, ValueError):
+        raise TransferError('Invalid wallet or currency id')
+    return apply(Transaction(sender_id=sender, receiver_id=receiver,
+                             amount=amount, currency_id=currency), user=user, signatures=signatures)
+
+
+def sign(sender, receiver, amount):
+    """
+    Return (message, sender signature, receiver signature) for a transfer
+    between two wallets loaded with their users.
+
+    Signing is the slow part of a transfer, callers that can run it
+    elsewhere (the async views) sign first and pass the result to
+    transfer(), so the wallets stay locked only for a signature check.
+    """
+    message = Transaction.message_for(sender, receiver, amount)
+    return message, sender.sign(message), receiver.sign(message)
+
+
+def _signed_by(wallet, message, signature):
+    try:
+        keycache.verifier(wallet).verify(
+            SHA256.new(message.encode('utf-8')), binascii.unhexlify(signature))
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def apply(transaction, user=None, signatures=None):
+    """Apply an unsaved Transaction: move the balances, sign and insert it."""
+    try:
+        amount = int(transaction.amount)
+    except (TypeError, ValueError):
+        raise InsufficientFunds('Insufficient funds')
+
+    # wallet instances the caller attached, kept in step with the new balances
+    attached = [
+        getattr(transaction, name) for name in ('sender', 'receiver')
+        if Transaction._meta.get_field(name).is_cached(transaction)
+    ]
+
+    using = _shard(transaction.currency_id)
+    with db_transaction.atomic(using=using):
+        wallets = {
+            wallet.id: wallet for wallet in shards.with_users(
+                Wallet.objects.using(using).select_for_update()
+                .filter(id__in=[transaction.sender_id, transaction.receiver_id]))
+        }
+        sender, receiver = _check(
+            wallets, transaction.sender_id, transaction.receiver_id, amount,
+            transaction.currency_id, user,
+            lambda: Currency.objects.filter(id=transaction.currency_id).exists())
+
+        updated = Wallet.objects.using(using).filter(
+            Q(id=receiver.id) | Q(id=sender.id, balance__gte=amount)
+        ).update(
+            balance=Case(
+                When(id=sender.id, then=F('balance') - amount),
+                default=F('balance') + amount,
+            ),
+            total_sent=Case(
+                When(id=sender.id, then=F('total_sent') + amount),
+                default=F('total_sent'),
+            ),
+            total_received=Case(
+                When(id=receiver.id, then=F('total_received') + amount),
+                default=F('total_received'),
+            ),
+            updated_at=timezone.now(),
+        )
+        if updated != 2:
+            raise InsufficientFunds('Insufficient funds')
+
+        message = Transaction.message_for(sender, receiver, amount)
+        if signatures is not None and not (
+                signatures[0] == message
+                and _signed_by(sender, message, signatures[1])
+                and _signed_by(receiver, message, signatures[2])):
+            signatures = None
+        if signatures is None:
+            signatures = message, sender.sign(message), receiver.sign(message)
+        transaction.sender = sender
+        transaction.receiver = receiver
+        transaction.amount = amount
+        transaction.before_sender_amount_snapshot = sender.balance
+        transaction.before_receiver_amount_snapshot = receiver.balance
+        transaction.after_sender_amount_snapshot = sender.balance - amount
+        transaction.after_receiver_amount_snapshot = receiver.balance + amount
+        transaction.sender_signature = signatures[1]
+        transaction.receiver_signature = signatures[2]
+        shards.assign_ids([transaction])
+        super(Transaction, transaction).save(force_insert=True, using=using)
+        events.publish_transfers([transaction], using=using)
+        leaderboard.record([transaction], using=using)
+
+    sender.balance = transaction.after_sender_amount_snapshot
+    receiver.balance = transaction.after_receiver_amount_snapshot
+    for wallet in attached:
+        wallet.balance = wallets[wallet.id].balance
+    return transaction
+
+
+def transfer_batch(items, user=None, atomic=True):
+    """
+    Apply a list of transfers, each a dict with sender, receiver, amount and
+    currency ids, in one database transaction.
+
+    Wallets are loaded with one query and balances are checked in memory in
+    the order of ``items``. Every touched wallet gets its net change from one
+    UPDATE and the transactions are inserted with one bulk_create. With
+    ``atomic`` a single invalid item rejects the whole batch, otherwise the
+    invalid items are skipped. Returns one result dict per item.
+
+    Items of currencies on different shards run in one transaction per
+    shard, these commit one after the other.
+    """
+    results = [None] * len(items)
+    planned = []
+    for index, item in enumerate(items):
+        try:
+            planned.append((index, int(item['sender']), int(item['receiver']),
+                            int(item['amount']), int(item['currency'])))
+        except (KeyError, TypeError, ValueError):
+            results[index] = _failed(index, 'Invalid transfer')
+
+    shard_of = {}
+    for index, _, _, _, currency_id in planned:
+        try:
+            shard_of.setdefault(currency_id, _shard(currency_id))
+        except CurrencyMoving as err:
+            results[index] = _failed(index, err.message)
+    planned = [item for item in planned if item[4] in shard_of]
+
+    with ExitStack() as stack:
+        wallets = {}
+        for using in sorted(set(shard_of.values())):
+            stack.enter_context(db_transaction.atomic(using=using))
+            wallet_ids = {wallet_id for _, sender, receiver, _, currency_id in planned
+                          if shard_of[currency_id] == using for wallet_id in (sender, receiver)}
+            wallets.update((wallet.id, wallet) for wallet in shards.with_users(
+                Wallet.objects.using(using).select_for_update().filter(id__in=wallet_ids)))
+        currency_ids = {currency for _, _, _, _, currency in planned}
+        known_currencies = None
+
+        def currency_exists(currency_id):
+            nonlocal known_currencies
+            if known_currencies is None:
+                known_currencies = set(Currency.objects.filter(
+                    id__in=currency_ids).values_list('id', flat=True))
+            return currency_id in known_currencies
+
+        balances = {wallet.id: wallet.balance for wallet in wallets.values()}
+        accepted = []
+        for index, sender_id, receiver_id, amount, currency_id in planned:
+            try:
+                sender, receiver = _check(
+                    wallets, sender_id, receiver_id, amount, currency_id, user,
+                    lambda: currency_exists(currency_id), balance=balances.get(sender_id))
+            except TransferError as err:
+                results[index] = _failed(index, err.message)
+                continue
+            transaction = Transaction(
+                sender=sender, receiver=receiver, amount=amount, currency_id=currency_id,
+                before_sender_amount_snapshot=balances[sender.id],
+                before_receiver_amount_snapshot=balances[receiver.id],
+                after_sender_amount_snapshot=balances[sender.id] - amount,
+                after_receiver_amount_snapshot=balances[receiver.id] + amount,
+            )
+            balances[sender.id] -= amount
+            balances[receiver.id] += amount
+            accepted.append((index, transaction))
+
+        if atomic and len(accepted) != len(items):
+            for index, _ in accepted:
+                results[index] = _failed(index, 'Batch rejected')
+            return results
+
+        by_shard = defaultdict(list)
+        for index, transaction in accepted:
+            by_shard[shard_of[transaction.currency_id]].append(transaction)
+        for using, transactions in by_shard.items():
+            _apply_balances(transactions, using)
+            for transaction in transactions:
+                message = Transaction.message_for(
+                    transaction.sender, transaction.receiver, transaction.amount)
+                transaction.sender_signature = transaction.sender.sign(message)
+                transaction.receiver_signature = transaction.receiver.sign(message)
+            shards.assign_ids(transactions)
+            Transaction.objects.using(using).bulk_create(transactions)
+            _read_back_ids(transactions, using)
+            events.publish_transfers(transactions, using=using)
+            leaderboard.record(transactions, using=using)
+
+    for index, transaction in accepted:
+        results[index] = {
+            'index': index,
+            'status': 'ok',
+            'transaction': {
+                'id': transaction.id,
+                'sender': transaction.sender_id,
+                'receiver': transaction.receiver_id,
+                'amount': transaction.amount,
+                'currency': transaction.currency_id,
+            },
+        }
+    return results
+
+
+def _failed(index, message):
+    return {'index': index, 'status': 'error', 'message': message}
+
+
+def _read_back_ids(transactions, using):
+    """Set the ids of inserted ``transactions`` on backends whose bulk_create does not return them."""
+    if transactions[0].pk is not None or connections[using].features.can_return_rows_from_bulk_insert:
+        return
+    # the senders stay locked until the commit, so the newest rows they sent are these
+    inserted = list(Transaction.objects.using(using).filter(
+        sender_id__in={transaction.sender_id for transaction in transactions},
+    ).order_by('-id').values_list('id', flat=True)[:len(transactions)])
+    for transaction, pk in zip(transactions, reversed(inserted)):
+        transaction.pk = pk
+
+
+def _apply_balances(transactions, using):
+    """Write the net change and running totals of every wallet with one guarded UPDATE."""
+    sent, received = defaultdict(int), defaultdict(int)
+    for transaction in transactions:
+        sent[transaction.sender_id] += transaction.amount
+        received[transaction.receiver_id] += transaction.amount
+    wallet_ids = set(sent) | set(received)
+    deltas = {wallet_id: received[wallet_id] - sent[wallet_id] for wallet_id in wallet_ids}
+
+    # a debited wallet must still hold the amount, in case the locked read was stale
+    guard = Q(id__in=[wallet_id for wallet_id, delta in deltas.items() if delta >= 0])
+    for wallet_id, delta in deltas.items():
+        if delta < 0:
+            guard |= Q(id=wallet_id, balance__gte=-delta)
+
+    def per_wallet(field, amounts):
+        return Case(*[
+            When(id=wallet_id, then=F(field) + amount)
+            for wallet_id, amount in amounts.items() if amount
+        ], default=F(field))
+
+    updated = Wallet.objects.using(using).filter(guard).update(
+        balance=per_wallet('balance', deltas),
+        total_sent=per_wallet('total_sent', sent),
+        total_received=per_wallet('total_received', received),
+        updated_at=timezone.now(),
+    )
+    if updated != len(wallet_ids):
+        raise InsufficientFunds('Insufficient funds')
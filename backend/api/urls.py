@@ -1,25 +1,35 @@
+from django.conf import settings
 from django.urls import path
-from rest_framework_simplejwt.views import (
-    TokenRefreshView,
-)
+from . import async_views, views
 
-from . import views
+# the CPU heavy endpoints have async versions for ASGI deployments
+hot = async_views if getattr(settings, 'ASYNC_VIEWS', {}).get('ENABLED') else views
 
 urlpatterns = [
     path('', views.index, name='index'),
     path('healthcheck', views.index, name='healthcheck'),
-    path('register', views.register, name='register'),
-    path('login', views.login, name='login'),
-    path('refresh', TokenRefreshView.as_view(), name='refresh'),
+    path('register', hot.register, name='register'),
+    path('login', hot.login, name='login'),
+    path('refresh', views.RefreshView.as_view(), name='refresh'),
     path('verify', views.verify, name='verify'),
     path("logout", views.logout, name="logout"),
 
     path("currency", views.currency, name="currency"),
-    path("currency/join", views.currency_join, name="currency_join"),
+    path("currency/join", hot.currency_join, name="currency_join"),
     path("currency/leave", views.currency_leave, name="currency_leave"),
+    path("currency/<int:currency_id>/export.<str:export_format>", views.currency_export, name="currency_export"),
+    path("currency/<int:currency_id>/balances", views.currency_balances, name="currency_balances"),
 
-    path("wallet/create", views.wallet_create, name="wallet_create"),
+    path("wallet/create", hot.wallet_create, name="wallet_create"),
     path("wallet/delete", views.currency_leave, name="wallet_delete"),
+    path("wallet/<int:wallet_id>/export.<str:export_format>", views.wallet_export, name="wallet_export"),
+    path("wallet/<int:wallet_id>/balance", views.wallet_balance, name="wallet_balance"),
 
-    path("transaction/create", views.transaction_create, name="transaction_create"),
+    path("transaction/create", hot.transaction_create, name="transaction_create"),
+    path("transaction/batch", views.transaction_batch, name="transaction_batch"),
+
+    path("keypool/stats", views.keypool_stats, name="keypool_stats"),
+    path("keycache/stats", views.keycache_stats, name="keycache_stats"),
+    path("usercache/stats", views.usercache_stats, name="usercache_stats"),
+    path("blacklist/stats", views.blacklist_stats, name="blacklist_stats"),
 ]
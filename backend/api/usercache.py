@@ -0,0 +1,85 @@
+"""
+Cache of authenticated users keyed by the user_id of their token.
+
+Every API call authenticates its token and would load the User row each
+time. Users are kept in the ``USER_CACHE['ALIAS']`` cache of CACHES instead,
+which bounds its size and gives the entries a TTL. The local memory cache is
+per process, pointing the alias at a shared backend (memcached, redis) lets
+the workers share it. Saving or deleting a user drops its entry, see
+api/signals.py.
+"""
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+DEFAULTS = {
+    'ALIAS': 'users',
+    # seconds an entry lives, None uses the TIMEOUT of the cache
+    'TIMEOUT': None,
+}
+
+_counters = {'hits': 0, 'misses': 0}
+_counters_lock = threading.Lock()
+
+# cache.get(key, default) can not tell a miss from a cached None
+_MISSING = object()
+
+
+def cache_settings():
+    return {**DEFAULTS, **getattr(settings, 'USER_CACHE', {})}
+
+
+def _cache():
+    return caches[cache_settings()['ALIAS']]
+
+
+def _key(user_id):
+    return f'user:{user_id}'
+
+
+def _count(name):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def get_user(user_id):
+    """Return the User with ``user_id`` or None, from the cache when possible."""
+    from .models import User
+
+    cache = _cache()
+    user = cache.get(_key(user_id), _MISSING)
+    if user is not _MISSING:
+        _count('hits')
+        return user
+    _count('misses')
+    user = User.objects.filter(id=user_id).first()
+    if user is not None:
+        timeout = cache_settings()['TIMEOUT']
+        if timeout is None:
+            cache.set(_key(user_id), user)
+        else:
+            cache.set(_key(user_id), user, timeout)
+    return user
+
+
+def invalidate(user_id):
+    _cache().delete(_key(user_id))
+
+
+def stats():
+    """Hits and misses of this process, each hit is a User query saved."""
+    with _counters_lock:
+        counters = dict(_counters)
+    lookups = counters['hits'] + counters['misses']
+    return {
+        'hits': counters['hits'],
+        'misses': counters['misses'],
+        'hit_rate': counters['hits'] / lookups if lookups else 0.0,
+    }
+
+
+def reset_stats():
+    with _counters_lock:
+        for name in _counters:
+            _counters[name] = 0
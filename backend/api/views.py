@@ -1,15 +1,29 @@
+from django.conf import settings
 from django.shortcuts import render
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import serializers, status
+from rest_framework.decorators import authentication_classes
+from rest_framework.views import exception_handler as drf_exception_handler
 from rest_framework_simplejwt.tokens import RefreshToken, AccessToken, TokenError, Token
+from rest_framework_simplejwt.views import TokenRefreshView
+
+from .authentication import ClaimsJWTAuthentication
 
 from .serializers import *
 from .models import *
+from . import blacklist, checkpoints, exports, keycache, keypool, shards, tokens, transfers, usercache
 
 # Create your views here.
 
 
+def exception_handler(exc, context):
+    # wallet saves and deletes are refused while their currency moves shards
+    if isinstance(exc, shards.LedgerMoving):
+        return Response({'message': transfers.MOVING_MESSAGE}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return drf_exception_handler(exc, context)
+
+
 @api_view(['GET'])
 def index(request):
     return Response({'message': 'Hello, world!'})
@@ -24,12 +38,7 @@ def register(request):
         username=username, email=email, password=password)
     user.save()
 
-    refresh = RefreshToken.for_user(user)
-    access = AccessToken.for_user(user)
-    return Response({
-        'refresh': str(refresh),
-        'access': str(access)
-    }, status=status.HTTP_201_CREATED)
+    return Response(tokens.tokens_for(user), status=status.HTTP_201_CREATED)
 
 
 @api_view(['POST'])
@@ -40,25 +49,27 @@ def login(request):
     if user is None:
         return Response({'message': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
     if user.check_password(password):
-        refresh = RefreshToken.for_user(user)
-        access = AccessToken.for_user(user)
-        token = {
-            'refresh': str(refresh),
-            'access': str(access)
-        }
-        return Response(token, status=status.HTTP_200_OK)
+        return Response(tokens.tokens_for(user), status=status.HTTP_200_OK)
     else:
         return Response({'message': 'Invalid credentials'}, status=status.HTTP_401_UNAUTHORIZED)
 
 
 @api_view(['GET', 'POST'])
+@authentication_classes([ClaimsJWTAuthentication])
 def verify(request):
-    # print("Hallo")
+    # tokens with current claims are answered without loading the user
     if request.method == 'POST':
         access = request.data['access']
         try:
             token = AccessToken(access)
-            user = User.objects.get(id=token.payload['user_id'])
+            if tokens.is_current(token):
+                return Response({
+                    'username': token['username'],
+                    'email': token['email']
+                }, status=status.HTTP_200_OK)
+            user = usercache.get_user(token.payload['user_id'])
+            if user is None:
+                return Response({'message': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
             return Response({
                 'username': user.username,
                 'email': user.email
@@ -76,9 +87,13 @@ def verify(request):
             return Response({'message': 'User is not authenticated'}, status=status.HTTP_401_UNAUTHORIZED)
 
 
+class RefreshView(TokenRefreshView):
+    serializer_class = tokens.ClaimsTokenRefreshSerializer
+
+
 @api_view(['POST'])
 def logout(request):
-    refresh = RefreshToken(request.data['refresh'])
+    refresh = tokens.ClaimsRefreshToken(request.data['refresh'])
     refresh.blacklist()
     return Response({'message': 'Logged out'}, status=status.HTTP_205_RESET_CONTENT)
 
@@ -94,6 +109,8 @@ def currency(request):
         user = request.user
         currency_name = request.data['name']
         currency_symbol = request.data['symbol']
+        if Currency.objects.filter(symbol=currency_symbol).exists():
+            return Response({'message': 'Symbol already in use'}, status=status.HTTP_400_BAD_REQUEST)
         currency = Currency(name=currency_name,
                             symbol=currency_symbol, admin=user)
         currency.save()
@@ -150,7 +167,7 @@ def currency_leave(request):
         else:
             return Response({'message': 'Wallet is required'}, status=status.HTTP_400_BAD_REQUEST)
         try:
-            wallet = Wallet.objects.get(id=walletid)
+            wallet = shards.find(Wallet.objects.all(), walletid)
         except Wallet.DoesNotExist:
             return Response({'message': 'Invalid wallet id'}, status=status.HTTP_404_NOT_FOUND)
 
@@ -195,32 +212,149 @@ def transaction_create(request):
         amount = request.data['amount']
         currency = request.data['currency']
         try:
-            s_wallet = Wallet.objects.get(id=sender)
-        except Wallet.DoesNotExist:
-            return Response({'message': 'Invalid sender wallet id'}, status=status.HTTP_404_NOT_FOUND)
+            transaction = transfers.transfer(
+                sender, receiver, amount, currency, user=user)
+        except transfers.TransferError as err:
+            return Response({'message': err.message}, status=err.status_code)
+        transactionSerializer = TransactionSerializers(transaction)
+        return Response(transactionSerializer.data, status=status.HTTP_201_CREATED)
+    else:
+        return Response({'message': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
+
+
+@api_view(['POST'])
+def transaction_batch(request):
+    if request.user.is_authenticated:
+        items = request.data.get('transfers')
+        if not isinstance(items, list) or len(items) == 0:
+            return Response({'message': 'Transfers are required'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.TRANSACTION_BATCH_MAX_SIZE:
+            return Response({'message': 'Too many transfers'}, status=status.HTTP_400_BAD_REQUEST)
+        mode = request.data.get('mode', 'atomic')
+        if mode not in ('atomic', 'best_effort'):
+            return Response({'message': 'Invalid mode'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            results = transfers.transfer_batch(
+                items, user=request.user, atomic=mode == 'atomic')
+        except transfers.TransferError as err:
+            return Response({'message': err.message}, status=err.status_code)
+        applied = sum(1 for result in results if result['status'] == 'ok')
+        if applied == len(results):
+            response_status = status.HTTP_201_CREATED
+        elif applied == 0:
+            response_status = status.HTTP_400_BAD_REQUEST
+        else:
+            response_status = status.HTTP_207_MULTI_STATUS
+        return Response({'applied': applied, 'results': results}, status=response_status)
+    else:
+        return Response({'message': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
+
+
+def _export(request, queryset, export_format, filename, counterparty_of=None):
+    try:
+        queryset = exports.filter_history(queryset, request.query_params, counterparty_of)
+        return exports.export_response(
+            queryset, export_format, filename,
+            compress=request.query_params.get('gzip') in ('1', 'true'))
+    except exports.ExportError as err:
+        return Response({'message': err.message}, status=status.HTTP_400_BAD_REQUEST)
 
+
+@api_view(['GET'])
+def wallet_export(request, wallet_id, export_format):
+    if request.user.is_authenticated:
         try:
-            r_wallet = Wallet.objects.get(id=receiver)
+            wallet = shards.find(Wallet.objects.all(), wallet_id)
         except Wallet.DoesNotExist:
-            return Response({'message': 'Invalid reciever wallet id'}, status=status.HTTP_404_NOT_FOUND)
+            return Response({'message': 'Invalid wallet id'}, status=status.HTTP_404_NOT_FOUND)
+        # the owner, the admin of the currency and auditors
+        if request.user.id not in (wallet.user_id, wallet.currency.admin_id) and not request.user.is_staff:
+            return Response({'message': 'Not authorized'}, status=status.HTTP_401_UNAUTHORIZED)
+        return _export(request, exports.wallet_history(wallet), export_format, f'wallet-{wallet.id}',
+                       counterparty_of=wallet.id)
+    else:
+        return Response({'message': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
 
+
+@api_view(['GET'])
+def currency_export(request, currency_id, export_format):
+    if request.user.is_authenticated:
         try:
-            currency = Currency.objects.get(id=currency)
+            currency = Currency.objects.get(id=currency_id)
         except Currency.DoesNotExist:
             return Response({'message': 'Invalid currency id'}, status=status.HTTP_404_NOT_FOUND)
-        
-        if s_wallet == r_wallet:
-            return Response({'message': 'Sender and receiver cannot be the same'}, status=status.HTTP_400_BAD_REQUEST)
-
-        if s_wallet.user == user:
-            if amount > s_wallet.balance or amount <= 0:
-                return Response({'message': 'Insufficient funds'}, status=status.HTTP_400_BAD_REQUEST)
-            transaction = Transaction(
-                sender=s_wallet, receiver=r_wallet, amount=amount, currency=currency)
-            transaction.save()
-            transactionSerializer = TransactionSerializers(transaction)
-            return Response(transactionSerializer.data, status=status.HTTP_201_CREATED)
+        if request.user.id != currency.admin_id and not request.user.is_staff:
+            return Response({'message': 'Not authorized'}, status=status.HTTP_401_UNAUTHORIZED)
+        return _export(request, exports.currency_history(currency), export_format, f'currency-{currency.symbol}')
+    else:
+        return Response({'message': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
 
-        return Response({'message': 'You are not the owner of this wallet'}, status=status.HTTP_401_UNAUTHORIZED)
+
+@api_view(['GET'])
+def wallet_balance(request, wallet_id):
+    if request.user.is_authenticated:
+        try:
+            wallet = shards.find(Wallet.objects.all(), wallet_id)
+        except Wallet.DoesNotExist:
+            return Response({'message': 'Invalid wallet id'}, status=status.HTTP_404_NOT_FOUND)
+        if request.user.id not in (wallet.user_id, wallet.currency.admin_id) and not request.user.is_staff:
+            return Response({'message': 'Not authorized'}, status=status.HTTP_401_UNAUTHORIZED)
+        try:
+            at = checkpoints.parse_time(request.query_params.get('at'))
+        except checkpoints.CheckpointError as err:
+            return Response({'message': err.message}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'wallet': wallet.id, 'at': at, 'balance': checkpoints.balance_at(wallet, at)},
+                        status=status.HTTP_200_OK)
+    else:
+        return Response({'message': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
+
+
+@api_view(['GET'])
+def currency_balances(request, currency_id):
+    if request.user.is_authenticated:
+        try:
+            currency = Currency.objects.get(id=currency_id)
+        except Currency.DoesNotExist:
+            return Response({'message': 'Invalid currency id'}, status=status.HTTP_404_NOT_FOUND)
+        if request.user.id != currency.admin_id and not request.user.is_staff:
+            return Response({'message': 'Not authorized'}, status=status.HTTP_401_UNAUTHORIZED)
+        try:
+            at = checkpoints.parse_time(request.query_params.get('at'))
+        except checkpoints.CheckpointError as err:
+            return Response({'message': err.message}, status=status.HTTP_400_BAD_REQUEST)
+        balances = [
+            {'wallet': wallet.id, 'user': wallet.user.username, 'balance': balance}
+            for wallet, balance in checkpoints.balances_at(currency.id, at)
+        ]
+        return Response({'currency': currency.id, 'at': at, 'balances': balances}, status=status.HTTP_200_OK)
     else:
         return Response({'message': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
+
+
+@api_view(['GET'])
+def keypool_stats(request):
+    if request.user.is_authenticated and request.user.is_staff:
+        return Response(keypool.stats(), status=status.HTTP_200_OK)
+    return Response({'message': 'Not authorized'}, status=status.HTTP_401_UNAUTHORIZED)
+
+
+@api_view(['GET'])
+def keycache_stats(request):
+    if request.user.is_authenticated and request.user.is_staff:
+        return Response(keycache.stats(), status=status.HTTP_200_OK)
+    return Response({'message': 'Not authorized'}, status=status.HTTP_401_UNAUTHORIZED)
+
+
+@api_view(['GET'])
+def usercache_stats(request):
+    if request.user.is_authenticated and request.user.is_staff:
+        return Response(usercache.stats(), status=status.HTTP_200_OK)
+    return Response({'message': 'Not authorized'}, status=status.HTTP_401_UNAUTHORIZED)
+
+
+@api_view(['GET'])
+def blacklist_stats(request):
+    if request.user.is_authenticated and request.user.is_staff:
+        return Response(blacklist.stats(), status=status.HTTP_200_OK)
+    return Response({'message': 'Not authorized'}, status=status.HTTP_401_UNAUTHORIZED)
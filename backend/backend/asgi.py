@@ -2,6 +2,9 @@
 ASGI config for backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Requests for the wallet event stream are served by api.streams, everything
+else by Django, whose streaming responses such as the history exports are
+iterated off the event loop, see api/exports.py.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
@@ -9,8 +12,20 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+# imported once the apps are loaded
+from api.exports import ExportASGIHandler  # noqa: E402
+from api.streams import EVENT_STREAM_PATH, event_stream  # noqa: E402
+
+django_application = ExportASGIHandler()
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] == EVENT_STREAM_PATH:
+        return await event_stream(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -56,15 +56,20 @@ AUTHENTICATION_BACKENDS = [
     "api.backends.JWTBackend",
 ]
 
+# Token authenticated routes that skip the session, CSRF, auth and message
+# middleware (the Web* wrappers), set DJANGO_API_FAST_PATH=0 to run them everywhere
+API_PATH_PREFIXES = ('/api/', '/graphql/') if os.getenv("DJANGO_API_FAST_PATH", "1") == "1" else ()
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'api.middleware.WebSessionMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
+    'api.middleware.WebCsrfViewMiddleware',
+    'api.middleware.WebAuthenticationMiddleware',
+    'api.middleware.WebMessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'api.middleware.JWTAuthMiddleware',
+    'api.routers.ReplicaMiddleware',
 ]
 
 ROOT_URLCONF = 'backend.urls'
@@ -91,11 +96,71 @@ WSGI_APPLICATION = 'backend.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
-DATABASES = {
+# DJANGO_DB_PROFILE=sqlite-tuned selects the SQLite backend tuned for
+# concurrent requests (WAL, busy timeout, BEGIN IMMEDIATE and persistent
+# connections), see api/db/sqlite_tuned/base.py
+DATABASE_PROFILES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.getenv("DJANGO_DB_NAME", BASE_DIR / 'db.sqlite3'),
+    },
+    'sqlite-tuned': {
+        'ENGINE': 'api.db.sqlite_tuned',
+        'NAME': os.getenv("DJANGO_DB_NAME", BASE_DIR / 'db.sqlite3'),
+        'CONN_MAX_AGE': 600,
+        'OPTIONS': {
+            # merged over api.db.sqlite_tuned.base.PRAGMAS
+            'pragmas': {},
+        },
+    },
+}
+
+DATABASES = {
+    'default': DATABASE_PROFILES[os.getenv("DJANGO_DB_PROFILE", "default")],
+}
+
+# DJANGO_DB_REPLICAS lists the files of read replicas of the primary,
+# comma separated. Read-only GraphQL queries are answered from them, see
+# api/routers.py, and `python manage.py sync_replicas` keeps them current.
+DATABASE_REPLICAS = []
+for index, name in enumerate(filter(None, os.getenv("DJANGO_DB_REPLICAS", "").split(','))):
+    DATABASE_REPLICAS.append(f'replica{index}')
+    DATABASES[f'replica{index}'] = {
+        **DATABASES['default'],
+        'NAME': name.strip(),
+        'TEST': {'MIRROR': 'default'},
+    }
+
+# DJANGO_LEDGER_SHARDS lists the files of more databases holding the
+# wallets and transactions of the currencies placed on them, comma
+# separated. `default` is always the first shard, see api/shards.py.
+LEDGER_SHARDS = ['default']
+for index, name in enumerate(filter(None, os.getenv("DJANGO_LEDGER_SHARDS", "").split(',')), start=1):
+    LEDGER_SHARDS.append(f'ledger{index}')
+    DATABASES[f'ledger{index}'] = {
+        **DATABASES['default'],
+        'NAME': name.strip(),
     }
+
+DATABASE_ROUTERS = ['api.shards.ShardRouter', 'api.routers.ReplicaRouter']
+
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # authenticated users, point it at a shared backend to share it between workers
+    'users': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'users',
+        # no longer than an access token lives
+        'TIMEOUT': 300,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+USER_CACHE = {
+    'ALIAS': 'users',
 }
 
 
@@ -139,13 +204,35 @@ STATIC_URL = '/static/'
 
 
 GRAPHENE = {
-    "SCHEMA": "api.schema.schema"
+    "SCHEMA": "api.schema.schema",
+    # largest page a connection field returns
+    "RELAY_CONNECTION_MAX_LIMIT": 100,
+}
+
+# Operations over these limits are rejected before they run, see api/query_cost.py
+GRAPHQL_LIMITS = {
+    'MAX_DEPTH': 10,
+    'MAX_COST': 20000,
+    # rows assumed for list fields without a page size
+    'DEFAULT_LIST_SIZE': 100,
+}
+
+# Parsed document cache and persisted queries, see api/documents.py
+GRAPHQL_DOCUMENTS = {
+    'CACHE_SIZE': 500,
+    # only run documents registered with `manage.py register_queries`
+    'PERSISTED_ONLY': os.getenv("GRAPHQL_PERSISTED_ONLY", "") == "1",
+    # seconds a process trusts a registered query it read
+    'REGISTRY_TTL': 60,
 }
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+        # shares the decoded token with api.middleware.JWTAuthMiddleware
+        'api.authentication.CachedJWTAuthentication',
+    ),
+    # answers writes to a currency moving between shards with a 503
+    'EXCEPTION_HANDLER': 'api.views.exception_handler',
 }
 
 SIMPLE_JWT = {
@@ -157,3 +244,113 @@ SIMPLE_JWT = {
     'SIGNING_KEY': SECRET_KEY,
     'USER_ID_FIELD': 'id',
 }
+
+# In-process blacklist of refresh tokens and its compaction, see api/blacklist.py
+TOKEN_BLACKLIST = {
+    # seconds between two reads of the tokens blacklisted by other workers
+    'SYNC_INTERVAL': 5,
+    # seconds of rows read again by every sync, longer than a commit may take
+    'SYNC_LOOKBACK': 60,
+    # seconds between two syncs reading every row, the longest a revocation can go unseen
+    'RELOAD_INTERVAL': 300,
+    'COMPACT_CHUNK_SIZE': 1000,
+    'COMPACT_PAUSE': 0.05,
+}
+
+# Streaming transaction history exports, see api/exports.py
+EXPORTS = {
+    # rows read per keyset query
+    'BATCH_SIZE': 5000,
+    'FETCH_SIZE': 1000,
+}
+
+# Balance checkpoints answering point-in-time balances, see api/checkpoints.py
+BALANCE_CHECKPOINTS = {
+    # transactions of a currency between two checkpoints
+    'EVERY': 1000,
+    # seconds after which fewer transactions get a checkpoint too
+    'INTERVAL': 3600,
+    # transactions younger than this may still be committing
+    'SETTLE_SECONDS': 60,
+    'CHUNK_SIZE': 500,
+}
+
+# Per-currency volume rollups, see api/rollups.py
+ROLLUPS = {
+    # transactions younger than this may still be committing
+    'SETTLE_SECONDS': 60,
+    # most buckets a volume query returns, longer ranges are downsampled
+    'MAX_POINTS': 500,
+    'CHUNK_SIZE': 500,
+}
+
+# Top holders kept in memory per currency, see api/leaderboard.py
+LEADERBOARD = {
+    # wallets kept per currency, bigger requests read the index
+    'SIZE': 100,
+    # seconds a board trusts the balances moved by other processes
+    'TTL': 30,
+    'DEFAULT_LIMIT': 10,
+}
+
+# Bulk ledger imports, see api/imports.py
+LEDGER_IMPORT = {
+    # rows written per bulk insert
+    'BATCH_SIZE': 2000,
+    # processes generating keys and signing, 0 works in-process
+    'WORKERS': 2,
+}
+
+# Ledger shards, see api/shards.py
+SHARDING = {
+    # seconds a process trusts its cached placement of a currency
+    'PLACEMENT_TTL': 5,
+    # wallet and transaction ids reserved at a time by a process
+    'ID_BLOCK': 100,
+    'MOVE_CHUNK_SIZE': 1000,
+    'MOVE_PAUSE': 0.05,
+}
+
+# Reads sent to DATABASE_REPLICAS, see api/routers.py
+REPLICA_ROUTING = {
+    # seconds a client that wrote keeps reading from the primary
+    'STICKY_SECONDS': 5,
+    'CACHE_ALIAS': 'default',
+    # pages copied per step by sync_replicas
+    'COPY_PAGES': 1024,
+}
+
+# Pre-generated RSA keys handed out to new wallets, see api/keypool.py
+KEY_POOL = {
+    'SIZE': 64,
+    'LOW_WATER': 16,
+    'WORKERS': 2,
+    'INTERVAL': 5,
+}
+
+# Parsed wallet keys kept in memory for signing, see api/keycache.py
+KEY_CACHE = {
+    'SIZE': 1024,
+}
+
+# Async versions of the CPU heavy views for ASGI deployments, see api/async_views.py
+ASYNC_VIEWS = {
+    'ENABLED': os.getenv("DJANGO_ASYNC_VIEWS", "") == "1",
+    # threads hashing passwords and signing transactions
+    'THREADS': 4,
+    # processes generating RSA keys when the key pool is empty, 0 uses the threads
+    'PROCESSES': 2,
+}
+
+# Wallet event stream served by backend/asgi.py, see api/events.py
+EVENTS = {
+    # replaced by a cross-process broker when running several processes
+    'BACKEND': 'api.events.InProcessBroker',
+    # seconds between keep-alive comments on an idle stream
+    'HEARTBEAT': 15,
+    # events buffered for a slow client before the oldest are dropped
+    'QUEUE_SIZE': 100,
+}
+
+# Largest number of transfers accepted by /api/transaction/batch
+TRANSACTION_BATCH_MAX_SIZE = 5000